@@ -0,0 +1,378 @@
+'''
+Detection accuracy and performance benchmark.
+
+Generates a seeded fleet with failures injected (the same generator and failure stages as data_generator.py),
+writes its failure_manifest.csv, then runs every detection method over it and scores them against the manifest:
+
+    rules       the fixed checks the dashboard has always had (find_errors): stopped reporting, signal spread, cpu_temp over 122
+    zscore, cusum, seasonal     the anomaly detectors in view_data/detectors.py
+
+For each method and failure mode: true/false positives, misses, precision, recall and the detection delay
+(hours from the manifest's failure_ts to the first alarm). An alarm on a metric maps to the failure mode
+that changes it (signal -> signal, lumens -> light, cpu_temp -> cooling), alarms on other metrics are false positives.
+
+Wall time and peak traced memory (tracemalloc) are recorded per stage:
+
+    generate    device series
+    inject      failure stages (failures.py)
+    write       device files in --format
+    load        reading the device files back into one frame
+    detect      rules + DetectionEngine
+
+Devices are processed --block-size at a time, so memory stays bounded as the fleet grows. Usage:
+
+    python benchmark_detection.py --devices 150 1000 10000 --days 180 --output results.json
+    python benchmark_detection.py --data-dir ../generate_data/device_data --manifest ../generate_data/failure_manifest.csv
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime as dt
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'generate_data'))
+sys.path.insert(0, os.path.join(ROOT, 'view_data'))
+
+from data_generator import device_attributes, generate_device_series, hourly_timestamps, series_to_frame, device_rng, device_stem
+from failures import FAILURE_MODES, assign_failures, device_stages, run_pipeline, write_manifest
+from writers import get_writer, writer_for
+from detectors import DetectionEngine
+
+# Which failure mode an alarm on each metric points to
+METRIC_MODES = {
+    'signal': 'signal',
+    'lumens': 'light',
+    'cpu_temp': 'cooling'
+}
+
+CPU_TEMP_LIMIT = 122
+SIGNAL_RATIO_LIMIT = 1.25
+
+
+class StageTimer():
+    '''
+    Wall time and peak traced memory per stage, summed/maxed over every time the stage runs.
+    '''
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.peak = defaultdict(int)
+        self.order = []
+
+    def run(self, stage, fn, *args, **kwargs):
+        if stage not in self.order:
+            self.order.append(stage)
+
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+
+        result = fn(*args, **kwargs)
+
+        self.seconds[stage] += time.perf_counter() - start
+        self.peak[stage] = max(self.peak[stage], tracemalloc.get_traced_memory()[1])
+
+        return result
+
+    def results(self):
+        return {s: {'seconds': self.seconds[s], 'peak_mb': self.peak[s] / 1e6} for s in self.order}
+
+
+def scaled_failure_modes(num_devices, base=150):
+    '''
+    FAILURE_MODES is 5 devices per mode out of 150. Keep the same share for other fleet sizes.
+    '''
+    return {name: {**mode, 'count': max(1, round(mode['count'] * num_devices / base))} for name, mode in FAILURE_MODES.items()}
+
+
+def make_fleet(num_devices, seed):
+    attrs = [device_attributes(seed, i) for i in range(num_devices)]
+
+    failures = assign_failures([a['id'] for a in attrs], np.random.default_rng(np.random.SeedSequence([seed])), scaled_failure_modes(num_devices))
+
+    return attrs, failures
+
+
+def generate_block(attrs, interval, seed):
+    '''
+    Each device's series, with its rng so the failure stages carry on from the same stream like generate_device_file.
+    '''
+    timestamps = hourly_timestamps(interval['start'], interval['end'])
+
+    generated = []
+    for a in attrs:
+        rng = device_rng(seed, a['id'])
+        generated.append((a, rng, series_to_frame(generate_device_series(a, timestamps, rng))))
+
+    return generated
+
+
+def inject_block(generated, failures):
+    '''
+    Runs each device through its failure stages. Returns the frames and the manifest records.
+    '''
+    frames = []
+    manifest = []
+
+    for attr, rng, df in generated:
+        df, records = run_pipeline(df, device_stages(failures.get(attr['id'])), rng)
+        for record in records:
+            record['id'] = attr['id']
+
+        frames.append((attr, df))
+        manifest.extend(records)
+
+    return frames, manifest
+
+
+def write_block(frames, interval, data_dir, fmt):
+    writer = get_writer(fmt)
+    paths = []
+
+    for attr, df in frames:
+        path = writer.path(data_dir, device_stem(attr, interval))
+        writer.write(path, df)
+        paths.append(path)
+
+    return paths
+
+
+def load_devices(paths):
+    '''
+    Reads device files back into one ts indexed frame, the shape DetectionEngine.update takes.
+    '''
+    df = pd.concat([writer_for(p).read(p) for p in paths], ignore_index=True)
+
+    return df.set_index('ts').sort_index(kind='stable')
+
+
+def rule_findings(df):
+    '''
+    The dashboard's fixed checks as per device alarms: ids whose signal max/min ratio is more than
+    SIGNAL_RATIO_LIMIT, or with any cpu_temp over CPU_TEMP_LIMIT. Returns {failure mode: set of ids},
+    and each device's last reading, since whether a device stopped reporting depends on the end of the whole fleet's data.
+    '''
+    g = df.groupby('id')
+    ratio = g['signal'].max() / g['signal'].min()
+    cpu_temp_max = g['cpu_temp'].max()
+
+    rules = {
+        'signal': set(ratio.index[np.abs(np.log(ratio.to_numpy())) > np.log(SIGNAL_RATIO_LIMIT)].astype(int)),
+        'cooling': set(cpu_temp_max.index[cpu_temp_max.to_numpy() > CPU_TEMP_LIMIT].astype(int))
+    }
+    last_seen = pd.Series(df.index, index=df['id'].to_numpy().astype(int)).groupby(level=0).max()
+
+    return rules, last_seen
+
+
+def detect_block(df, workers):
+    engine = DetectionEngine(workers=workers)
+    engine.update(df)
+
+    return rule_findings(df), engine.findings()
+
+
+def read_truth(manifest_file):
+    '''
+    {(id, failure mode): failure_ts} from a failure_manifest.csv, ignoring missing_rows which every device gets.
+    '''
+    manifest = pd.read_csv(manifest_file)
+    manifest = manifest[manifest['failure'] != 'missing_rows']
+
+    return {(int(r.id), r.failure): pd.Timestamp(r.failure_ts) for r in manifest.itertuples()}
+
+
+def score(truth, predicted, first_alarms=None):
+    '''
+    Precision/recall/delay per failure mode for one method.
+
+    predicted is a set of (id, mode), first_alarms {(id, mode): ts} for methods that know when they alarmed.
+    '''
+    modes = sorted(set(m for _, m in truth) | set(m for _, m in predicted))
+    rows = []
+
+    for mode in modes:
+        actual = set(k for k in truth if k[1] == mode)
+        found = set(k for k in predicted if k[1] == mode)
+        tp = actual & found
+
+        delays = []
+        if first_alarms is not None:
+            delays = [(first_alarms[k] - truth[k]) / pd.Timedelta(hours=1) for k in tp]
+
+        rows.append({
+            'mode': mode,
+            'tp': len(tp),
+            'fp': len(found - actual),
+            'fn': len(actual - found),
+            'precision': len(tp) / len(found) if found else None,
+            'recall': len(tp) / len(actual) if actual else None,
+            'median_delay_hours': float(np.median(delays)) if delays else None,
+            'max_delay_hours': float(np.max(delays)) if delays else None
+        })
+
+    return rows
+
+
+def evaluate(truth, rules, detector_tables):
+    '''
+    Scores the rules and every detector. Returns {method: score rows}.
+    '''
+    results = {'rules': score(truth, set((i, mode) for mode, ids in rules.items() for i in ids))}
+
+    for name, table in detector_tables.items():
+        predicted = set()
+        first_alarms = {}
+
+        for device_id, row in table.iterrows():
+            key = (int(device_id), METRIC_MODES.get(row['metric'], 'other:' + row['metric']))
+            predicted.add(key)
+            first_alarms[key] = min(first_alarms.get(key, row['first_alarm']), row['first_alarm'])
+
+        results[name] = score(truth, predicted, first_alarms)
+
+    return results
+
+
+def merge_findings(parts, end=None):
+    '''
+    Combines every block's findings. Devices whose last reading is more than a day before end
+    (default the last reading of any device) count as stopped reporting, the battery failure.
+    '''
+    rules = defaultdict(set)
+    tables = defaultdict(list)
+    last_seen = []
+
+    for (block_rules, block_last_seen), block_tables in parts:
+        for mode, ids in block_rules.items():
+            rules[mode] |= ids
+        for name, table in block_tables.items():
+            tables[name].append(table)
+        last_seen.append(block_last_seen)
+
+    last_seen = pd.concat(last_seen)
+    end = last_seen.max() if end is None else pd.Timestamp(end)
+    rules['battery'] = set(last_seen.index[last_seen < end - pd.Timedelta(days=1)])
+
+    return rules, {name: pd.concat(frames) for name, frames in tables.items()}
+
+
+def manifest_path(data_dir):
+    '''
+    Where a fleet's failure_manifest.csv goes: beside its device directory, like data_generator.py writes it,
+    so the directory only ever has device files in it.
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(data_dir)), 'failure_manifest.csv')
+
+
+def run_generated(num_devices, days, seed, fmt, block_size, workers, keep_dir=None):
+    '''
+    Generates, injects, writes, loads and detects a fleet of num_devices, block_size devices at a time.
+    With keep_dir the fleet is left there, and its manifest beside it (see manifest_path).
+    '''
+    timer = StageTimer()
+    interval = {'start': dt(2020, 1, 1), 'end': dt(2020, 1, 1) + timedelta(days=days)}
+
+    attrs, failures = make_fleet(num_devices, seed)
+
+    # A temp fleet gets a directory of its own to hold the manifest beside the device directory
+    temp_dir = None if keep_dir else tempfile.mkdtemp(prefix='benchmark_')
+    data_dir = keep_dir or os.path.join(temp_dir, 'device_data')
+    os.makedirs(data_dir, exist_ok=True)
+    manifest = []
+    parts = []
+
+    try:
+        for i in range(0, num_devices, block_size):
+            block = attrs[i:i + block_size]
+
+            generated = timer.run('generate', generate_block, block, interval, seed)
+            frames, records = timer.run('inject', inject_block, generated, failures)
+            del generated
+
+            paths = timer.run('write', write_block, frames, interval, data_dir, fmt)
+            del frames
+
+            df = timer.run('load', load_devices, paths)
+            parts.append(timer.run('detect', detect_block, df, workers))
+            del df
+
+            manifest.extend(records)
+            print(f'{min(i + block_size, num_devices)}/{num_devices} devices done')
+
+        manifest_file = manifest_path(data_dir)
+        write_manifest(manifest_file, manifest)
+        truth = read_truth(manifest_file)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    rules, tables = merge_findings(parts, interval['end'])
+
+    return {'devices': num_devices, 'days': days, 'format': fmt, 'stages': timer.results(), 'scores': evaluate(truth, rules, tables)}
+
+
+def run_existing(data_dir, manifest_file, block_size, workers):
+    '''
+    Loads and detects an already generated fleet (data_generator.py output), scoring it against its manifest.
+    '''
+    timer = StageTimer()
+    paths = [os.path.join(data_dir, f) for f in sorted(os.listdir(data_dir))]
+    parts = []
+
+    for i in range(0, len(paths), block_size):
+        df = timer.run('load', load_devices, paths[i:i + block_size])
+        parts.append(timer.run('detect', detect_block, df, workers))
+        del df
+
+    rules, tables = merge_findings(parts)
+
+    return {'devices': len(paths), 'data_dir': data_dir, 'stages': timer.results(), 'scores': evaluate(read_truth(manifest_file), rules, tables)}
+
+
+def print_result(result):
+    print(f"\n=== {result['devices']} devices ===")
+    for stage, r in result['stages'].items():
+        print(f"{stage:>10}: {r['seconds']:8.2f}s  peak {r['peak_mb']:9.1f}MB")
+
+    for method, rows in result['scores'].items():
+        print(f'\n{method}')
+        print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark detection accuracy and performance against injected failures')
+    parser.add_argument('--devices', type=int, nargs='+', default=[150], help='fleet sizes to run, e.g. 150 1000 10000')
+    parser.add_argument('--days', type=int, default=180, help='days of hourly readings per device')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', default='parquet', choices=['csv', 'parquet', 'arrow'])
+    parser.add_argument('--block-size', type=int, default=500, help='devices generated/loaded/detected at a time')
+    parser.add_argument('--workers', type=int, default=4, help='DetectionEngine threads')
+    parser.add_argument('--keep-dir', default=None, help='keep the generated fleet here instead of a temp dir')
+    parser.add_argument('--data-dir', default=None, help='benchmark an existing fleet instead of generating one')
+    parser.add_argument('--manifest', default=None, help='failure_manifest.csv for --data-dir')
+    parser.add_argument('--output', default=None, help='write results as JSON')
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    results = []
+
+    if args.data_dir:
+        results.append(run_existing(args.data_dir, args.manifest or manifest_path(args.data_dir), args.block_size, args.workers))
+    else:
+        for n in args.devices:
+            results.append(run_generated(n, args.days, args.seed, args.format, args.block_size, args.workers, args.keep_dir))
+
+    for result in results:
+        print_result(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
@@ -0,0 +1,193 @@
+'''
+Small in-process metrics: counters, gauges and histograms with labels, exported as Prometheus text or JSON.
+
+Shared by generate_data/ and view_data/, which import it as metrics through the small metrics.py in each.
+
+    QUERY_SECONDS = histogram('query_seconds', 'Time per query')
+
+    with QUERY_SECONDS.time(op='fetch_rows'):
+        ...
+
+    REGISTRY.to_prometheus()
+'''
+import json
+import time
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Seconds, from a millisecond to a minute
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Counter():
+    kind = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            self.values[label_key(labels)] += amount
+
+    def get(self, **labels):
+        return self.values.get(label_key(labels), 0)
+
+    def prometheus_lines(self):
+        with self.lock:
+            return [f'{self.name}{format_labels(key)} {value}' for key, value in self.values.items()]
+
+    def to_dict(self):
+        with self.lock:
+            return [{'labels': dict(key), 'value': value} for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    '''
+    A value that goes up and down. Pass fn to read the value when exported instead of setting it.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help='', fn=None):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+    def prometheus_lines(self):
+        if self.fn is not None:
+            self.set(self.fn())
+
+        return super().prometheus_lines()
+
+    def to_dict(self):
+        if self.fn is not None:
+            self.set(self.fn())
+
+        return super().to_dict()
+
+
+class Histogram():
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.sums = defaultdict(float)
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+
+        with self.lock:
+            if key not in self.counts:
+                self.counts[key] = [0] * (len(self.buckets) + 1)
+
+            self.counts[key][bisect_left(self.buckets, value)] += 1
+            self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def prometheus_lines(self):
+        lines = []
+        with self.lock:
+            for key, counts in self.counts.items():
+                cumulative = 0
+                for le, count in zip(list(self.buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{format_labels(key, [("le", le)])} {cumulative}')
+
+                lines.append(f'{self.name}_sum{format_labels(key)} {self.sums[key]}')
+                lines.append(f'{self.name}_count{format_labels(key)} {cumulative}')
+
+        return lines
+
+    def to_dict(self):
+        with self.lock:
+            return [{
+                'labels': dict(key),
+                'count': sum(counts),
+                'sum': self.sums[key],
+                'mean': self.sums[key] / max(sum(counts), 1),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], counts))
+            } for key, counts in self.counts.items()]
+
+
+class Registry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get(self, cls, name, help='', **kwargs):
+        '''
+        The metric called name, created the first time it's asked for.
+        '''
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, **kwargs)
+
+            return self.metrics[name]
+
+    def to_prometheus(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.prometheus_lines())
+
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        return {m.name: {'type': m.kind, 'help': m.help, 'samples': m.to_dict()} for m in list(self.metrics.values())}
+
+    def write(self, path):
+        '''
+        Writes every metric to path, as JSON if it ends in .json and Prometheus text otherwise
+        (a .prom file can be picked up by node_exporter's textfile collector).
+        '''
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.to_dict(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help=''):
+    return REGISTRY.get(Counter, name, help)
+
+
+def gauge(name, help='', fn=None):
+    return REGISTRY.get(Gauge, name, help, fn=fn)
+
+
+def histogram(name, help='', buckets=DEFAULT_BUCKETS):
+    return REGISTRY.get(Histogram, name, help, buckets=buckets)
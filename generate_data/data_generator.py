@@ -1,16 +1,34 @@
 import os
+import argparse
+import time
 from datetime import datetime as dt
-from datetime import timedelta
 import random
 import csv
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+import numpy as np
 import pandas as pd
 from kafka import KafkaProducer
+from writers import get_writer, writer_for
+from kafka_publisher import make_producer, publish_fleet
+from failures import assign_failures, device_stages, run_pipeline, write_manifest, write_failed_files
+from metrics import REGISTRY, histogram, counter
 
+STAGE_SECONDS = histogram('generator_stage_seconds', 'Time per device file in each generation stage (generate, failures, write)')
+ROWS_WRITTEN = counter('generator_rows_total', 'Rows written to device files, by format')
+FILES_WRITTEN = counter('generator_files_total', 'Device files written, by format')
+# Mixed into a device's seed for its attributes, so they don't come from the same stream as its readings
+ATTRIBUTE_STREAM = 1
 
-def generate_device_attributes():
+FAILURE_STAGES = counter('generator_failure_stages_total', 'Failure stages applied to devices, by stage')
+
+
+def generate_device_attributes(rng=random):
     '''
     This will randomly generate attributes for an IoT devices.
     These are to be used to generate the rest of the data.
+    rng is anything with choice and uniform: the random module, or a numpy Generator (see device_attributes).
 
     Generated attributes:
         randomly select between indoor/outdoor sensor
@@ -19,7 +37,7 @@ def generate_device_attributes():
     attrs = {}
 
     location_types = ['indoor', 'outdoor']
-    location_type = random.choice(location_types)
+    location_type = str(rng.choice(location_types))
 
     attrs['location_type'] = location_type
 
@@ -28,18 +46,18 @@ def generate_device_attributes():
         'outdoor': ['direct', 'ambient']
     }
 
-    light_type = random.choice(light_types[location_type])
+    light_type = str(rng.choice(light_types[location_type]))
 
     attrs['light_type'] = light_type
 
-    attrs['base_temp'] = generate_basetemp(location_type, light_type)
+    attrs['base_temp'] = generate_basetemp(location_type, light_type, rng)
 
-    attrs['base_signal'] = generate_base_signal_strength()
+    attrs['base_signal'] = generate_base_signal_strength(rng)
 
     return attrs
 
 
-def generate_basetemp(location, light):
+def generate_basetemp(location, light, rng=random):
     '''
     generates a base temp value for a sensor, to then be modified to fill a time series of temps.
 
@@ -56,21 +74,21 @@ def generate_basetemp(location, light):
         if light == 'direct':
             mult = 1.25
         
-        mult += random.uniform(-0.2, 0.2)
+        mult += float(rng.uniform(-0.2, 0.2))
         
         base_temp = base_temp * mult
 
     return base_temp
 
 
-def generate_base_signal_strength():
+def generate_base_signal_strength(rng=random):
     '''
     Devices will get a "base" strength to essentially model distance to router
         Acceptable connection strengths should range from -50 dBm (excellent) to -67 dBm (minimum for smooth and reliable data traffic)
             https://eyenetworks.no/en/wifi-signal-strength/
     Then, they'll just be allowed to fluctate +/- 10%
     '''
-    return random.uniform(-50, -67)
+    return float(rng.uniform(-67, -50))
 
 
 def generate_lumens(location, light, hour):
@@ -250,6 +268,224 @@ def generate_battery_level(prev_charge):
     return new_charge
 
 
+def lumens_hour_table(location, light):
+    '''
+    24 entry lookup of lumens by hour of day for a device.
+
+    Built straight from generate_lumens so the vectorized path can't drift from the per-hour one.
+    '''
+    return np.array([generate_lumens(location, light, hour) for hour in range(24)], dtype=float)
+
+
+def temperature_hour_table(location, base_temp):
+    '''
+    24 entry lookup of temperature by hour of day for a device, built from generate_temperature.
+    '''
+    return np.array([generate_temperature(location, base_temp, hour) for hour in range(24)], dtype=float)
+
+
+@lru_cache(maxsize=8)
+def battery_levels(num_hours, start_charge=1):
+    '''
+    Runs the generate_battery_level recurrence over num_hours.
+
+    The charge/discharge cycle has no randomness and every device starts full,
+    so the scan is done once per series length and shared by every device.
+    The returned array is read only since it's shared.
+    '''
+    levels = np.empty(num_hours, dtype=float)
+    charge = start_charge
+    for i in range(num_hours):
+        charge = generate_battery_level(charge)
+        levels[i] = charge
+
+    levels.flags.writeable = False
+
+    return levels
+
+
+def hourly_timestamps(start, end):
+    '''
+    Every hour from start to end (inclusive), same as stepping a datetime by timedelta(hours=1).
+    '''
+    return np.arange(np.datetime64(start, 'h'), np.datetime64(end, 'h') + 1, dtype='datetime64[h]')
+
+
+def generate_device_series(device_attr, timestamps, rng):
+    '''
+    Generates a whole device's series at once as numpy arrays.
+
+    Does the same thing as calling generate_lumens, generate_temperature, generate_cpu_temperature,
+    generate_signal_strength and generate_battery_level for every hour, but with hour of day
+    lookup tables and one random draw per metric instead of one per row.
+
+    rng is a numpy Generator, so passing a seeded one makes the output reproducible.
+    Returns a dict of column name -> array, in the same column order as the CSVs.
+    '''
+    num_hours = timestamps.shape[0]
+    hours = timestamps.astype(np.int64) % 24
+
+    lumens = lumens_hour_table(device_attr['location_type'], device_attr['light_type'])
+    temp = temperature_hour_table(device_attr['location_type'], device_attr['base_temp'])
+
+    return {
+        'id': np.full(num_hours, device_attr['id']),
+        'ts': timestamps,
+        'lumens': lumens[hours],
+        'temp': temp[hours],
+        'cpu_temp': rng.uniform(104, 122, num_hours),
+        'signal': device_attr['base_signal'] * rng.uniform(0.9, 1.1, num_hours),
+        'charge': battery_levels(num_hours).copy()
+    }
+
+
+def generate_fleet_series(device_attrs, timestamps, rng):
+    '''
+    Same as generate_device_series, but for a list of devices in one go.
+
+    Every array is 2d, (devices, hours). Memory is devices * hours * 8 bytes per column,
+    so for big fleets call this on chunks of devices rather than all at once.
+    '''
+    num_devices = len(device_attrs)
+    num_hours = timestamps.shape[0]
+    hours = timestamps.astype(np.int64) % 24
+
+    lumens = np.stack([lumens_hour_table(a['location_type'], a['light_type']) for a in device_attrs])
+    temp = np.stack([temperature_hour_table(a['location_type'], a['base_temp']) for a in device_attrs])
+    ids = np.array([a['id'] for a in device_attrs])
+    base_signal = np.array([a['base_signal'] for a in device_attrs], dtype=float)
+
+    return {
+        'id': np.repeat(ids[:, None], num_hours, axis=1),
+        'ts': np.broadcast_to(timestamps, (num_devices, num_hours)),
+        'lumens': lumens[:, hours],
+        'temp': temp[:, hours],
+        'cpu_temp': rng.uniform(104, 122, (num_devices, num_hours)),
+        'signal': base_signal[:, None] * rng.uniform(0.9, 1.1, (num_devices, num_hours)),
+        'charge': np.broadcast_to(battery_levels(num_hours), (num_devices, num_hours))
+    }
+
+
+def series_to_frame(series):
+    '''
+    Turns a single device's series into a DataFrame, ts as datetime64 and everything else float.
+    '''
+    df = pd.DataFrame(series)
+    df['ts'] = df['ts'].astype('datetime64[ns]')
+
+    return df
+
+
+def device_rng(seed, device_id):
+    '''
+    Independent random stream for one device, derived from the master seed plus the device id.
+
+    Because a device's stream doesn't depend on what else was generated before it,
+    the output is the same no matter how devices are split across workers.
+    '''
+    return np.random.default_rng(np.random.SeedSequence([seed, int(device_id)]))
+
+
+def device_attributes(seed, device_id):
+    '''
+    One device's attributes, drawn from its own stream of the master seed (separate from device_rng's),
+    so the same seed always makes the same fleet.
+    '''
+    attr = generate_device_attributes(np.random.default_rng(np.random.SeedSequence([seed, int(device_id), ATTRIBUTE_STREAM])))
+    attr['id'] = device_id
+
+    return attr
+
+
+def device_stem(device_attr, interval):
+    '''
+    Name of a device's data, without the extension the writer adds.
+    '''
+    return f'''device_id_{device_attr['id']}_{interval['start'].strftime('%Y%m%d')}-{interval['end'].strftime('%Y%m%d')}'''
+
+
+def generate_device_file(device_attr, interval, seed, fmt='csv', stages=None):
+    '''
+    Generates the series for one device, runs it through the failure stages (see failures.py) and writes it once.
+
+    Returns (pid, rows written, {stage: seconds taken}, manifest records) so the caller can work out
+    throughput per worker and collect the ground truth of what failures were applied.
+    Timings are returned rather than recorded here, since this usually runs in a worker process.
+    '''
+    timings = {}
+
+    start = time.perf_counter()
+    rng = device_rng(seed, device_attr['id'])
+    timestamps = hourly_timestamps(interval['start'], interval['end'])
+    series = generate_device_series(device_attr, timestamps, rng)
+    timings['generate'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df, manifest = run_pipeline(series_to_frame(series), stages or [], rng)
+    timings['failures'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    writer = get_writer(fmt)
+    path = writer.path(os.path.join(os.getcwd(), 'device_data'), device_stem(device_attr, interval))
+    writer.write(path, df)
+    timings['write'] = time.perf_counter() - start
+
+    for record in manifest:
+        record['id'] = device_attr['id']
+        record['file'] = os.path.basename(path)
+
+    return os.getpid(), df.shape[0], timings, manifest
+
+
+def generate_fleet(device_attrs, interval, seed, workers=1, fmt='csv', stages=None):
+    '''
+    Generates a file per device, split across a process pool when workers > 1.
+
+    Every device is seeded from (seed, device id), so the files are byte identical whatever the worker count.
+    fmt is any of the formats in writers.FORMATS.
+    stages is a dict of device id -> failure stages to apply to that device before writing.
+    Prints rows/sec for each worker, and for the whole run, when done, and records every device's
+    stage timings and counts in the generator_* metrics.
+
+    Returns the failure manifest for the whole fleet.
+    '''
+    start = time.perf_counter()
+    stages = stages or {}
+    device_stage_list = [stages.get(a['id']) for a in device_attrs]
+
+    if workers == 1:
+        results = list(map(generate_device_file, device_attrs, repeat(interval), repeat(seed), repeat(fmt), device_stage_list))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(device_attrs) // (4 * (workers or os.cpu_count())))
+            results = list(pool.map(generate_device_file, device_attrs, repeat(interval), repeat(seed), repeat(fmt), device_stage_list, chunksize=chunksize))
+
+    per_worker = {}
+    manifest = []
+    for pid, rows, timings, records in results:
+        manifest.extend(records)
+        worker = per_worker.setdefault(pid, {'devices': 0, 'rows': 0, 'seconds': 0})
+        worker['devices'] += 1
+        worker['rows'] += rows
+        worker['seconds'] += sum(timings.values())
+
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        for record in records:
+            FAILURE_STAGES.inc(stage=record['failure'])
+        ROWS_WRITTEN.inc(rows, format=fmt)
+        FILES_WRITTEN.inc(format=fmt)
+
+    for pid, worker in sorted(per_worker.items()):
+        print(f'''Worker {pid}: {worker['devices']} devices, {worker['rows']} rows, {worker['rows'] / worker['seconds']:,.0f} rows/sec''')
+
+    total_rows = sum(w['rows'] for w in per_worker.values())
+    total_seconds = time.perf_counter() - start
+    print(f'Generated {total_rows} rows for {len(device_attrs)} devices in {total_seconds:.1f}s ({total_rows / total_seconds:,.0f} rows/sec)')
+
+    return manifest
+
+
 def write_json_list(filename, data):
     '''
     Takes a list of JSONs and writes them to a CSV.
@@ -266,6 +502,18 @@ def write_json_list(filename, data):
         for row in data:
             writer.writerow(row)
 
+
+def write_series(stem, series, fmt='csv'):
+    '''
+    Writes a device series (see generate_device_series) to device_data in the given format.
+
+    csv matches the files write_json_list makes, parquet/arrow are partitioned by month under a directory per device.
+    '''
+    writer = get_writer(fmt)
+
+    writer.write(writer.path(os.path.join(os.getcwd(), 'device_data'), stem), series_to_frame(series))
+
+
 def apply_missing_rows(filename):
     '''
     Remove an arbitrary-ish number of records from every file.
@@ -279,7 +527,9 @@ def apply_missing_rows(filename):
     '''
     print(f'Removing arbitrary rows for {filename}')
 
-    df = pd.read_csv(os.path.join(os.getcwd(), 'device_data', filename))
+    path = os.path.join(os.getcwd(), 'device_data', filename)
+    writer = writer_for(path)
+    df = writer.read(path)
 
     rowcount = df.shape[0]
 
@@ -289,9 +539,9 @@ def apply_missing_rows(filename):
 
     indices_remove = random.choices(range(0, rowcount), k=num_remove)
 
-    df = df.drop(indices_remove)
+    df = df.drop(indices_remove).reset_index(drop=True)
 
-    df.to_csv(os.path.join(os.getcwd(), 'device_data', filename), mode='w')
+    writer.write(path, df)
     
 
 def apply_battery_failure(filename):
@@ -302,7 +552,9 @@ def apply_battery_failure(filename):
     '''
     print('Applying battery failures')
 
-    df = pd.read_csv(os.path.join(os.getcwd(), 'device_data', filename))
+    path = os.path.join(os.getcwd(), 'device_data', filename)
+    writer = writer_for(path)
+    df = writer.read(path)
 
     rowcount = df.shape[0]
 
@@ -314,7 +566,7 @@ def apply_battery_failure(filename):
     #df.loc[failure_start:, 'charge'] = 0
     df = df.loc[:failure_start]
     
-    df.to_csv(os.path.join(os.getcwd(), 'device_data', filename), mode='w')
+    writer.write(path, df)
 
 def apply_signal_failure(filename):
     '''
@@ -325,7 +577,9 @@ def apply_signal_failure(filename):
     '''
     print('Applying signal failures')
 
-    df = pd.read_csv(os.path.join(os.getcwd(), 'device_data', filename))
+    path = os.path.join(os.getcwd(), 'device_data', filename)
+    writer = writer_for(path)
+    df = writer.read(path)
 
     rowcount = df.shape[0]
 
@@ -338,7 +592,7 @@ def apply_signal_failure(filename):
 
     df.loc[failure_start:, 'signal'] *= signal_mult
     
-    df.to_csv(os.path.join(os.getcwd(), 'device_data', filename), mode='w')
+    writer.write(path, df)
     
 
 def apply_cooling_failure(filename):
@@ -349,7 +603,9 @@ def apply_cooling_failure(filename):
     '''
     print('Applying cooling failures')
 
-    df = pd.read_csv(os.path.join(os.getcwd(), 'device_data', filename))
+    path = os.path.join(os.getcwd(), 'device_data', filename)
+    writer = writer_for(path)
+    df = writer.read(path)
 
     rowcount = df.shape[0]
 
@@ -362,7 +618,7 @@ def apply_cooling_failure(filename):
 
     df.loc[failure_start:, 'cpu_temp'] += cooling_add
     
-    df.to_csv(os.path.join(os.getcwd(), 'device_data', filename), mode='w')
+    writer.write(path, df)
 
 
 def apply_light_failure(filename):
@@ -373,7 +629,9 @@ def apply_light_failure(filename):
     '''
     print('Applying light failures')
 
-    df = pd.read_csv(os.path.join(os.getcwd(), 'device_data', filename))
+    path = os.path.join(os.getcwd(), 'device_data', filename)
+    writer = writer_for(path)
+    df = writer.read(path)
 
     rowcount = df.shape[0]
 
@@ -386,12 +644,14 @@ def apply_light_failure(filename):
 
     df.loc[failure_start:, 'lumens'] *= light_mult
     
-    df.to_csv(os.path.join(os.getcwd(), 'device_data', filename), mode='w')
+    writer.write(path, df)
 
 
 def publish_csv_to_kafka(data_dir):
     '''
-    Reads CSVs of generated data and reports to Kafka one row at a time.
+    Reads generated data (any format in writers.FORMATS) and reports to Kafka one row at a time.
+
+    Messages are the same str() of a dict of strings the CSV version always sent.
     '''
     data_files = os.listdir(data_dir)
     
@@ -400,87 +660,39 @@ def publish_csv_to_kafka(data_dir):
     for filename in data_files:
         print(f'Reporting to Kafka for {filename}')
 
-        with open(os.path.join(data_dir, filename), 'r') as f:
-            reader = csv.DictReader(f)
+        path = os.path.join(data_dir, filename)
+
+        for df in writer_for(path).iter_frames(path):
+            df['ts'] = df['ts'].dt.strftime('%Y-%m-%d %H:%M:%S')
 
-            for row in reader:
+            for row in df.astype(str).to_dict('records'):
                 producer.send('raw-sensor-data', value=str(row).encode('utf-8'))
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate IoT device data')
+    parser.add_argument('--seed', type=int, default=None, help='master seed, every device stream is derived from it')
+    parser.add_argument('--workers', type=int, default=1, help='processes to generate devices with (0 = one per core)')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet', 'arrow'], help='output format for device data')
+    parser.add_argument('--metrics-file', default=None, help='write generation and publish metrics here when done (.prom or .json)')
+    args = parser.parse_args()
 
-    # Let's generate 250 devices w/ IDs
-    if True: # Just change to True to run again... only need to run once but don't want to remove the code.
-        attrs = []
-        for i in range(0, 150):
-            attr = generate_device_attributes()
-            attr['id'] = i
+    seed = args.seed
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        print(f'No seed given, using {seed}')
 
-            attrs.append(attr)
-
-        write_json_list('device_attributes.csv', attrs)
-
-
-    # Now I need to generate data for each device
-    if True:
-        with open('device_attributes.csv', 'r') as f:
-            reader = csv.DictReader(f, quoting=csv.QUOTE_NONNUMERIC)
-            
-            interval = {
-                'start': dt.strptime('20200101', '%Y%m%d'),
-                'end': dt.strptime('20221231', '%Y%m%d')
-            }
-            delta = timedelta(hours=1)
-
-            for device_attr in reader:
-                date = interval['start']
-                all_data = []
-
-                print(device_attr)
-                
-                charge = 1
-                
-                while date <= interval['end']:
-                    data = {}
-
-                    # id
-                    data['id'] = device_attr['id']
-
-                    # timestamp
-                    data['ts'] = date.strftime('%Y-%m-%d %H:%M:%S')
-
-                    # light
-                    lumens = generate_lumens(device_attr['location_type'], device_attr['light_type'], date.hour)
-                    data['lumens'] = lumens
-
-                    # temp
-                    temp = generate_temperature(device_attr['location_type'], device_attr['base_temp'], date.hour)
-                    data['temp'] = temp
-
-                    # cpu
-                    cpu_temp = generate_cpu_temperature()
-                    data['cpu_temp'] = cpu_temp
-
-                    # signal
-                    signal = generate_signal_strength(device_attr['base_signal'])
-                    data['signal'] = signal
-
-                    # battery
-                    charge = generate_battery_level(charge)
-                    data['charge'] = charge
-
-                    all_data.append(data)
-                    date += delta
-
-                fn = f'''device_data/device_id_{device_attr['id']}_{interval['start'].strftime('%Y%m%d')}-{interval['end'].strftime('%Y%m%d')}.csv'''
-
-                write_json_list(fn, all_data)
+    # Let's generate 150 devices w/ IDs, from the seed so the same seed makes the same fleet
+    attrs = [device_attributes(seed, i) for i in range(0, 150)]
+    write_json_list('device_attributes.csv', attrs)
 
     '''
-    Now let's apply some "failures" to some devices.
+    Now I need to generate data for each device, with some "failures" applied to some devices.
     There will be 4 failure modes: Battery failing, wifi receptor failing, cooling device failing, or light sensor failing.
 
     The methodology:
+        - Every device has 1-5% of its records removed for realism
+
         - 0 Battery level / battery failing
                 0. Pick X amount of devices to apply this to
                 1. Pick a random row number in the CSV
@@ -507,57 +719,37 @@ if __name__ == '__main__':
                 # Holoviz - vizualization suite of many libraries (panel: dashboards, interactive, PowerBIish)
     
     *** Do NOT apply more than 1 failure to a device ***
+
+    The failures are applied in memory (failures.py) before each device is written, instead of
+    re-reading and re-writing every file per failure mode. The apply_*_failure functions above still
+    work on files that have already been written.
     '''
     if True:
-        # Get list of files
-        files = os.listdir(path=os.path.join(os.getcwd(), 'device_data'))
-        failed_files = ['battery']
-
-        # Remove some records from every file for realism
-        for f in files:
-            apply_missing_rows(f)
-
-        # Pick 5 for scenario 0 and remove from list
-        battery_failures = random.choices(files, k=5)        
-        files = [x for x in files if x not in battery_failures]
-
-        for f in battery_failures:
-            failed_files.append(f)
-            apply_battery_failure(f)
-
-
-        # Pick 5 for scenario 1 and remove from list
-        signal_failures = random.choices(files, k=5)        
-        files = [x for x in files if x not in signal_failures]
-        failed_files.append('signal')
-
-        for f in signal_failures:
-            failed_files.append(f)
-            apply_signal_failure(f)
-
-        # Pick 5 for scenario 2 and remove from list
-        cooling_failures = random.choices(files, k=5)        
-        files = [x for x in files if x not in cooling_failures]
-        failed_files.append('cooling')
+        with open('device_attributes.csv', 'r') as f:
+            reader = csv.DictReader(f, quoting=csv.QUOTE_NONNUMERIC)
+            device_attrs = list(reader)
 
-        for f in cooling_failures:
-            failed_files.append(f)
-            apply_cooling_failure(f)
+        interval = {
+            'start': dt.strptime('20200101', '%Y%m%d'),
+            'end': dt.strptime('20221231', '%Y%m%d')
+        }
 
-        # Pick 5 for scenario 3 and remove from list
-        light_failures = random.choices(files, k=5)        
-        files = [x for x in files if x not in light_failures]
-        failed_files.append('light')
+        device_ids = [a['id'] for a in device_attrs]
+        failures = assign_failures(device_ids, np.random.default_rng(np.random.SeedSequence([seed])))
+        stages = {device_id: device_stages(failures.get(device_id)) for device_id in device_ids}
 
-        for f in light_failures:
-            failed_files.append(f)
-            apply_light_failure(f)
+        manifest = generate_fleet(device_attrs, interval, seed, workers=args.workers or None, fmt=args.format, stages=stages)
 
-        # Write which files had "failures" applied for future ref
-        with open('files_applied_failures.txt', 'w') as f:
-            for ele in failed_files:
-                f.write(ele + '\n')
+        # Write which files had "failures" applied for future ref, plus the full ground truth
+        write_failed_files('files_applied_failures.txt', manifest)
+        write_manifest('failure_manifest.csv', manifest)
 
-    # Now iterate through files and report to kafka row by row
+    # Now iterate through files and report to kafka, batched and keyed by device (see kafka_publisher.py)
+    # repr keeps the message format publish_csv_to_kafka has always sent
     if True:
-        publish_csv_to_kafka(os.path.join(os.getcwd(), 'device_data'))
+        producer = make_producer()
+        publish_fleet(os.path.join(os.getcwd(), 'device_data'), producer, serializer='repr')
+        producer.close()
+
+    if args.metrics_file:
+        REGISTRY.write(args.metrics_file)
@@ -0,0 +1,201 @@
+'''
+In-memory failure injection.
+
+Same failure modes as the apply_*_failure functions in data_generator, but applied to a device's
+DataFrame before it's ever written, so each device file is only written once.
+
+A device's failures are a list of stages, each a dict with the stage name and its params:
+    [
+        {'name': 'missing_rows', 'params': {'perc': (1, 5)}},
+        {'name': 'signal', 'params': {'mult': (0.4, 0.7), 'start': {'dist': 'uniform', 'min': 100}}}
+    ]
+
+Every stage returns a record of exactly what it did, and those records make up the failure manifest.
+'''
+import csv
+
+
+def draw_start(rng, rowcount, start=None):
+    '''
+    Picks the row a failure starts at.
+
+    start is a dict describing the distribution:
+        dist: 'uniform' (default) or 'triangular'
+        min: first row allowed, default 100 to ensure some "functioning" rows
+        max: last row allowed, default the second to last row
+        mode: for triangular, where in [0, 1] of the min-max range failures are most likely
+    '''
+    start = start or {}
+    low = start.get('min', 100)
+    high = start.get('max', rowcount - 1)
+
+    if start.get('dist', 'uniform') == 'triangular':
+        mode = low + start.get('mode', 0.5) * (high - low)
+        return int(rng.triangular(low, mode, high))
+
+    return int(rng.integers(low, high))
+
+
+def missing_rows(df, rng, perc=(1, 5)):
+    '''
+    Remove an arbitrary-ish number of records, between perc[0]% and perc[1]% of them.
+
+    This is just because in real life, you don't get 100% of the data.
+    '''
+    rowcount = df.shape[0]
+
+    num_remove = round(rowcount * rng.uniform(*perc) / 100)
+    indices_remove = rng.choice(rowcount, size=num_remove, replace=False)
+
+    df = df.drop(df.index[indices_remove]).reset_index(drop=True)
+
+    return df, {'rows_removed': num_remove}
+
+
+def battery_failure(df, rng, start=None):
+    '''
+    Battery dies: every row after the failure start is removed.
+    '''
+    failure_start = draw_start(rng, df.shape[0], start)
+
+    record = {'failure_start': failure_start, 'failure_ts': df['ts'].iloc[failure_start], 'rows_removed': df.shape[0] - failure_start - 1}
+
+    return df.iloc[:failure_start + 1], record
+
+
+def signal_failure(df, rng, mult=(0.4, 0.7), start=None):
+    '''
+    Wifi receptor failing: signal strength after the failure start is multiplied by a value in mult.
+    '''
+    return scale_after_start(df, rng, 'signal', rng.uniform(*mult), start)
+
+
+def cooling_failure(df, rng, add=(15, 30), start=None):
+    '''
+    Cooling device failing: a value in add is added to cpu_temp after the failure start.
+    '''
+    failure_start = draw_start(rng, df.shape[0], start)
+    cooling_add = rng.uniform(*add)
+
+    df = df.copy()
+    df.iloc[failure_start:, df.columns.get_loc('cpu_temp')] += cooling_add
+
+    return df, {'failure_start': failure_start, 'failure_ts': df['ts'].iloc[failure_start], 'amount': cooling_add}
+
+
+def light_failure(df, rng, mult=(2, 3), start=None):
+    '''
+    Light sensor failing: lumens after the failure start are multiplied by a value in mult.
+    '''
+    return scale_after_start(df, rng, 'lumens', rng.uniform(*mult), start)
+
+
+def scale_after_start(df, rng, column, mult, start):
+    failure_start = draw_start(rng, df.shape[0], start)
+
+    df = df.copy()
+    df.iloc[failure_start:, df.columns.get_loc(column)] *= mult
+
+    return df, {'failure_start': failure_start, 'failure_ts': df['ts'].iloc[failure_start], 'amount': mult}
+
+
+STAGES = {
+    'missing_rows': missing_rows,
+    'battery': battery_failure,
+    'signal': signal_failure,
+    'cooling': cooling_failure,
+    'light': light_failure
+}
+
+# Every device gets these
+BASE_STAGES = [
+    {'name': 'missing_rows', 'params': {'perc': (1, 5)}}
+]
+
+# How many devices get each failure mode, and the stage used for it
+FAILURE_MODES = {
+    'battery': {'count': 5, 'stage': {'name': 'battery', 'params': {}}},
+    'signal': {'count': 5, 'stage': {'name': 'signal', 'params': {'mult': (0.4, 0.7)}}},
+    'cooling': {'count': 5, 'stage': {'name': 'cooling', 'params': {'add': (15, 30)}}},
+    'light': {'count': 5, 'stage': {'name': 'light', 'params': {'mult': (2, 3)}}}
+}
+
+
+def run_pipeline(df, stages, rng):
+    '''
+    Applies each stage in order to an in-memory device DataFrame.
+
+    Returns the new DataFrame and the manifest: one record per stage saying what was done.
+    '''
+    manifest = []
+
+    for stage in stages:
+        df, record = STAGES[stage['name']](df, rng, **stage.get('params', {}))
+
+        record['failure'] = stage['name']
+        manifest.append(record)
+
+    return df, manifest
+
+
+def assign_failures(device_ids, rng, failure_modes=FAILURE_MODES):
+    '''
+    Picks which devices get which failure mode.
+
+    Devices are drawn without replacement, so no device gets more than 1 failure. A fleet with fewer devices
+    than the counts add up to runs out part way: the modes are filled in order with the devices there are.
+    Returns a dict of device id -> failure mode name.
+    '''
+    total = sum(mode['count'] for mode in failure_modes.values())
+    chosen = rng.choice(len(device_ids), size=min(total, len(device_ids)), replace=False)
+
+    assigned = {}
+    i = 0
+    for name, mode in failure_modes.items():
+        for idx in chosen[i:i + mode['count']]:
+            assigned[device_ids[idx]] = name
+        i += mode['count']
+
+    if total > len(device_ids):
+        print(f'Only {len(device_ids)} devices for {total} failures, {total - len(device_ids)} not assigned')
+
+    return assigned
+
+
+def device_stages(failure_mode=None, failure_modes=FAILURE_MODES, base_stages=BASE_STAGES):
+    '''
+    The full list of stages for a device with the given failure mode (or None for no failure).
+    '''
+    stages = list(base_stages)
+
+    if failure_mode is not None:
+        stages.append(failure_modes[failure_mode]['stage'])
+
+    return stages
+
+
+def write_manifest(filename, manifest):
+    '''
+    Writes the ground truth of what was applied to every device, one row per stage.
+    '''
+    fields = ['id', 'file', 'failure', 'failure_start', 'failure_ts', 'amount', 'rows_removed']
+
+    with open(filename, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writeheader()
+
+        for record in manifest:
+            writer.writerow(record)
+
+
+def write_failed_files(filename, manifest, failure_modes=FAILURE_MODES):
+    '''
+    Writes files_applied_failures.txt in the format it's always had: each failure mode name followed by its files.
+    '''
+    with open(filename, 'w') as f:
+        for name in failure_modes:
+            f.write(name + '\n')
+
+            for record in manifest:
+                if record['failure'] == name:
+                    f.write(record['file'] + '\n')
@@ -0,0 +1,270 @@
+'''
+High throughput publishing of generated device data to Kafka.
+
+publish_csv_to_kafka in data_generator sends one unbatched str(dict) per row. This batches on the
+producer side (linger_ms/batch_size/compression), keys every message by device id so a partition
+keeps each device's readings in order, reads device files concurrently, and flushes at the end
+while counting delivery errors.
+
+Serializers (value of each message):
+    repr: str() of a dict of strings, exactly what publish_csv_to_kafka sends
+    json: {"id": 3, "ts": "2020-01-01 00:00:00", "lumens": 0.0, ...} with real numbers
+    msgpack: same fields as json, ts as epoch seconds
+    struct: fixed 56 byte little endian record, see STRUCT_FORMAT
+'''
+import os
+import json
+import time
+import argparse
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from writers import writer_for
+from metrics import REGISTRY, histogram, counter, gauge
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+TOPIC = 'raw-sensor-data'
+COLUMNS = ['id', 'ts', 'lumens', 'temp', 'cpu_temp', 'signal', 'charge']
+
+# id, ts (epoch seconds), lumens, temp, cpu_temp, signal, charge
+STRUCT_FORMAT = '<dqddddd'
+STRUCT_DTYPE = np.dtype([
+    ('id', '<f8'), ('ts', '<i8'), ('lumens', '<f8'), ('temp', '<f8'),
+    ('cpu_temp', '<f8'), ('signal', '<f8'), ('charge', '<f8')
+])
+
+
+MESSAGES = counter('publisher_messages_total', 'Messages by status (sent, delivered, failed) and mode (fleet, replay)')
+DEVICE_SECONDS = histogram('publisher_device_seconds', 'Time reading, serializing and sending one device file')
+THROUGHPUT = gauge('publisher_messages_per_second', 'Send rate of the last run, by mode')
+
+
+def epoch_seconds(ts):
+    return ts.to_numpy(dtype='datetime64[s]').astype(np.int64)
+
+
+def serialize_repr(df):
+    df = df[COLUMNS].copy()
+    df['ts'] = df['ts'].dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    return [str(row).encode('utf-8') for row in df.astype(str).to_dict('records')]
+
+
+def serialize_json(df):
+    df = df[COLUMNS].copy()
+    df['ts'] = df['ts'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    df['id'] = df['id'].astype(int)
+
+    return [json.dumps(row, separators=(',', ':')).encode('utf-8') for row in df.to_dict('records')]
+
+
+def serialize_msgpack(df):
+    if msgpack is None:
+        raise ImportError('msgpack is required for the msgpack serializer (pip install msgpack)')
+
+    df = df[COLUMNS].copy()
+    df['ts'] = epoch_seconds(df['ts'])
+    df['id'] = df['id'].astype(int)
+
+    return [msgpack.packb(row) for row in df.to_dict('records')]
+
+
+def serialize_struct(df):
+    records = np.empty(df.shape[0], dtype=STRUCT_DTYPE)
+    for c in COLUMNS:
+        records[c] = epoch_seconds(df['ts']) if c == 'ts' else df[c].to_numpy()
+
+    buf = records.tobytes()
+    size = STRUCT_DTYPE.itemsize
+
+    return [buf[i:i + size] for i in range(0, len(buf), size)]
+
+
+SERIALIZERS = {
+    'repr': serialize_repr,
+    'json': serialize_json,
+    'msgpack': serialize_msgpack,
+    'struct': serialize_struct
+}
+
+
+class PublishStats():
+    '''
+    Counts sent/delivered/failed messages. Callbacks come from the producer's IO thread, hence the lock.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.delivered = 0
+        self.failed = 0
+        self.errors = Counter()
+
+    def on_sent(self, count):
+        with self.lock:
+            self.sent += count
+
+    def on_delivered(self, metadata):
+        with self.lock:
+            self.delivered += 1
+
+    def on_error(self, exc):
+        with self.lock:
+            self.failed += 1
+            self.errors[type(exc).__name__] += 1
+
+    def record(self, mode, elapsed):
+        '''
+        Adds this run's counts to the publisher_* metrics.
+        '''
+        MESSAGES.inc(self.sent, status='sent', mode=mode)
+        MESSAGES.inc(self.delivered, status='delivered', mode=mode)
+        MESSAGES.inc(self.failed, status='failed', mode=mode)
+        THROUGHPUT.set(self.sent / max(elapsed, 1e-9), mode=mode)
+
+
+class LocalFuture():
+    def __init__(self, metadata=None, exc=None):
+        self.metadata = metadata
+        self.exc = exc
+
+    def add_callback(self, fn):
+        if self.exc is None:
+            fn(self.metadata)
+        return self
+
+    def add_errback(self, fn):
+        if self.exc is not None:
+            fn(self.exc)
+        return self
+
+
+class LocalProducer():
+    '''
+    Stand-in for KafkaProducer that keeps messages in memory, so the publisher can be run without a broker.
+
+    Messages are spread across partitions by key the same way Kafka keeps keyed messages together.
+    Pass fail_every=N to fail every Nth send, to exercise the delivery error accounting.
+    '''
+    def __init__(self, partitions=8, fail_every=None):
+        self.partitions = partitions
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.messages = defaultdict(lambda: defaultdict(list))
+        self.count = 0
+
+    def send(self, topic, value=None, key=None):
+        with self.lock:
+            self.count += 1
+            if self.fail_every and self.count % self.fail_every == 0:
+                return LocalFuture(exc=RuntimeError('simulated delivery failure'))
+
+            partition = hash(key) % self.partitions
+            self.messages[topic][partition].append((key, value))
+
+            return LocalFuture(metadata=(topic, partition, len(self.messages[topic][partition]) - 1))
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+def make_producer(bootstrap_servers='localhost:9092', linger_ms=50, batch_size=512 * 1024, compression_type='gzip', acks=1):
+    '''
+    A KafkaProducer tuned for bulk replay instead of the defaults (no linger, 16KB batches, no compression).
+
+    gzip is the default since kafka-python only needs the standard library for it. lz4, snappy and zstd
+    compress faster but need their codec package installed (lz4, python-snappy, zstandard),
+    and kafka-python refuses to build the producer without it.
+    '''
+    from kafka import KafkaProducer
+
+    return KafkaProducer(
+        bootstrap_servers=bootstrap_servers,
+        linger_ms=linger_ms,
+        batch_size=batch_size,
+        compression_type=compression_type,
+        acks=acks
+    )
+
+
+def publish_device(path, producer, serialize, stats, topic=TOPIC):
+    '''
+    Publishes one device's data, keyed by device id.
+    '''
+    print(f'Reporting to Kafka for {os.path.basename(path)}')
+
+    with DEVICE_SECONDS.time(serializer=serialize.__name__.replace('serialize_', '')):
+        for df in writer_for(path).iter_frames(path):
+            keys = [str(int(i)).encode('utf-8') for i in df['id']]
+
+            for key, value in zip(keys, serialize(df)):
+                producer.send(topic, key=key, value=value).add_callback(stats.on_delivered).add_errback(stats.on_error)
+
+            stats.on_sent(len(keys))
+
+
+def publish_fleet(data_dir, producer, serializer='json', readers=4, topic=TOPIC):
+    '''
+    Publishes every device file in data_dir, with `readers` files being read at once.
+
+    Flushes the producer at the end so every message is either delivered or counted as failed.
+    Returns the PublishStats.
+    '''
+    serialize = SERIALIZERS[serializer]
+    stats = PublishStats()
+    paths = [os.path.join(data_dir, f) for f in sorted(os.listdir(data_dir))]
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=readers) as pool:
+        # list() so any reader exceptions are raised here
+        list(pool.map(lambda path: publish_device(path, producer, serialize, stats, topic), paths))
+
+    producer.flush()
+    elapsed = time.perf_counter() - start
+
+    print(f'Sent {stats.sent} messages in {elapsed:.1f}s ({stats.sent / elapsed:,.0f} msgs/sec): {stats.delivered} delivered, {stats.failed} failed')
+    if stats.errors:
+        print(f'Delivery errors: {dict(stats.errors)}')
+
+    stats.record('fleet', elapsed)
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish generated device data to Kafka')
+    parser.add_argument('--data-dir', default=os.path.join(os.getcwd(), 'device_data'))
+    parser.add_argument('--bootstrap-servers', default='localhost:9092')
+    parser.add_argument('--serializer', default='json', choices=list(SERIALIZERS))
+    parser.add_argument('--linger-ms', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=512 * 1024)
+    parser.add_argument('--compression', default='gzip', choices=['none', 'gzip', 'snappy', 'lz4', 'zstd'], help='lz4/snappy/zstd need their codec package installed')
+    parser.add_argument('--readers', type=int, default=4, help='device files read concurrently')
+    parser.add_argument('--local', action='store_true', help='publish to an in-memory LocalProducer instead of Kafka')
+    parser.add_argument('--metrics-file', default=None, help='write publish metrics here when done (.prom or .json)')
+    args = parser.parse_args()
+
+    if args.local:
+        producer = LocalProducer()
+    else:
+        producer = make_producer(
+            args.bootstrap_servers,
+            linger_ms=args.linger_ms,
+            batch_size=args.batch_size,
+            compression_type=None if args.compression == 'none' else args.compression
+        )
+
+    publish_fleet(args.data_dir, producer, serializer=args.serializer, readers=args.readers)
+    producer.close()
+
+    if args.metrics_file:
+        REGISTRY.write(args.metrics_file)
@@ -0,0 +1,190 @@
+'''
+Replays generated device data to Kafka in global timestamp order, like a live fleet would report.
+
+publish_fleet sends each device's whole history before moving on to the next device. This instead
+k-way merges every device's rows by ts (a heap over one lazy iterator per device, so only a chunk
+per device is ever in memory) and sends each hour's readings when they're due.
+
+Each of those iterators keeps its file open, so fleets bigger than --max-open devices are merged in groups:
+each group into a sorted run in a temporary directory, then the runs (see merge_devices).
+
+speed is simulated seconds per wall clock second:
+    1       real time, one hour of readings per hour
+    3600    one hour of readings per second
+    None    as fast as possible, still in timestamp order
+'''
+import os
+import time
+import heapq
+import pickle
+import argparse
+import tempfile
+from functools import partial
+from itertools import groupby, islice
+import pandas as pd
+from writers import writer_for
+from kafka_publisher import COLUMNS, SERIALIZERS, TOPIC, PublishStats, LocalProducer, make_producer
+from metrics import REGISTRY
+
+
+def iter_device_rows(path, chunksize=1000):
+    '''
+    Lazily yields a device's rows as tuples in COLUMNS order, reading a chunk at a time.
+    '''
+    for df in writer_for(path).iter_frames(path, chunksize=chunksize):
+        yield from df[COLUMNS].sort_values('ts').itertuples(index=False, name=None)
+
+
+def merge(sources):
+    '''
+    k-way merge by ts (the second element of each row) of the iterators the sources (functions) return.
+    '''
+    return heapq.merge(*[source() for source in sources], key=lambda row: row[1])
+
+
+def write_run(rows, path, chunksize=1000):
+    '''
+    Writes rows (already in ts order) to a run file, as pickled lists of chunksize rows.
+    '''
+    with open(path, 'wb') as f:
+        for batch in iter(lambda: list(islice(rows, chunksize)), []):
+            pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def iter_run(path):
+    '''
+    Lazily yields the rows of a run file written by write_run, a chunk at a time.
+    '''
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
+def merge_devices(data_dir, chunksize=1000, max_open=256):
+    '''
+    Every row of every device in data_dir, in ts order.
+
+    No more than max_open files are read at once. With more devices than that, each group of max_open
+    devices is merged into a run file in a temporary directory first, then the runs are merged
+    (again in groups, if there are more than max_open of them). The directory is removed once the
+    rows have all been read.
+    '''
+    paths = [os.path.join(data_dir, f) for f in sorted(os.listdir(data_dir))]
+    sources = [partial(iter_device_rows, p, chunksize) for p in paths]
+
+    if len(sources) <= max_open:
+        yield from merge(sources)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='replay-') as tmp:
+        level = 0
+        while len(sources) > max_open:
+            runs = []
+            for i in range(0, len(sources), max_open):
+                path = os.path.join(tmp, f'run-{level}-{len(runs)}.pkl')
+                write_run(merge(sources[i:i + max_open]), path, chunksize)
+                runs.append(partial(iter_run, path))
+
+            print(f'Merged {len(sources)} {"devices" if level == 0 else "runs"} into {len(runs)} runs')
+            sources = runs
+            level += 1
+
+        yield from merge(sources)
+
+
+def schedule(rows, speed=3600, max_batch=5000):
+    '''
+    Groups rows by ts and yields them once they're due, sleeping in between.
+
+    Consecutive hours that are already due (speed=None, or the replay fell behind) are yielded
+    together, up to max_batch rows, so catching up doesn't pay the per-send overhead for every hour.
+
+    Yields (last ts in the batch, rows, seconds behind schedule).
+    '''
+    first_ts = None
+    wall_start = None
+    batch = []
+    batch_ts = None
+    behind = 0
+
+    for ts, group in groupby(rows, key=lambda row: row[1]):
+        if speed is not None:
+            if first_ts is None:
+                first_ts = ts
+                wall_start = time.monotonic()
+
+            due = wall_start + (ts - first_ts).total_seconds() / speed
+            delay = due - time.monotonic()
+
+            if delay > 0:
+                if batch:
+                    yield batch_ts, batch, behind
+                    batch = []
+                time.sleep(delay)
+
+            behind = max(-delay, 0)
+
+        batch.extend(group)
+        batch_ts = ts
+
+        if len(batch) >= max_batch:
+            yield batch_ts, batch, behind
+            batch = []
+
+    if batch:
+        yield batch_ts, batch, behind
+
+
+def replay_fleet(data_dir, producer, speed=3600, serializer='json', topic=TOPIC, report_every=100, max_open=256):
+    '''
+    Sends the fleet to Kafka in ts order at the given speed, keyed by device id like publish_fleet.
+
+    Prints progress every report_every sends. Returns the PublishStats.
+    '''
+    serialize = SERIALIZERS[serializer]
+    stats = PublishStats()
+    start = time.perf_counter()
+
+    for i, (ts, group, behind) in enumerate(schedule(merge_devices(data_dir, max_open=max_open), speed)):
+        df = pd.DataFrame(group, columns=COLUMNS)
+        keys = [str(int(device_id)).encode('utf-8') for device_id in df['id']]
+
+        for key, value in zip(keys, serialize(df)):
+            producer.send(topic, key=key, value=value).add_callback(stats.on_delivered).add_errback(stats.on_error)
+        stats.on_sent(len(keys))
+
+        if i % report_every == 0:
+            elapsed = time.perf_counter() - start
+            print(f'Replayed up to {ts}: {stats.sent} messages, {stats.sent / max(elapsed, 1e-9):,.0f} msgs/sec, {behind:.2f}s behind schedule')
+
+    producer.flush()
+    print(f'Replay finished: {stats.sent} sent, {stats.delivered} delivered, {stats.failed} failed')
+
+    stats.record('replay', time.perf_counter() - start)
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay generated device data to Kafka in timestamp order')
+    parser.add_argument('--data-dir', default=os.path.join(os.getcwd(), 'device_data'))
+    parser.add_argument('--bootstrap-servers', default='localhost:9092')
+    parser.add_argument('--speed', default='3600', help='simulated seconds per second, 1 for real time, or "max"')
+    parser.add_argument('--serializer', default='json', choices=list(SERIALIZERS))
+    parser.add_argument('--max-open', type=int, default=256, help='device files read at once, bigger fleets are merged in groups through temporary files')
+    parser.add_argument('--local', action='store_true', help='replay to an in-memory LocalProducer instead of Kafka')
+    parser.add_argument('--metrics-file', default=None, help='write publish metrics here when done (.prom or .json)')
+    args = parser.parse_args()
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    producer = LocalProducer() if args.local else make_producer(args.bootstrap_servers, linger_ms=5)
+
+    replay_fleet(args.data_dir, producer, speed=speed, serializer=args.serializer, max_open=args.max_open)
+    producer.close()
+
+    if args.metrics_file:
+        REGISTRY.write(args.metrics_file)
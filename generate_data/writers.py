@@ -0,0 +1,137 @@
+import os
+import csv
+import shutil
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+
+class CsvWriter():
+    '''
+    The original format: one QUOTE_NONNUMERIC CSV per device.
+    '''
+    name = 'csv'
+
+    def path(self, data_dir, stem):
+        return os.path.join(data_dir, stem + '.csv')
+
+    def write(self, path, df):
+        df = df.copy()
+        df['ts'] = df['ts'].dt.strftime('%Y-%m-%d %H:%M:%S')
+
+        df.to_csv(path, index=False, quoting=csv.QUOTE_NONNUMERIC)
+
+    def read(self, path):
+        df = pd.read_csv(path)
+
+        # Files written before the writer layer have an index column (or several) from to_csv
+        df = df[[c for c in df.columns if not c.startswith('Unnamed')]]
+        df['ts'] = pd.to_datetime(df['ts'])
+
+        return df
+
+    def iter_frames(self, path, chunksize=50000):
+        for df in pd.read_csv(path, chunksize=chunksize):
+            df = df[[c for c in df.columns if not c.startswith('Unnamed')]]
+            df['ts'] = pd.to_datetime(df['ts'])
+            yield df
+
+
+class PartitionedWriter():
+    '''
+    One directory per device, holding one file per month of data.
+
+    Columns are stored typed (float64 metrics, timestamp ts) so nothing gets re-parsed from text.
+    Subclasses just say how a single month file is written and read.
+    '''
+    name = None
+    extension = None
+
+    def __init__(self):
+        if pa is None:
+            raise ImportError(f'pyarrow is required for the {self.name} format (pip install pyarrow)')
+
+    def path(self, data_dir, stem):
+        return os.path.join(data_dir, stem)
+
+    def write(self, path, df):
+        # Rewrites replace the device, so clear out any months left from the last write
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        months = df['ts'].dt.strftime('%Y-%m')
+        for month, month_df in df.groupby(months, sort=True):
+            table = pa.Table.from_pandas(month_df, preserve_index=False)
+            self.write_table(os.path.join(path, month + self.extension), table)
+
+    def month_files(self, path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(self.extension))
+
+    def read(self, path):
+        frames = list(self.iter_frames(path))
+
+        return pd.concat(frames, ignore_index=True)
+
+    def iter_frames(self, path, chunksize=None):
+        # Chunks are always a month file, chunksize is only there to match CsvWriter
+        for fn in self.month_files(path):
+            yield self.read_table(fn).to_pandas()
+
+
+class ParquetWriter(PartitionedWriter):
+    name = 'parquet'
+    extension = '.parquet'
+
+    def write_table(self, fn, table):
+        pq.write_table(table, fn, compression='zstd')
+
+    def read_table(self, fn):
+        return pq.read_table(fn)
+
+
+class ArrowWriter(PartitionedWriter):
+    '''
+    Arrow IPC (feather v2) files, uncompressed so they can be memory mapped.
+    '''
+    name = 'arrow'
+    extension = '.arrow'
+
+    def write_table(self, fn, table):
+        feather.write_feather(table, fn, compression='uncompressed')
+
+    def read_table(self, fn):
+        return feather.read_table(fn, memory_map=True)
+
+
+FORMATS = {
+    'csv': CsvWriter,
+    'parquet': ParquetWriter,
+    'arrow': ArrowWriter
+}
+
+
+def get_writer(fmt):
+    '''
+    Returns a writer for a format name: csv, parquet or arrow.
+    '''
+    return FORMATS[fmt]()
+
+
+def writer_for(path):
+    '''
+    Works out which writer can read an existing device file/directory.
+    '''
+    if not os.path.isdir(path):
+        return CsvWriter()
+
+    for cls in (ParquetWriter, ArrowWriter):
+        if any(f.endswith(cls.extension) for f in os.listdir(path)):
+            return cls()
+
+    raise ValueError(f'No device data found in {path}')
@@ -0,0 +1,132 @@
+'''
+Bucketed storage layouts for the hourly readings.
+
+One document per reading repeats every field name and an ObjectId _id, so the readings take several
+times the space of their values, and scans (health checks, long range plots) read all of it.
+Two layouts store many readings per document instead:
+
+    timeseries  (readings-ts) a MongoDB 5.0+ time-series collection, metaField id and timeField ts.
+                MongoDB buckets and compresses the readings itself, queries look exactly the same.
+
+    buckets     (readings-buckets) one document per device per day, holding the day's readings as arrays:
+
+        _id             {'id': device id, 'ts': start of the day}
+        id, ts          same as in _id
+        count
+        t               seconds since ts of each reading
+        <metric>        the values for every metric, in the same order as t
+
+The readings collection stays as it is. MongoReader reads whichever layout it's given (layout= or MONGOREADER_LAYOUT),
+and the ingest consumer can write either one (--layout). Existing readings are copied over with --migrate.
+'''
+from collections import defaultdict
+from schema import COLLECTION, METRICS, READING_COLLECTIONS
+from rollups import bucket_start, fresh_readings
+from idempotent import fold_once
+
+TIMESERIES_COLLECTION = READING_COLLECTIONS['timeseries']
+BUCKET_COLLECTION = READING_COLLECTIONS['buckets']
+
+
+def bucket_update(bucket, docs):
+    '''
+    (filter, update) appending one device's readings for one day to its bucket, skipping the ones it
+    already has, or None if it has them all. bucket is the current document (at least t), or None.
+    '''
+    start = bucket_start(docs[0]['ts'], 'daily')
+    fresh = fresh_readings(bucket, docs, start)
+    if not fresh:
+        return None
+
+    push = {'t': {'$each': list(fresh)}}
+    for m in METRICS:
+        push[m] = {'$each': [d[m] for d in fresh.values()]}
+
+    # Stops matching once these readings are in
+    return {'t': {'$nin': list(fresh)}}, {'$setOnInsert': {'id': docs[0]['id'], 'ts': start}, '$inc': {'count': len(fresh)}, '$push': push}
+
+
+def update_buckets(db, docs):
+    '''
+    Appends a batch of ingested documents to their day buckets. Safe to repeat with the same documents.
+    '''
+    buckets = defaultdict(list)
+    for doc in docs:
+        buckets[(doc['id'], bucket_start(doc['ts'], 'daily'))].append(doc)
+
+    groups = [({'id': device_id, 'ts': start}, bucket_docs) for (device_id, start), bucket_docs in buckets.items()]
+    fold_once(db[BUCKET_COLLECTION], groups, bucket_update, {'t': 1})
+
+
+def ensure_buckets(db):
+    db[BUCKET_COLLECTION].create_index([('id', 1), ('ts', 1)])
+
+    return db[BUCKET_COLLECTION]
+
+
+def ensure_timeseries(db):
+    '''
+    Creates the time-series collection if it doesn't exist yet.
+    '''
+    if TIMESERIES_COLLECTION not in db.list_collection_names():
+        db.create_collection(TIMESERIES_COLLECTION, timeseries={'timeField': 'ts', 'metaField': 'id', 'granularity': 'hours'})
+
+    return db[TIMESERIES_COLLECTION]
+
+
+def migrate_to_buckets(db):
+    '''
+    Rebuilds the day buckets from everything in the readings collection, server side.
+    Needs MongoDB 5.0+ for $dateTrunc/$dateDiff. Run --convert-existing first if there are documents stored as strings.
+    '''
+    group = {
+        '_id': {'id': '$id', 'ts': '$day'},
+        'count': {'$sum': 1},
+        't': {'$push': {'$dateDiff': {'startDate': '$day', 'endDate': '$ts', 'unit': 'second'}}}
+    }
+    for m in METRICS:
+        group[m] = {'$push': '$' + m}
+
+    db[COLLECTION].aggregate([
+        {'$sort': {'id': 1, 'ts': 1}},
+        {'$set': {'day': {'$dateTrunc': {'date': '$ts', 'unit': 'day'}}}},
+        {'$group': group},
+        {'$set': {'id': '$_id.id', 'ts': '$_id.ts'}},
+        {'$merge': {'into': BUCKET_COLLECTION, 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+    ], allowDiskUse=True)
+
+    ensure_buckets(db)
+    print(f'Migrated readings into {db[BUCKET_COLLECTION].count_documents({})} day buckets')
+    print_storage(db, [COLLECTION, BUCKET_COLLECTION])
+
+
+def migrate_to_timeseries(db, batch_size=10000):
+    '''
+    Copies every reading into the time-series collection ($out/$merge can't write to one before MongoDB 7.0).
+    Run it against an empty time-series collection, or readings already there get copied twice.
+    '''
+    coll = ensure_timeseries(db)
+
+    batch = []
+    copied = 0
+    for doc in db[COLLECTION].find({}, {'_id': 0}).sort([('id', 1), ('ts', 1)]):
+        batch.append(doc)
+
+        if len(batch) >= batch_size:
+            coll.insert_many(batch, ordered=False)
+            copied += len(batch)
+            batch = []
+            print(f'Copied {copied} readings')
+
+    if batch:
+        coll.insert_many(batch, ordered=False)
+        copied += len(batch)
+
+    print(f'Migrated {copied} readings into {TIMESERIES_COLLECTION}')
+    print_storage(db, [COLLECTION, TIMESERIES_COLLECTION])
+
+
+def print_storage(db, names):
+    for name in names:
+        stats = db.command('collStats', name)
+        print(f"{name}: {stats.get('count')} documents, {stats.get('size', 0) / 1e6:.1f}MB data, {stats.get('storageSize', 0) / 1e6:.1f}MB on disk")
@@ -0,0 +1,296 @@
+'''
+Kafka -> MongoDB ingestion.
+
+Reads readings off the raw-sensor-data topic, converts each one to the typed schema (schema.py)
+and inserts them into sensordata.raw-sensor-data. Messages that don't fit the schema are skipped and counted.
+Each inserted batch is also folded into the per-device health summaries (health.py) and the daily/weekly rollups (rollups.py).
+With --layout the readings go into the time-series collection or the day buckets instead (buckets.py).
+
+Run as many of these as the topic has partitions: they share a consumer group, so Kafka splits the
+partitions between them (and keyed by device id, each device's readings stay with one consumer).
+
+Batches are written when they reach batch_size documents or when the oldest buffered message is max_wait
+seconds old, whichever comes first. Offsets are only committed once a batch has been written with the
+durable write concern, so a crash re-delivers at most the uncommitted batch (at least once delivery).
+Every write is safe to repeat (see idempotent.py), so a re-delivered or retried batch is stored and
+counted once.
+Polling only resumes once the batch is written, so a slow MongoDB slows consumption rather than
+filling memory.
+'''
+import time
+import argparse
+from collections import deque
+import pymongo
+from pymongo import WriteConcern
+from pymongo.errors import AutoReconnect, BulkWriteError, ExecutionTimeout, WTimeoutError
+from schema import DATABASE, COLLECTION, READING_COLLECTIONS, parse_message, to_document, ensure_collection, convert_collection
+from idempotent import only_duplicates, reading_id
+from health import update_health, backfill_health
+from rollups import update_rollups, backfill_rollups, ensure_rollup_indexes
+from buckets import TIMESERIES_COLLECTION, update_buckets, ensure_buckets, ensure_timeseries, migrate_to_buckets, migrate_to_timeseries
+
+LAYOUTS = list(READING_COLLECTIONS)
+
+TOPIC = 'raw-sensor-data'
+
+# Errors worth retrying a write for. Anything else (like a validation error) is raised.
+TRANSIENT_ERRORS = (AutoReconnect, ExecutionTimeout, WTimeoutError)
+
+
+class IngestStats():
+    '''
+    Consumed/inserted/rejected counts, batch write latencies, throughput and consumer lag.
+    '''
+    def __init__(self, window=100):
+        self.start = time.perf_counter()
+        self.consumed = 0
+        self.inserted = 0
+        self.rejected = 0
+        self.batches = 0
+        self.retries = 0
+        self.lag = None
+        self.latencies = deque(maxlen=window)
+
+    def on_batch(self, count, latency):
+        self.batches += 1
+        self.inserted += count
+        self.latencies.append(latency)
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start
+        latencies = sorted(self.latencies)
+
+        return {
+            'consumed': self.consumed,
+            'inserted': self.inserted,
+            'rejected': self.rejected,
+            'batches': self.batches,
+            'retries': self.retries,
+            'lag': self.lag,
+            'docs_per_sec': self.inserted / max(elapsed, 1e-9),
+            'batch_latency_p50': latencies[len(latencies) // 2] if latencies else None,
+            'batch_latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else None
+        }
+
+    def report(self):
+        s = self.snapshot()
+        latency = f"{s['batch_latency_p50'] * 1000:.0f}/{s['batch_latency_p95'] * 1000:.0f}ms p50/p95" if self.latencies else 'n/a'
+
+        print(f"Inserted {s['inserted']} documents ({s['docs_per_sec']:,.0f} docs/sec), rejected {s['rejected']}, "
+              f"batch latency {latency}, lag {s['lag']}")
+
+
+class Ingester():
+    '''
+    Buffers parsed documents from a consumer and writes them to db in batches.
+
+    consumer is a KafkaConsumer or anything with the same poll/commit/assignment/position/end_offsets
+    methods (local.LocalConsumer). db should have the write concern the writes need to be durable under.
+    layout is where readings are stored, one of LAYOUTS (see buckets.py).
+    '''
+    def __init__(self, consumer, db, batch_size=1000, max_wait=1.0, retries=5, layout='documents'):
+        self.consumer = consumer
+        self.db = db
+        self.coll = db[TIMESERIES_COLLECTION if layout == 'timeseries' else COLLECTION]
+        self.layout = layout
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.retries = retries
+
+        self.batch = []
+        self.oldest = None
+        self.stats = IngestStats()
+
+    def add(self, records):
+        for msg in records:
+            self.stats.consumed += 1
+            try:
+                self.batch.append(to_document(parse_message(msg.value)))
+            except (ValueError, KeyError, TypeError, SyntaxError) as e:
+                self.stats.rejected += 1
+                print(f'Skipping message at partition {msg.partition} offset {msg.offset}: {e}')
+
+        if self.oldest is None and records:
+            self.oldest = time.monotonic()
+
+    def due(self):
+        return len(self.batch) >= self.batch_size or (self.oldest is not None and time.monotonic() - self.oldest >= self.max_wait)
+
+    def write(self, fn, *args):
+        '''
+        Runs one write, retrying transient errors with exponential backoff.
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args)
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                self.stats.retries += 1
+                print(f'Write failed ({e}), retrying in {0.1 * 2 ** attempt:.1f}s')
+                time.sleep(0.1 * 2 ** attempt)
+
+    def insert(self, batch):
+        '''
+        Inserts the readings in batch that aren't stored yet.
+
+        Readings get their (id, ts) as _id, so ones already stored (re-delivered, or inserted by an attempt
+        that failed partway) are duplicate key errors and skipped. Time-series collections don't enforce
+        a unique _id, so there the readings already stored are looked up and left out first.
+        '''
+        if self.layout == 'timeseries':
+            stored = self.coll.find(
+                {'id': {'$in': list({d['id'] for d in batch})}, 'ts': {'$gte': min(d['ts'] for d in batch), '$lte': max(d['ts'] for d in batch)}},
+                {'_id': 0, 'id': 1, 'ts': 1}
+            )
+            stored = {(d['id'], d['ts']) for d in stored}
+
+            docs = [d for d in batch if (d['id'], d['ts']) not in stored]
+            if docs:
+                self.coll.insert_many(docs, ordered=False)
+            return
+
+        try:
+            self.coll.insert_many([{'_id': reading_id(d), **d} for d in batch], ordered=False)
+        except BulkWriteError as e:
+            if not only_duplicates(e):
+                raise
+
+    def flush(self):
+        '''
+        Writes the buffered documents and then commits offsets. Everything polled so far is either in
+        this batch or was rejected, so committing the consumer's positions is safe.
+        '''
+        if self.oldest is None:
+            return
+
+        start = time.perf_counter()
+        # A reading sent twice (a producer retry) can be in the same batch twice
+        batch = list({(d['id'], d['ts']): d for d in self.batch}.values())
+
+        if batch:
+            # Each step is retried on its own, and skips whatever an earlier attempt (or delivery) already wrote
+            if self.layout == 'buckets':
+                self.write(update_buckets, self.db, batch)
+            else:
+                self.write(self.insert, batch)
+            self.write(update_health, self.db, batch)
+            self.write(update_rollups, self.db, batch)
+
+        # Cleared before committing: if the commit fails the batch is re-delivered, not written twice by this process
+        self.batch = []
+        self.oldest = None
+
+        self.consumer.commit()
+        self.stats.on_batch(len(batch), time.perf_counter() - start)
+
+    def update_lag(self):
+        partitions = list(self.consumer.assignment())
+        if partitions:
+            ends = self.consumer.end_offsets(partitions)
+            self.stats.lag = sum(ends[tp] - self.consumer.position(tp) for tp in partitions)
+
+        return self.stats.lag
+
+    def run(self, poll_timeout_ms=500, report_every=10, stop_when_idle=False):
+        '''
+        Polls and writes until interrupted, or with stop_when_idle until a poll comes back empty
+        with nothing left to read. Always flushes what's buffered before returning.
+        '''
+        try:
+            while True:
+                polled = self.consumer.poll(timeout_ms=poll_timeout_ms, max_records=self.batch_size - len(self.batch))
+
+                for records in polled.values():
+                    self.add(records)
+
+                if self.due():
+                    self.flush()
+
+                    if self.stats.batches % report_every == 0:
+                        self.update_lag()
+                        self.stats.report()
+
+                if stop_when_idle and not polled and not self.update_lag():
+                    break
+        finally:
+            self.flush()
+            self.update_lag()
+            self.stats.report()
+
+        return self.stats
+
+
+def consume(bootstrap_servers='localhost:9092', mongo_uri='mongodb://localhost:27017', batch_size=1000, group_id='mongo-ingest', max_wait=1.0, w='majority', journal=True, layout='documents'):
+    '''
+    Ingests from Kafka as part of consumer group group_id, until interrupted.
+    '''
+    from kafka import KafkaConsumer, ConsumerRebalanceListener
+
+    client = pymongo.MongoClient(mongo_uri)
+    db = client.get_database(DATABASE, write_concern=WriteConcern(w=w, j=journal))
+    if layout == 'timeseries':
+        ensure_timeseries(db)
+    elif layout == 'buckets':
+        ensure_buckets(db)
+    else:
+        ensure_collection(db, COLLECTION)
+    ensure_rollup_indexes(db)
+
+    consumer = KafkaConsumer(
+        bootstrap_servers=bootstrap_servers,
+        group_id=group_id,
+        enable_auto_commit=False,
+        auto_offset_reset='earliest',
+        max_poll_records=batch_size
+    )
+    ingester = Ingester(consumer, db, batch_size=batch_size, max_wait=max_wait, layout=layout)
+
+    class FlushOnRevoke(ConsumerRebalanceListener):
+        '''
+        Writes and commits what's buffered before partitions move to another consumer in the group,
+        so the new owner doesn't re-deliver it.
+        '''
+        def on_partitions_revoked(self, revoked):
+            ingester.flush()
+
+        def on_partitions_assigned(self, assigned):
+            pass
+
+    consumer.subscribe([TOPIC], listener=FlushOnRevoke())
+
+    try:
+        return ingester.run()
+    finally:
+        consumer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest sensor readings from Kafka into MongoDB')
+    parser.add_argument('--bootstrap-servers', default='localhost:9092')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--group-id', default='mongo-ingest', help='consumers with the same group id split the partitions between them')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--layout', default='documents', choices=LAYOUTS, help='how readings are stored (and backfilled from), see buckets.py')
+    parser.add_argument('--migrate', choices=['timeseries', 'buckets'], help='copy the stored readings into a bucketed layout, then exit')
+    parser.add_argument('--max-wait', type=float, default=1.0, help='seconds a message can wait before a partial batch is written')
+    parser.add_argument('--write-concern', default='majority', help='w for inserts, a number or "majority"')
+    parser.add_argument('--no-journal', action='store_true', help="don't wait for writes to be journaled before committing offsets")
+    parser.add_argument('--convert-existing', action='store_true', help='convert documents already stored as strings to the typed schema, then exit')
+    parser.add_argument('--backfill-health', action='store_true', help='rebuild the device health summaries from the readings stored in --layout, then exit')
+    parser.add_argument('--backfill-rollups', action='store_true', help='rebuild the daily/weekly rollups from the readings stored in --layout, then exit')
+    args = parser.parse_args()
+
+    if args.convert_existing:
+        convert_collection(pymongo.MongoClient(args.mongo_uri)[DATABASE][COLLECTION])
+    elif args.backfill_health:
+        backfill_health(pymongo.MongoClient(args.mongo_uri)[DATABASE], layout=args.layout)
+    elif args.backfill_rollups:
+        backfill_rollups(pymongo.MongoClient(args.mongo_uri)[DATABASE], args.layout)
+    elif args.migrate == 'timeseries':
+        migrate_to_timeseries(pymongo.MongoClient(args.mongo_uri)[DATABASE])
+    elif args.migrate == 'buckets':
+        migrate_to_buckets(pymongo.MongoClient(args.mongo_uri)[DATABASE])
+    else:
+        w = int(args.write_concern) if args.write_concern.isdigit() else args.write_concern
+        consume(args.bootstrap_servers, args.mongo_uri, args.batch_size, args.group_id, args.max_wait, w, not args.no_journal, args.layout)
@@ -0,0 +1,86 @@
+'''
+Incrementally maintained per-device health summaries.
+
+The dashboard's health checks (missing records, no new data, signal spread, CPU overtemp) only need
+a handful of running values per device. Rather than recomputing them over the whole history, every
+ingested batch is folded into one document per device in the device-health collection:
+
+    _id             device id
+    ts_min, ts_max, ts_count
+    signal_min, signal_max, signal_sum
+    cpu_temp_count, cpu_temp_max        readings over CPU_TEMP_LIMIT
+
+Each device's readings are folded in as they arrive, so a summary only takes readings newer than its
+ts_max: re-delivered ones are already in it. The consumer gets a device's readings oldest first (they're
+keyed by device, so they stay in one partition, and the publishers send each device's series in order),
+but any reading that does turn up after a newer one is stored without being counted here.
+'''
+from collections import defaultdict
+from schema import readings
+from idempotent import fold_once
+
+HEALTH_COLLECTION = 'device-health'
+CPU_TEMP_LIMIT = 122
+
+
+def health_update(summary, docs, cpu_temp_limit=CPU_TEMP_LIMIT):
+    '''
+    (filter, update) folding one device's readings newer than its summary into it, or None if there aren't any.
+    summary is the device's current summary (at least ts_max), None if it doesn't have one yet.
+    '''
+    last = summary.get('ts_max') if summary else None
+    fresh = [d for d in docs if last is None or d['ts'] > last]
+    if not fresh:
+        return None
+
+    ts = [d['ts'] for d in fresh]
+    signal = [d['signal'] for d in fresh]
+    over_temp = [d['cpu_temp'] for d in fresh if d['cpu_temp'] > cpu_temp_limit]
+
+    update = {
+        '$inc': {'ts_count': len(fresh), 'signal_sum': sum(signal), 'cpu_temp_count': len(over_temp)},
+        '$min': {'ts_min': min(ts), 'signal_min': min(signal)},
+        '$max': {'ts_max': max(ts), 'signal_max': max(signal)}
+    }
+    if over_temp:
+        update['$max']['cpu_temp_max'] = max(over_temp)
+
+    # Only while the summary is still as it was read
+    return {'ts_max': last if summary else {'$exists': False}}, update
+
+
+def update_health(db, docs, cpu_temp_limit=CPU_TEMP_LIMIT):
+    '''
+    Folds a batch of ingested documents into the health summaries, one update per device.
+    Safe to repeat with the same documents.
+    '''
+    by_id = defaultdict(list)
+    for doc in docs:
+        by_id[doc['id']].append(doc)
+
+    fold_once(db[HEALTH_COLLECTION], list(by_id.items()), lambda summary, device_docs: health_update(summary, device_docs, cpu_temp_limit), {'ts_max': 1})
+
+
+def backfill_health(db, cpu_temp_limit=CPU_TEMP_LIMIT, layout='documents'):
+    '''
+    Rebuilds the health summaries from everything already stored in layout (see buckets.py), server side.
+    '''
+    source, unwind = readings(db, layout)
+    over_temp = {'$gt': ['$cpu_temp', cpu_temp_limit]}
+
+    source.aggregate(unwind + [
+        {'$group': {
+            '_id': '$id',
+            'ts_min': {'$min': '$ts'},
+            'ts_max': {'$max': '$ts'},
+            'ts_count': {'$sum': 1},
+            'signal_min': {'$min': '$signal'},
+            'signal_max': {'$max': '$signal'},
+            'signal_sum': {'$sum': '$signal'},
+            'cpu_temp_count': {'$sum': {'$cond': [over_temp, 1, 0]}},
+            'cpu_temp_max': {'$max': {'$cond': [over_temp, '$cpu_temp', None]}}
+        }},
+        {'$merge': {'into': HEALTH_COLLECTION, 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+    ], allowDiskUse=True)
+
+    print(f'Backfilled health summaries for {db[HEALTH_COLLECTION].count_documents({})} devices')
@@ -0,0 +1,68 @@
+'''
+Writes that are safe to repeat.
+
+Kafka delivers at least once: a batch that was written but whose offsets weren't committed comes back,
+and a write that failed with AutoReconnect may have been applied anyway before it gets retried.
+So every write the consumer makes has to leave the same result however many times it's applied:
+
+    readings        inserted with a deterministic _id ({'id', 'ts'}), duplicate key errors are readings already stored
+    summaries       (health, rollups, buckets) read first, only the readings a document hasn't taken in yet are folded
+                    into it, and the update's filter checks the document is still as it was read. If another attempt
+                    got there first the upsert fails with a duplicate key, and that document is read and folded again.
+'''
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY = 11000
+
+
+def only_duplicates(error):
+    '''
+    Whether a BulkWriteError was nothing but duplicate keys, i.e. documents that are already there.
+    '''
+    details = error.details
+    return not details.get('writeConcernErrors') and all(e['code'] == DUPLICATE_KEY for e in details.get('writeErrors', []))
+
+
+def reading_id(doc):
+    return {'id': doc['id'], 'ts': doc['ts']}
+
+
+def key_of(_id):
+    return tuple(_id.values()) if isinstance(_id, dict) else _id
+
+
+def fold_once(coll, groups, update_for, projection, attempts=5):
+    '''
+    Folds each group of readings into its document exactly once.
+
+    groups is [(_id, docs)]. update_for(current, docs) gets the document as it is now (just the projection,
+    None if there isn't one) and returns (filter, update) for the readings it hasn't taken in, or None if
+    it has them all. The filter has to stop matching once the update has been applied.
+    '''
+    pending = {key_of(_id): (_id, docs) for _id, docs in groups}
+
+    for _ in range(attempts):
+        current = {key_of(d['_id']): d for d in coll.find({'_id': {'$in': [_id for _id, _ in pending.values()]}}, projection)}
+
+        keys, ops = [], []
+        for key, (_id, docs) in pending.items():
+            op = update_for(current.get(key), docs)
+            if op is not None:
+                keys.append(key)
+                ops.append(UpdateOne({'_id': _id, **op[0]}, op[1], upsert=True))
+
+        if not ops:
+            return
+
+        try:
+            coll.bulk_write(ops, ordered=False)
+            return
+        except BulkWriteError as e:
+            if not only_duplicates(e):
+                raise
+
+            # Changed since it was read: read those again and fold in whatever's still missing
+            pending = {keys[err['index']]: pending[keys[err['index']]] for err in e.details['writeErrors']}
+
+    raise RuntimeError(f'{coll.name}: {len(pending)} documents kept changing while being updated')
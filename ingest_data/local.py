@@ -0,0 +1,82 @@
+'''
+In-memory stand-in for KafkaConsumer, so the ingester can be run and tested without a broker.
+
+It reads the same {partition: [(key, value), ...]} layout that LocalProducer in
+generate_data/kafka_publisher.py keeps per topic, so the two can be wired together:
+
+    producer = LocalProducer()
+    publish_fleet(data_dir, producer)
+    consumer = LocalConsumer(producer.messages[TOPIC], topic=TOPIC)
+'''
+from collections import namedtuple
+
+TopicPartition = namedtuple('TopicPartition', ['topic', 'partition'])
+ConsumerRecord = namedtuple('ConsumerRecord', ['topic', 'partition', 'offset', 'key', 'value'])
+
+
+class LocalConsumer():
+    '''
+    Consumes every partition of one topic, with positions and committed offsets tracked like a
+    single member consumer group. Pass fail_commit_every=N to fail every Nth commit.
+    '''
+    def __init__(self, partitions, topic='raw-sensor-data', fail_commit_every=None):
+        self.topic = topic
+        self.partitions = {TopicPartition(topic, p): list(messages) for p, messages in partitions.items()}
+        self.positions = {tp: 0 for tp in self.partitions}
+        self.committed = {tp: 0 for tp in self.partitions}
+        self.fail_commit_every = fail_commit_every
+        self.commits = 0
+
+    def append(self, partition, key, value):
+        '''
+        Adds a message, as if a producer had just sent it.
+        '''
+        tp = TopicPartition(self.topic, partition)
+        self.partitions.setdefault(tp, []).append((key, value))
+        self.positions.setdefault(tp, 0)
+        self.committed.setdefault(tp, 0)
+
+    def poll(self, timeout_ms=0, max_records=500):
+        '''
+        Returns {TopicPartition: [ConsumerRecord, ...]} with at most max_records records in total.
+        '''
+        records = {}
+        remaining = max_records
+
+        for tp, messages in self.partitions.items():
+            start = self.positions[tp]
+            end = min(len(messages), start + remaining)
+            if end > start:
+                records[tp] = [ConsumerRecord(tp.topic, tp.partition, i, *messages[i]) for i in range(start, end)]
+                self.positions[tp] = end
+                remaining -= end - start
+
+            if not remaining:
+                break
+
+        return records
+
+    def commit(self):
+        self.commits += 1
+        if self.fail_commit_every and self.commits % self.fail_commit_every == 0:
+            raise RuntimeError('simulated commit failure')
+
+        self.committed.update(self.positions)
+
+    def seek_to_committed(self):
+        '''
+        Rewinds to the last commit, like a restarted consumer picking its partitions back up.
+        '''
+        self.positions.update(self.committed)
+
+    def assignment(self):
+        return set(self.partitions)
+
+    def position(self, tp):
+        return self.positions[tp]
+
+    def end_offsets(self, partitions):
+        return {tp: len(self.partitions[tp]) for tp in partitions}
+
+    def close(self):
+        pass
@@ -0,0 +1,124 @@
+'''
+Daily and weekly rollups of the hourly readings, maintained as readings are ingested.
+
+One document per device per day (readings-daily) or week starting Monday (readings-weekly):
+
+    _id             {'id': device id, 'ts': start of the day/week}
+    id, ts          same as in _id, so they can be queried/indexed like readings
+    count
+    t               seconds since ts of every reading taken in, so a re-delivered one isn't counted twice
+    <metric>_min, <metric>_max, <metric>_sum    for every metric
+
+Means are <metric>_sum / count. Keeping the sum rather than the mean means every update is just $inc/$min/$max
+(and a $push to t).
+'''
+from collections import defaultdict
+from datetime import timedelta
+from schema import METRICS, readings
+from idempotent import fold_once
+
+ROLLUPS = {
+    'daily': 'readings-daily',
+    'weekly': 'readings-weekly'
+}
+
+
+def bucket_start(ts, granularity):
+    day = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if granularity == 'weekly':
+        return day - timedelta(days=day.weekday())
+
+    return day
+
+
+def fresh_readings(current, docs, start):
+    '''
+    {seconds since start: doc} for the readings in docs that current (a rollup or day bucket, or None) hasn't taken in.
+    '''
+    seen = set(current.get('t', [])) if current else set()
+
+    fresh = {}
+    for doc in docs:
+        t = int((doc['ts'] - start).total_seconds())
+        if t not in seen:
+            fresh.setdefault(t, doc)
+
+    return fresh
+
+
+def rollup_update(rollup, docs, granularity):
+    '''
+    (filter, update) folding one device's readings for one day/week into its rollup, skipping the ones
+    it already has, or None if it has them all. rollup is the current document (at least t), or None.
+    '''
+    start = bucket_start(docs[0]['ts'], granularity)
+    fresh = fresh_readings(rollup, docs, start)
+    if not fresh:
+        return None
+
+    update = {
+        '$setOnInsert': {'id': docs[0]['id'], 'ts': start},
+        '$inc': {'count': len(fresh)},
+        '$push': {'t': {'$each': list(fresh)}},
+        '$min': {},
+        '$max': {}
+    }
+    for m in METRICS:
+        values = [d[m] for d in fresh.values()]
+        update['$inc'][m + '_sum'] = sum(values)
+        update['$min'][m + '_min'] = min(values)
+        update['$max'][m + '_max'] = max(values)
+
+    # Stops matching once these readings are in
+    return {'t': {'$nin': list(fresh)}}, update
+
+
+def update_rollups(db, docs):
+    '''
+    Folds a batch of ingested documents into every rollup, one update per device per day/week.
+    Safe to repeat with the same documents.
+    '''
+    for granularity, name in ROLLUPS.items():
+        buckets = defaultdict(list)
+        for doc in docs:
+            buckets[(doc['id'], bucket_start(doc['ts'], granularity))].append(doc)
+
+        groups = [({'id': device_id, 'ts': start}, bucket_docs) for (device_id, start), bucket_docs in buckets.items()]
+        fold_once(db[name], groups, lambda rollup, bucket_docs: rollup_update(rollup, bucket_docs, granularity), {'t': 1})
+
+
+def ensure_rollup_indexes(db):
+    for name in ROLLUPS.values():
+        db[name].create_index([('id', 1), ('ts', 1)])
+
+
+def backfill_rollups(db, layout='documents'):
+    '''
+    Rebuilds the rollups from everything already stored in layout (see buckets.py), server side.
+    Needs MongoDB 5.0+ for $dateTrunc.
+    '''
+    source, unwind = readings(db, layout)
+    units = {'daily': {'unit': 'day'}, 'weekly': {'unit': 'week', 'startOfWeek': 'monday'}}
+
+    for granularity, name in ROLLUPS.items():
+        start = {'$dateTrunc': {'date': '$ts', **units[granularity]}}
+        group = {
+            '_id': {'id': '$id', 'ts': start},
+            'count': {'$sum': 1},
+            't': {'$push': {'$dateDiff': {'startDate': start, 'endDate': '$ts', 'unit': 'second'}}}
+        }
+        for m in METRICS:
+            group[m + '_min'] = {'$min': '$' + m}
+            group[m + '_max'] = {'$max': '$' + m}
+            group[m + '_sum'] = {'$sum': '$' + m}
+
+        source.aggregate(unwind + [
+            {'$group': group},
+            {'$set': {'id': '$_id.id', 'ts': '$_id.ts'}},
+            {'$merge': {'into': name, 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ], allowDiskUse=True)
+
+        print(f'Backfilled {db[name].count_documents({})} {granularity} rollups')
+
+    ensure_rollup_indexes(db)
@@ -0,0 +1,145 @@
+'''
+The typed document schema for sensor readings in MongoDB.
+
+Readings used to land in Mongo exactly as the generator sent them: a str() of a dict of strings,
+so ids looked like '10.0', ts was a string that range queries compared lexicographically, and every
+reader had to run pd.to_numeric/pd.to_datetime over every row. Documents are now stored as
+
+    id          int
+    ts          BSON date
+    lumens, temp, cpu_temp, signal, charge      double
+'''
+import ast
+import json
+import struct
+from datetime import datetime as dt
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+DATABASE = 'sensordata'
+COLLECTION = 'raw-sensor-data'
+
+METRICS = ['lumens', 'temp', 'cpu_temp', 'signal', 'charge']
+
+# Where the readings are, by storage layout (see buckets.py)
+READING_COLLECTIONS = {
+    'documents': COLLECTION,
+    'timeseries': 'readings-ts',
+    'buckets': 'readings-buckets'
+}
+
+# Turns day buckets back into one document per reading, like MongoReader.UNWIND_BUCKETS
+UNWIND_BUCKETS = [
+    {'$unwind': {'path': '$t', 'includeArrayIndex': 'i'}},
+    {'$project': {
+        'id': 1,
+        'ts': {'$add': ['$ts', {'$multiply': ['$t', 1000]}]},
+        **{m: {'$arrayElemAt': ['$' + m, '$i']} for m in METRICS}
+    }}
+]
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# The struct serializer's record, see generate_data/kafka_publisher.py: id, ts (epoch seconds), then the metrics
+STRUCT_FORMAT = '<dqddddd'
+STRUCT_SIZE = struct.calcsize(STRUCT_FORMAT)
+
+VALIDATOR = {
+    '$jsonSchema': {
+        'bsonType': 'object',
+        'required': ['id', 'ts'] + METRICS,
+        'properties': {
+            'id': {'bsonType': 'int'},
+            'ts': {'bsonType': 'date'},
+            **{m: {'bsonType': 'double'} for m in METRICS}
+        }
+    }
+}
+
+
+def parse_message(value):
+    '''
+    Decodes a Kafka message value into a dict.
+
+    Handles every serializer in generate_data/kafka_publisher.py: JSON, the str(dict) repr the generator
+    has always sent (parsed with literal_eval, never eval), msgpack and fixed size struct records.
+    '''
+    if not value:
+        raise ValueError('empty message')
+
+    if isinstance(value, bytes) and not value.startswith(b'{'):
+        # A msgpack map of the 7 fields starts with a fixmap (0x80-0x8f) or map16 (0xde) marker
+        if value[0] in range(0x80, 0x90) or value[0] == 0xde:
+            if msgpack is None:
+                raise ValueError('msgpack message, but msgpack is not installed (pip install msgpack)')
+            return msgpack.unpackb(value)
+
+        if len(value) == STRUCT_SIZE:
+            return dict(zip(['id', 'ts'] + METRICS, struct.unpack(STRUCT_FORMAT, value)))
+
+    text = value.decode('utf-8') if isinstance(value, bytes) else value
+
+    if text.startswith('{"'):
+        return json.loads(text)
+
+    return ast.literal_eval(text)
+
+
+def to_document(record):
+    '''
+    Converts a parsed reading into a typed document. Raises ValueError/KeyError/TypeError if it can't.
+    '''
+    ts = record['ts']
+    if isinstance(ts, str):
+        ts = dt.strptime(ts, TS_FORMAT)
+    elif isinstance(ts, (int, float)):
+        ts = dt.utcfromtimestamp(ts)
+
+    doc = {
+        'id': int(float(record['id'])),
+        'ts': ts
+    }
+    for m in METRICS:
+        doc[m] = float(record[m])
+
+    return doc
+
+
+def readings(db, layout='documents'):
+    '''
+    The collection layout keeps the readings in, and the stages that start a pipeline over them one document per reading.
+    '''
+    return db[READING_COLLECTIONS[layout]], UNWIND_BUCKETS if layout == 'buckets' else []
+
+
+def ensure_collection(db, name=COLLECTION):
+    '''
+    Creates the collection with the schema validator, or adds the validator to an existing one.
+
+    validationLevel is moderate, so documents already stored as strings can still be updated/converted.
+    '''
+    if name in db.list_collection_names():
+        db.command('collMod', name, validator=VALIDATOR, validationLevel='moderate')
+    else:
+        db.create_collection(name, validator=VALIDATOR, validationLevel='moderate')
+
+    return db[name]
+
+
+def convert_collection(coll):
+    '''
+    Converts documents stored as strings to the typed schema, in place and server side.
+    '''
+    result = coll.update_many(
+        {'ts': {'$type': 'string'}},
+        [{'$set': {
+            'id': {'$toInt': {'$toDouble': '$id'}},
+            'ts': {'$dateFromString': {'dateString': '$ts', 'format': '%Y-%m-%d %H:%M:%S'}},
+            **{m: {'$toDouble': '$' + m} for m in METRICS}
+        }}]
+    )
+    print(f'Converted {result.modified_count} documents to the typed schema')
+
+    return result.modified_count
@@ -0,0 +1,91 @@
+'''
+The scripts import their siblings by bare name (from schema import ...), like they do when run from their
+own directory, so every script directory goes on sys.path.
+
+MongoDB is mongomock. Its bulk_write doesn't work with current pymongo, so the db fixtures swap in one
+that applies each UpdateOne in turn and reports duplicate keys the way a real unordered bulk_write does.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+'''
+import os
+import sys
+import mongomock
+import mongomock.collection
+import numpy as np
+import pandas as pd
+import pytest
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for name in ('generate_data', 'ingest_data', 'view_data'):
+    sys.path.insert(0, os.path.join(ROOT, name))
+
+
+def bulk_write(self, requests, ordered=True, **kwargs):
+    errors = []
+    for i, op in enumerate(requests):
+        try:
+            self.update_one(op._filter, op._doc, upsert=op._upsert)
+        except DuplicateKeyError:
+            errors.append({'index': i, 'code': 11000})
+            if ordered:
+                break
+
+    if errors:
+        raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': []})
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', bulk_write)
+
+    return mongomock.MongoClient()
+
+
+@pytest.fixture
+def db(client):
+    return client['sensordata']
+
+
+@pytest.fixture
+def reader(client, monkeypatch):
+    '''
+    A MongoReader on the mongomock client, reading the documents layout straight from MongoDB.
+    '''
+    import pymongo
+    from MongoReader import MongoReader
+
+    monkeypatch.setattr(pymongo, 'MongoClient', lambda *args, **kwargs: client)
+
+    return MongoReader(layout='documents', backend='mongo', explain=False, fan_out=False)
+
+
+def hourly_readings(ids, start, hours, seed=0):
+    '''
+    A DataFrame of readings (the COLUMNS of a stored document) for every device in ids, one an hour from start.
+    '''
+    rng = np.random.default_rng(seed)
+    ts = pd.date_range(start, periods=hours, freq='h')
+
+    frames = []
+    for i in ids:
+        frames.append(pd.DataFrame({
+            'id': float(i),
+            'ts': ts,
+            'lumens': rng.uniform(0, 100, hours),
+            'temp': rng.normal(60, 2, hours),
+            'cpu_temp': rng.uniform(100, 130, hours),
+            'signal': rng.uniform(-70, -50, hours),
+            'charge': rng.uniform(0, 1, hours)
+        }))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def documents(df):
+    '''
+    df's rows as documents in the typed schema (int id, datetime ts), the way the ingester stores them.
+    '''
+    return [{**row, 'id': int(row['id']), 'ts': row['ts'].to_pydatetime()} for row in df.to_dict('records')]
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import hourly_readings
+from detectors import DetectionEngine
+
+
+@pytest.fixture
+def frame():
+    '''
+    Six weeks of readings for 5 devices in the get_frame shape, with some readings missing,
+    device 2's cpu_temp stepping up and device 4 reporting a spike of lumens.
+    '''
+    df = hourly_readings(range(5), '2023-01-01', 24 * 42, seed=1)
+    df = df[np.random.default_rng(2).random(len(df)) > 0.02]
+
+    late = df['ts'] > pd.Timestamp('2023-01-30')
+    df.loc[(df['id'] == 2) & late, 'cpu_temp'] += 40
+    df.loc[(df['id'] == 4) & (df['ts'] == pd.Timestamp('2023-02-02 12:00')), 'lumens'] = 1000
+
+    return df.set_index('ts').sort_index()
+
+
+def assert_same_findings(engine, expected):
+    found, wanted = engine.findings(), expected.findings()
+
+    assert found.keys() == wanted.keys()
+    for name in wanted:
+        a = found[name].reset_index().sort_values(['id', 'metric'], ignore_index=True)
+        b = wanted[name].reset_index().sort_values(['id', 'metric'], ignore_index=True)
+
+        pd.testing.assert_frame_equal(a[['id', 'metric', 'first_alarm', 'alarms']], b[['id', 'metric', 'first_alarm', 'alarms']])
+        np.testing.assert_allclose(a['max_score'], b['max_score'])
+
+
+def test_finds_the_anomalies(frame):
+    engine = DetectionEngine()
+    engine.update(frame)
+
+    findings = engine.findings()
+    assert any(((t.index == 2) & (t['metric'] == 'cpu_temp')).any() for t in findings.values())
+    assert any(((t.index == 4) & (t['metric'] == 'lumens')).any() for t in findings.values())
+
+
+def test_incremental_updates_match_one_update(frame):
+    once = DetectionEngine()
+    once.update(frame)
+
+    engine = DetectionEngine(block_size=2)
+    for cut in ('2023-01-10', '2023-01-10 07:00', '2023-01-29', '2023-02-12'):
+        engine.update(frame[frame.index < pd.Timestamp(cut)])
+
+    # Everything it's had already is skipped
+    assert engine.update(frame[frame.index < pd.Timestamp('2023-01-29')]) == 0
+
+    assert_same_findings(engine, once)
+
+
+def test_readings_arriving_late_are_scored(frame):
+    once = DetectionEngine()
+    once.update(frame)
+
+    # Device 3 is behind the rest, and device 4 only turns up later
+    behind = ((frame['id'] == 3) & (frame.index >= pd.Timestamp('2023-01-20'))) | (frame['id'] == 4)
+
+    engine = DetectionEngine(block_size=2)
+    engine.update(frame[~behind])
+    engine.update(frame)
+
+    assert_same_findings(engine, once)
+
+
+def test_since_and_save_round_trip(frame, tmp_path):
+    engine = DetectionEngine()
+    engine.update(frame[frame['id'] != 4])
+
+    since = engine.since([0, 4])
+    assert since[0] == frame.index[frame['id'] == 0].max() + pd.Timedelta(hours=1)
+    assert since[4] is None
+
+    path = str(tmp_path / 'engine.npz')
+    engine.save(path)
+
+    loaded = DetectionEngine()
+    assert loaded.load(path)
+    assert loaded.since([0, 4]) == since
+
+    loaded.update(frame)
+    engine.update(frame)
+    assert_same_findings(loaded, engine)
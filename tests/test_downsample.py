@@ -0,0 +1,44 @@
+import numpy as np
+from downsample import lttb_indices, minmax_indices
+
+
+def test_minmax_keeps_every_buckets_extremes():
+    rng = np.random.default_rng(0)
+    y = rng.normal(size=1000)
+    y[437] = 50
+    y[802] = -50
+
+    kept = minmax_indices(y, 100)
+
+    assert (np.diff(kept) > 0).all()
+    assert len(kept) <= 200
+    assert {437, 802} <= set(kept)
+
+    bucket = np.arange(len(y)) * 100 // len(y)
+    for b in range(100):
+        members = np.flatnonzero(bucket == b)
+        assert y[members].min() in y[kept] and y[members].max() in y[kept]
+
+
+def test_minmax_short_series_is_untouched():
+    np.testing.assert_array_equal(minmax_indices(np.arange(10.0), 5), np.arange(10))
+
+
+def test_lttb_keeps_ends_and_spikes():
+    x = np.arange(2000, dtype=float)
+    y = np.sin(x / 100)
+    y[1234] = 10
+
+    kept = lttb_indices(x, y, 200)
+
+    assert len(kept) == 200
+    assert kept[0] == 0 and kept[-1] == len(x) - 1
+    assert (np.diff(kept) > 0).all()
+    assert 1234 in kept
+
+
+def test_lttb_short_series_is_untouched():
+    x = np.arange(50, dtype=float)
+
+    np.testing.assert_array_equal(lttb_indices(x, x, 100), np.arange(50))
+    np.testing.assert_array_equal(lttb_indices(x, x, 2), np.arange(50))
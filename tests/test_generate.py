@@ -0,0 +1,30 @@
+import numpy as np
+from failures import FAILURE_MODES, assign_failures
+
+
+def test_assign_failures_one_per_device():
+    assigned = assign_failures(list(range(100)), np.random.default_rng(0))
+
+    assert len(assigned) == sum(mode['count'] for mode in FAILURE_MODES.values())
+    for name, mode in FAILURE_MODES.items():
+        assert list(assigned.values()).count(name) == mode['count']
+
+    assert assign_failures(list(range(100)), np.random.default_rng(0)) == assigned
+
+
+def test_assign_failures_small_fleet():
+    assigned = assign_failures(list(range(12)), np.random.default_rng(0))
+
+    assert sorted(assigned) == list(range(12))
+    assert list(assigned.values()).count('battery') == FAILURE_MODES['battery']['count']
+
+
+def test_same_seed_same_fleet():
+    from data_generator import device_attributes
+
+    fleet = [device_attributes(7, i) for i in range(20)]
+
+    assert fleet == [device_attributes(7, i) for i in range(20)]
+    assert fleet != [device_attributes(8, i) for i in range(20)]
+    assert {a['location_type'] for a in fleet} == {'indoor', 'outdoor'}
+    assert all(-67 <= a['base_signal'] <= -50 for a in fleet)
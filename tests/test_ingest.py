@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+import pandas as pd
+import pytest
+from conftest import hourly_readings, documents
+from kafka_publisher import LocalProducer, SERIALIZERS, serialize_json, TOPIC
+from local import LocalConsumer
+from consumer import Ingester, LAYOUTS
+from health import HEALTH_COLLECTION, health_update, update_health
+from rollups import ROLLUPS, bucket_start, rollup_update, update_rollups
+from schema import METRICS, parse_message, to_document
+
+
+@pytest.mark.parametrize('serializer', SERIALIZERS)
+def test_every_wire_format_parses_back_to_the_same_documents(serializer):
+    df = hourly_readings([3, 250], '2023-01-01 05:00', 30)
+
+    parsed = [to_document(parse_message(value)) for value in SERIALIZERS[serializer](df)]
+
+    assert parsed == documents(df)
+
+
+@pytest.mark.parametrize('value', [b'', b'{"id": 1}', b'not a reading', b'\x00' * 10, "{'id': '1', 'ts': 'yesterday'}"])
+def test_bad_messages_are_rejected(value):
+    # The exceptions Ingester.add counts as rejected instead of failing the batch
+    with pytest.raises((ValueError, KeyError, TypeError, SyntaxError)):
+        to_document(parse_message(value))
+
+
+def reading(hour, cpu_temp=110.0, signal=-60.0):
+    return {'id': 1, 'ts': datetime(2023, 1, 2) + timedelta(hours=hour), 'lumens': 1.0, 'temp': 60.0,
+            'cpu_temp': cpu_temp, 'signal': signal, 'charge': 0.5}
+
+
+def test_health_update_folds_new_readings():
+    docs = [reading(0, signal=-60), reading(1, cpu_temp=125, signal=-50), reading(2, cpu_temp=130, signal=-70)]
+
+    query, update = health_update(None, docs, cpu_temp_limit=122)
+
+    assert query == {'ts_max': {'$exists': False}}
+    assert update['$inc'] == {'ts_count': 3, 'signal_sum': -180, 'cpu_temp_count': 2}
+    assert update['$min'] == {'ts_min': docs[0]['ts'], 'signal_min': -70}
+    assert update['$max'] == {'ts_max': docs[2]['ts'], 'signal_max': -50, 'cpu_temp_max': 130}
+
+
+def test_health_update_skips_readings_it_has():
+    docs = [reading(0), reading(1), reading(2, cpu_temp=100)]
+
+    query, update = health_update({'ts_max': docs[1]['ts']}, docs)
+
+    assert query == {'ts_max': docs[1]['ts']}
+    assert update['$inc'] == {'ts_count': 1, 'signal_sum': -60, 'cpu_temp_count': 0}
+    assert 'cpu_temp_max' not in update['$max']
+
+    assert health_update({'ts_max': docs[2]['ts']}, docs) is None
+
+
+def test_rollup_update_skips_readings_it_has():
+    docs = [reading(0), reading(1), reading(1), reading(5)]
+    docs[1]['lumens'] = 3.0
+
+    query, update = rollup_update({'t': [0]}, docs, 'daily')
+
+    assert query == {'t': {'$nin': [3600, 18000]}}
+    assert update['$setOnInsert'] == {'id': 1, 'ts': datetime(2023, 1, 2)}
+    assert update['$inc']['count'] == 2
+    assert update['$push'] == {'t': {'$each': [3600, 18000]}}
+    assert update['$inc']['lumens_sum'] == 4.0
+    assert update['$max']['lumens_max'] == 3.0
+
+    assert rollup_update({'t': [0, 3600, 18000]}, docs, 'daily') is None
+
+
+def test_weekly_buckets_start_on_monday():
+    assert bucket_start(datetime(2023, 1, 8, 13), 'weekly') == datetime(2023, 1, 2)
+    assert bucket_start(datetime(2023, 1, 8, 13), 'daily') == datetime(2023, 1, 8)
+
+
+def expected_health(df, cpu_temp_limit=122):
+    return {
+        int(i): (len(g), pytest.approx(g['signal'].sum()), int((g['cpu_temp'] > cpu_temp_limit).sum()), g['ts'].max())
+        for i, g in df.groupby('id')
+    }
+
+
+def stored_health(db):
+    return {d['_id']: (d['ts_count'], d['signal_sum'], d['cpu_temp_count'], d['ts_max']) for d in db[HEALTH_COLLECTION].find()}
+
+
+def test_summaries_take_each_reading_once(db):
+    df = hourly_readings([1, 2, 3], '2023-01-01', 24 * 9)
+    docs = documents(df)
+
+    # Overlapping, repeated batches, like re-deliveries after a failed commit
+    for batch in (docs[:300], docs[200:500], docs[:300], docs[400:], docs):
+        update_health(db, batch)
+        update_rollups(db, batch)
+
+    assert stored_health(db) == expected_health(df)
+
+    for granularity, name in ROLLUPS.items():
+        rollups = list(db[name].find())
+        start = df['ts'].dt.to_period('W' if granularity == 'weekly' else 'D').dt.start_time
+        expected = df.groupby(['id', start])
+
+        assert len(rollups) == expected.ngroups
+        assert sum(r['count'] for r in rollups) == len(df)
+        for m in METRICS:
+            assert sum(r[m + '_sum'] for r in rollups) == pytest.approx(df[m].sum())
+            assert max(r[m + '_max'] for r in rollups) == df[m].max()
+
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_ingester_stores_each_reading_once(db, layout):
+    df = hourly_readings([1, 2, 3, 4], '2023-01-01', 80)
+
+    producer = LocalProducer(partitions=2)
+    for key, value in zip(df['id'].astype(int).astype(str).str.encode('utf-8'), serialize_json(df)):
+        producer.send(TOPIC, key=key, value=value)
+
+    # A producer retry sends one twice
+    partition = next(iter(producer.messages[TOPIC].values()))
+    partition.append(partition[3])
+
+    # Every third commit fails, so batches are written again after rewinding to the last commit
+    consumer = LocalConsumer(producer.messages[TOPIC], topic=TOPIC, fail_commit_every=3)
+    ingester = Ingester(consumer, db, batch_size=50, max_wait=0, layout=layout)
+
+    for _ in range(10):
+        try:
+            ingester.run(poll_timeout_ms=0, stop_when_idle=True)
+            break
+        except RuntimeError:
+            ingester.batch, ingester.oldest = [], None
+            consumer.seek_to_committed()
+
+    if layout == 'buckets':
+        stored = sum(len(b['t']) for b in db['readings-buckets'].find())
+    else:
+        stored = ingester.coll.count_documents({})
+
+    assert stored == len(df)
+    assert stored_health(db) == expected_health(df)
+    assert sum(r['count'] for r in db[ROLLUPS['daily']].find()) == len(df)
+    assert sum(r['count'] for r in db[ROLLUPS['weekly']].find()) == len(df)
@@ -0,0 +1,116 @@
+import pandas as pd
+import pytest
+from conftest import hourly_readings, documents
+from live import EPOCH, LiveFeed, Subscription
+
+
+@pytest.fixture
+def feed(reader, monkeypatch):
+    '''
+    A polling feed whose background thread only says it's following, so the tests poll it themselves.
+    '''
+    monkeypatch.setattr(LiveFeed, 'run', lambda self: self.following.set())
+
+    return LiveFeed(reader, source='poll')
+
+
+def poll(feed):
+    with feed.lock:
+        subs = list(feed.subscriptions)
+    df = feed.poll(subs)
+    feed.publish(df, 'poll')
+
+    return df
+
+
+def test_subscribers_follow_from_each_devices_latest_reading(reader, feed):
+    reader.coll.insert_many(documents(hourly_readings([1], '2023-01-01', 48)))
+    reader.coll.insert_many(documents(hourly_readings([2], '2023-01-01', 24)))
+
+    sub = feed.subscribe([1, 2, 3], {})
+    assert sub.since == {1: pd.Timestamp('2023-01-02 23:00'), 2: pd.Timestamp('2023-01-01 23:00')}
+
+    # Device 2 is a day behind device 1, and device 3 has no readings yet
+    new = pd.concat([
+        hourly_readings([1], '2023-01-03', 3, seed=1),
+        hourly_readings([2], '2023-01-02', 2, seed=2),
+        hourly_readings([3], '2023-01-03 01:00', 1, seed=3)
+    ])
+    reader.coll.insert_many(documents(new))
+
+    polled = poll(feed)
+    assert len(polled) == len(new)
+    assert polled['ts'].is_monotonic_increasing
+
+    drained = sub.drain()
+    assert sorted(zip(drained['id'], drained['ts'])) == sorted(zip(new['id'], new['ts']))
+    assert sub.since[3] == pd.Timestamp('2023-01-03 01:00')
+
+    # Nothing new since
+    poll(feed)
+    assert sub.drain() is None
+
+
+def test_poll_starts_from_the_furthest_behind_subscriber(reader, feed):
+    reader.coll.insert_many(documents(hourly_readings([1], '2023-01-01', 10)))
+
+    ahead = Subscription([1], {1: pd.Timestamp('2023-01-01 07:00')})
+    behind = Subscription([1], {1: pd.Timestamp('2023-01-01 03:00')})
+    for sub in (ahead, behind):
+        sub.catch_up(pd.DataFrame(columns=['id', 'ts']))
+
+    polled = feed.poll([ahead, behind])
+    assert polled['ts'].min() == pd.Timestamp('2023-01-01 04:00')
+
+    # Each gets only what it doesn't have
+    for sub in (ahead, behind):
+        sub.offer(polled)
+    assert list(ahead.drain()['ts']) == list(pd.date_range('2023-01-01 08:00', periods=2, freq='h'))
+    assert list(behind.drain()['ts']) == list(pd.date_range('2023-01-01 04:00', periods=6, freq='h'))
+
+    assert feed.poll([ahead]).empty
+
+
+def test_subscribe_catches_up_with_readings_after_the_window(reader, feed):
+    reader.coll.insert_many(documents(hourly_readings([1, 2], '2023-01-01', 10)))
+    window_end = {1: pd.Timestamp('2023-01-01 09:00'), 2: pd.Timestamp('2023-01-01 09:00')}
+
+    # Inserted after the chart read its window, before it subscribed
+    gap = hourly_readings([1, 2], '2023-01-01 10:00', 2, seed=1)
+    reader.coll.insert_many(documents(gap))
+
+    sub = feed.subscribe([1, 2], window_end)
+
+    drained = sub.drain()
+    assert sorted(zip(drained['id'], drained['ts'])) == sorted(zip(gap['id'], gap['ts']))
+    assert drained['ts'].is_monotonic_increasing
+
+
+def test_readings_offered_while_catching_up_are_held():
+    sub = Subscription([1], {1: pd.Timestamp('2023-01-01 00:00')})
+    readings = hourly_readings([1], '2023-01-01 01:00', 6)
+
+    # The feed delivers the newest ones before the catch up query (which overlaps them) comes back
+    sub.offer(readings.iloc[4:])
+    assert sub.drain() is None
+
+    sub.catch_up(readings.iloc[:5])
+    assert list(sub.drain()['ts']) == list(readings['ts'])
+
+    sub.offer(hourly_readings([1], '2023-01-01 07:00', 1))
+    assert list(sub.drain()['ts']) == [pd.Timestamp('2023-01-01 07:00')]
+
+
+def test_offer_drops_what_a_subscriber_has():
+    sub = Subscription([1, 2], {1: pd.Timestamp('2023-01-01 05:00')})
+    sub.catch_up(pd.DataFrame(columns=['id', 'ts']))
+    df = hourly_readings([1, 2, 3], '2023-01-01 04:00', 3)
+
+    sub.offer(df)
+    drained = sub.drain()
+
+    assert sorted(zip(drained['id'], drained['ts'])) == [
+        (1.0, pd.Timestamp('2023-01-01 06:00')),
+        (2.0, pd.Timestamp('2023-01-01 04:00')), (2.0, pd.Timestamp('2023-01-01 05:00')), (2.0, pd.Timestamp('2023-01-01 06:00'))
+    ]
+    assert sub.since.get(3, EPOCH) == EPOCH
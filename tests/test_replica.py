@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import hourly_readings, documents
+from replica import Replica, TS_DTYPE, VALUE_DTYPE
+
+
+@pytest.fixture
+def readings(reader):
+    df = hourly_readings([1, 2, 3], '2023-01-01', 100)
+    reader.coll.insert_many(documents(df))
+
+    return df
+
+
+def assert_replica_matches(replica, df):
+    for i, expected in df.groupby('id'):
+        ts, values = replica.arrays(int(i))
+
+        np.testing.assert_array_equal(ts, expected['ts'].to_numpy(dtype=TS_DTYPE))
+        for c in replica.columns:
+            np.testing.assert_allclose(values[c], expected[c].to_numpy())
+
+
+def test_sync_appends_only_new_readings(reader, readings, tmp_path):
+    replica = Replica(str(tmp_path))
+    assert replica.sync(reader) == len(readings)
+    assert_replica_matches(replica, readings)
+
+    newer = hourly_readings([1, 2, 3], '2023-01-05 04:00', 20, seed=1)
+    reader.coll.insert_many(documents(newer))
+
+    # A second Replica on the same directory, like another process reading it, sees the sync too
+    other = Replica(str(tmp_path))
+    assert replica.sync(reader) == len(newer)
+    other.refresh()
+
+    both = pd.concat([readings, newer])
+    assert_replica_matches(replica, both)
+    assert_replica_matches(other, both)
+    assert other.watermark(1) == newer['ts'].max()
+
+    assert replica.sync(reader) == 0
+
+
+def test_sync_cuts_off_what_a_failed_sync_left(reader, readings, tmp_path):
+    replica = Replica(str(tmp_path))
+    replica.sync(reader)
+
+    # A sync that died after appending but before writing the manifest
+    for name, dtype in [('ts', TS_DTYPE)] + [(c, VALUE_DTYPE) for c in replica.columns]:
+        with open(os.path.join(replica.device_dir(2), f'{name}.bin'), 'ab') as f:
+            np.zeros(7, dtype=dtype).tofile(f)
+
+    newer = hourly_readings([2], '2023-01-05 04:00', 5, seed=1)
+    reader.coll.insert_many(documents(newer))
+    replica.sync(reader)
+
+    assert_replica_matches(replica, pd.concat([readings, newer]))
+    assert os.path.getsize(os.path.join(replica.device_dir(2), 'ts.bin')) == replica.rows(2) * TS_DTYPE.itemsize
+
+
+def test_fetch_rows_matches_the_reader(reader, readings, tmp_path):
+    replica = Replica(str(tmp_path))
+    replica.sync(reader)
+
+    dates = (pd.Timestamp('2023-01-02').to_pydatetime(), pd.Timestamp('2023-01-03 12:00').to_pydatetime())
+    expected = reader.fetch_rows(dates, [1, 3])
+    rows = replica.fetch_rows(dates, [1, 3])
+
+    pd.testing.assert_frame_equal(rows, expected[rows.columns], check_dtype=False, check_index_type=False)
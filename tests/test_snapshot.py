@@ -0,0 +1,75 @@
+import os
+import shutil
+import pandas as pd
+import pytest
+from conftest import hourly_readings, documents
+from detectors import DetectionEngine
+from health import update_health
+from snapshot import INDEX_FILE, load_snapshot, read_index, save_snapshot
+
+pytest.importorskip('pyarrow')
+
+
+@pytest.fixture
+def tables():
+    return {
+        'missing_records': pd.DataFrame({'id': [1, 2], 'missing': [3, 0]}),
+        'cpu_overtemp': pd.DataFrame({'id': [2], 'cpu_temp_max': [130.5]})
+    }
+
+
+def ingest(reader, df):
+    docs = documents(df)
+    reader.coll.insert_many([dict(d) for d in docs])
+    update_health(reader.db, docs)
+
+
+def test_snapshot_is_reused_until_the_data_changes(reader, tables, tmp_path):
+    ingest(reader, hourly_readings([1, 2], '2023-01-01', 48))
+    watermark = reader.get_watermark()
+
+    assert save_snapshot(tables, watermark, path=str(tmp_path))
+
+    loaded = load_snapshot(reader.get_watermark(), path=str(tmp_path))
+    assert loaded.keys() == tables.keys()
+    for name in tables:
+        pd.testing.assert_frame_equal(loaded[name], tables[name])
+
+    ingest(reader, hourly_readings([1], '2023-01-03', 1, seed=1))
+    assert reader.get_watermark() != watermark
+    assert load_snapshot(reader.get_watermark(), path=str(tmp_path)) is None
+
+
+def test_engine_state_is_restored_even_when_out_of_date(tables, tmp_path):
+    engine = DetectionEngine()
+    engine.update(hourly_readings([1, 2], '2023-01-01', 48).set_index('ts'))
+    save_snapshot(tables, {'documents': 96}, engine, path=str(tmp_path))
+
+    restored = DetectionEngine()
+    assert load_snapshot({'documents': 97}, restored, path=str(tmp_path)) is None
+    assert restored.since([1, 2]) == engine.since([1, 2])
+
+
+def test_failed_save_keeps_the_previous_snapshot(tables, tmp_path, monkeypatch):
+    path = str(tmp_path)
+    first = save_snapshot(tables, {'documents': 1}, path=path)
+
+    def fail(self, *args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(pd.DataFrame, 'to_parquet', fail)
+    assert save_snapshot(tables, {'documents': 2}, path=path) is None
+    monkeypatch.undo()
+
+    # Nothing half written is left, and the last good snapshot is still the one used
+    assert sorted(os.listdir(path)) == sorted([INDEX_FILE, os.path.basename(first)])
+    assert read_index(path)['watermark'] == {'documents': 1}
+    assert load_snapshot({'documents': 1}, path=path) is not None
+
+
+def test_snapshot_deleted_under_the_index_is_a_miss(tables, tmp_path):
+    version_dir = save_snapshot(tables, {'documents': 1}, path=str(tmp_path))
+    shutil.rmtree(version_dir)
+
+    assert load_snapshot({'documents': 1}, path=str(tmp_path)) is None
+    assert load_snapshot({'documents': 1}, path=str(tmp_path / 'nothing here')) is None
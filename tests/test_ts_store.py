@@ -0,0 +1,33 @@
+import pandas as pd
+from conftest import hourly_readings
+from ts_store import TimeSeriesStore
+
+
+def test_only_missing_chunks_are_fetched():
+    df = hourly_readings([1, 2, 3], '2023-01-01', 24 * 120).set_index('ts')
+    calls = []
+
+    def fetch(dates, ids):
+        calls.append((pd.Timestamp(dates[0]), pd.Timestamp(dates[1]), ids))
+        return df[(df.index >= dates[0]) & (df.index < dates[1]) & df['id'].isin(ids)]
+
+    store = TimeSeriesStore(fetch)
+    window = (pd.Timestamp('2023-01-01'), pd.Timestamp('2023-03-01'))
+
+    store.get_frame(window, [1, 2])
+    assert calls == [(pd.Timestamp('2023-01-01'), pd.Timestamp('2023-03-01'), [1, 2])]
+
+    # Device 3 is missing both months, device 1 only March: not the whole 3 devices x 3 months
+    calls.clear()
+    frame = store.get_frame((pd.Timestamp('2023-01-01'), pd.Timestamp('2023-04-01')), [1, 3])
+    assert calls == [
+        (pd.Timestamp('2023-01-01'), pd.Timestamp('2023-03-01'), [3]),
+        (pd.Timestamp('2023-03-01'), pd.Timestamp('2023-04-01'), [1, 3])
+    ]
+
+    expected = df[(df.index < '2023-04-01') & df['id'].isin([1, 3])]
+    assert sorted(zip(frame['id'], frame.index)) == sorted(zip(expected['id'], expected.index))
+
+    calls.clear()
+    store.get_frame(window, [1, 2, 3])
+    assert calls == []
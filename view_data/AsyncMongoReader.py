@@ -0,0 +1,71 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+from MongoReader import CANCEL, QueryCancelled
+
+# pymongo is blocking, so queries run here instead of on Panel's event loop.
+# One pool for the whole process, shared by every session.
+EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix='mongo')
+
+
+class AsyncMongoReader():
+    '''
+    asyncio front end for blocking work (MongoReader queries, or anything that makes them) that Panel callbacks can await.
+
+    Calls run on a shared thread pool, so a slow query doesn't freeze every widget and session on the server.
+    Calls made with a key supersede each other: starting a new call with the same key cancels the
+    one still running - it stops at its next cursor batch (see MongoReader.CANCEL) rather than
+    running to completion for a result nobody will see.
+    '''
+    def __init__(self, reader, executor=EXECUTOR):
+        self.reader = reader
+        self.executor = executor
+        self.running = {}
+
+    async def run(self, fn, *args, key=None, **kwargs):
+        '''
+        Runs fn(*args, **kwargs) on the thread pool. Raises asyncio.CancelledError if superseded by a newer call with the same key.
+        '''
+        cancel = threading.Event()
+
+        if key is not None:
+            previous = self.running.get(key)
+            if previous is not None:
+                previous.set()
+            self.running[key] = cancel
+
+        def call():
+            CANCEL.set(cancel)
+            return fn(*args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        try:
+            # copy_context so the CANCEL set in the worker thread doesn't leak into other calls
+            future = loop.run_in_executor(self.executor, partial(copy_context().run, call))
+
+            try:
+                result = await future
+            except asyncio.CancelledError:
+                cancel.set()
+                raise
+            except QueryCancelled:
+                raise asyncio.CancelledError(f'Superseded call for {key}')
+
+            if cancel.is_set():
+                raise asyncio.CancelledError(f'Superseded call for {key}')
+
+            return result
+        finally:
+            if key is not None and self.running.get(key) is cancel:
+                del self.running[key]
+
+    async def fetch_rows(self, dates, ids, resolution='hourly', key=None):
+        return await self.run(self.reader.fetch_rows, dates, ids, resolution, key=key)
+
+    async def get_health_summaries(self):
+        return await self.run(self.reader.get_health_summaries)
+
+    async def get_device_summaries(self, cpu_temp_limit=122):
+        return await self.run(self.reader.get_device_summaries, cpu_temp_limit)
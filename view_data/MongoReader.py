@@ -1,98 +1,627 @@
+import os
+import time
+import logging
+import argparse
+import threading
 import pandas as pd
+import numpy as np
 import pymongo
-from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from itertools import chain, islice
+from datetime import timedelta
+from metrics import histogram, counter
+from replica import Replica
+
+log = logging.getLogger(__name__)
+
+# Fields every reading has. Anything else on a document (_id, the old CSV index columns) is ignored.
+COLUMNS = ['id', 'ts', 'lumens', 'temp', 'cpu_temp', 'signal', 'charge']
+NUMERIC_COLUMNS = [c for c in COLUMNS if c != 'ts']
+METRICS = [c for c in NUMERIC_COLUMNS if c != 'id']
+
+# The readings at each resolution, finest first: (name, hours each row covers, collection).
+# The rollups are maintained by the ingest consumer (ingest_data/rollups.py).
+RESOLUTIONS = [
+    ('hourly', 1, 'raw-sensor-data'),
+    ('daily', 24, 'readings-daily'),
+    ('weekly', 168, 'readings-weekly')
+]
+
+# Where the hourly readings are, by storage layout (see ingest_data/buckets.py)
+LAYOUTS = {
+    'documents': 'raw-sensor-data',
+    'timeseries': 'readings-ts',
+    'buckets': 'readings-buckets'
+}
+
+QUERY_SECONDS = histogram('mongoreader_query_seconds', 'Wall time of MongoReader queries, by operation and layout')
+CURSOR_SECONDS = histogram('mongoreader_cursor_seconds', 'Time reading and decoding a batch of documents off the cursor')
+FRAME_SECONDS = histogram('mongoreader_frame_build_seconds', 'Time building a DataFrame from a decoded batch')
+ROWS = counter('mongoreader_rows_total', 'Readings returned, by layout')
+
+# A day bucket holds the device's readings for [ts, ts + BUCKET_SPAN), t being seconds since ts
+BUCKET_SPAN = timedelta(days=1)
+BUCKET_PROJECTION = {'_id': 0, 'id': 1, 'ts': 1, 't': 1, **{m: 1 for m in METRICS}}
+
+# Turns day buckets back into one document per reading, for aggregations written against readings
+UNWIND_BUCKETS = [
+    {'$unwind': {'path': '$t', 'includeArrayIndex': 'i'}},
+    {'$project': {
+        'id': 1,
+        'ts': {'$add': ['$ts', {'$multiply': ['$t', 1000]}]},
+        **{m: {'$arrayElemAt': ['$' + m, '$i']} for m in METRICS}
+    }}
+]
+
+TS_OPS = {'$gte': np.greater_equal, '$gt': np.greater, '$lte': np.less_equal, '$lt': np.less}
+
+# A threading.Event that, once set, stops any query running in this context at its next batch.
+# Set by AsyncMongoReader so a superseded dashboard query stops instead of running to completion.
+CANCEL = ContextVar('cancel', default=None)
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+# Only fetch the fields that get used, not _id or anything else on the documents
+PROJECTION = {'_id': 0, **{c: 1 for c in COLUMNS}}
+
+# Indexes the reader's queries depend on, by collection.
+# get_rows/fetch_rows filter on id $in + a ts range, get_rows_tst on id alone - (id, ts) covers both.
+INDEXES = {
+    'raw-sensor-data': [[('id', 1), ('ts', 1)]],
+    'readings-daily': [[('id', 1), ('ts', 1)]],
+    'readings-weekly': [[('id', 1), ('ts', 1)]],
+    'readings-buckets': [[('id', 1), ('ts', 1)]]
+}
+
 
 class MongoReader():
-    def __init__(self):
-        self.client = pymongo.MongoClient()
+    def __init__(self, batch_size=10000, ensure_indexes=False, explain=None, fan_out=None, max_concurrency=8, layout=None, backend=None):
+        '''
+        ensure_indexes: create the indexes in INDEXES. Off by default, since that's a round trip per index every
+            time a reader is made: create them once with `python MongoReader.py --ensure-indexes` instead.
+        explain: check the plan of every query and warn about collection scans.
+            Defaults to the MONGOREADER_EXPLAIN environment variable, since it costs an extra round trip per query.
+        fan_out: split hourly queries into one per 'device' or per 'month' (device and month), run up to
+            max_concurrency at once. A single cursor streams its batches one round trip at a time, so for
+            multi device selections several cursors get the data back faster.
+            Defaults to the MONGOREADER_FAN_OUT environment variable, off if it isn't set.
+        layout: how the readings are stored, a key of LAYOUTS.
+            Defaults to the MONGOREADER_LAYOUT environment variable, or 'documents'.
+        backend: 'mongo', or 'replica' to serve hourly rows (get_rows, fetch_rows, get_all_rows, get_rows_tst)
+            from the local memory mapped replica (see replica.py) instead. Summaries and rollups still come from MongoDB.
+            Defaults to the MONGOREADER_BACKEND environment variable, or 'mongo'.
+        '''
+        self.fan_out = os.environ.get('MONGOREADER_FAN_OUT') if fan_out is None else fan_out
+        self.max_concurrency = max_concurrency
+
+        # The client's connection pool has to be at least as big as the fan out, or queries just queue for a connection
+        self.client = pymongo.MongoClient(maxPoolSize=max(100, max_concurrency))
         self.db = self.client['sensordata']
-        self.coll = self.db['raw-sensor-data']
+        self.layout = layout or os.environ.get('MONGOREADER_LAYOUT', 'documents')
+        self.coll = self.db[LAYOUTS[self.layout]]
+        self.health = self.db['device-health']
+        self.batch_size = batch_size
+
+        self.backend = backend or os.environ.get('MONGOREADER_BACKEND', 'mongo')
+        self.replica = Replica() if self.backend == 'replica' else None
+
+        self.explain = bool(os.environ.get('MONGOREADER_EXPLAIN')) if explain is None else explain
+        self.collscans = []
+
+        if ensure_indexes:
+            self.ensure_indexes()
+
+    @property
+    def source(self):
+        '''
+        Where hourly rows are read from, for labelling metrics: the layout, or 'replica'.
+        '''
+        return 'replica' if self.replica is not None else self.layout
+
+    def ensure_indexes(self):
+        '''
+        Creates the indexes in INDEXES. Does nothing for ones that already exist.
+        '''
+        for name, indexes in INDEXES.items():
+            for keys in indexes:
+                self.db[name].create_index(keys)
+
+    def check_plan(self, coll, query, projection=None):
+        '''
+        Explains a query and warns if the winning plan scans the whole collection.
+        Queries that do are kept in self.collscans.
+        '''
+        plan = coll.find(query, projection).explain()
+        stages = plan_stages(plan.get('queryPlanner', {}).get('winningPlan', {}))
+
+        if 'COLLSCAN' in stages:
+            log.warning('COLLSCAN on %s for query %s (plan: %s)', coll.name, query, ' <- '.join(stages))
+            self.collscans.append((coll.name, query))
+
+        return stages
+
+    def iter_chunks(self, query, batch_size=None, limit=0):
+        '''
+        Streams the results of a query as DataFrames of at most batch_size rows.
+
+        Each document's values are copied into per-column arrays as the cursor is read, so only one
+        batch is held at a time rather than a list of every document.
+
+        Documents in the typed schema (int id, date ts, double metrics - see ingest_data/schema.py)
+        go straight into float64/datetime64 arrays. Older documents stored as strings still work,
+        but pay for parsing every value.
+
+        Raises QueryCancelled (and closes the server cursor) if the CANCEL event gets set.
+        '''
+        batch_size = batch_size or self.batch_size
+
+        if self.layout == 'buckets':
+            yield from self.iter_buckets(query, batch_size, limit)
+            return
+
+        if self.explain:
+            self.check_plan(self.coll, query, PROJECTION)
+
+        cursor = self.coll.find(query, PROJECTION, batch_size=batch_size, limit=limit)
+        cancel = CANCEL.get()
+
+        while True:
+            if cancel is not None and cancel.is_set():
+                cursor.close()
+                raise QueryCancelled(f'Query {query} was cancelled')
+
+            start = time.perf_counter()
+
+            first = next(cursor, None)
+            if first is None:
+                break
+
+            typed = not isinstance(first['ts'], str)
+
+            numeric = {c: np.empty(batch_size, dtype=float if typed else object) for c in NUMERIC_COLUMNS}
+            ts = np.empty(batch_size, dtype='datetime64[ms]' if typed else object)
+
+            n = 0
+            for doc in chain([first], islice(cursor, batch_size - 1)):
+                for c in NUMERIC_COLUMNS:
+                    numeric[c][n] = doc[c]
+                ts[n] = doc['ts']
+                n += 1
+
+            decoded = time.perf_counter()
+            CURSOR_SECONDS.observe(decoded - start, layout=self.layout)
+
+            if typed:
+                df = pd.DataFrame({c: numeric[c][:n] for c in NUMERIC_COLUMNS})
+                df.insert(1, 'ts', ts[:n])
+            else:
+                # Convert data types from string
+                df = pd.DataFrame({c: pd.to_numeric(numeric[c][:n]) for c in NUMERIC_COLUMNS})
+                df.insert(1, 'ts', pd.to_datetime(ts[:n]))
+
+            FRAME_SECONDS.observe(time.perf_counter() - decoded, layout=self.layout)
+            ROWS.inc(n, layout=self.layout)
+
+            yield df
+
+            if n < batch_size:
+                break
+
+    def iter_buckets(self, query, batch_size, limit=0):
+        '''
+        iter_chunks for the buckets layout: runs a reading query against the day buckets and unpacks
+        each bucket's arrays a whole bucket at a time, keeping only the readings the query asked for.
+        '''
+        bounds = query.get('ts', {})
+        if not isinstance(bounds, dict):
+            bounds = {'$gte': bounds, '$lte': bounds}
+
+        # A bucket can hold matching readings if it starts less than a bucket span before the range
+        bucket_query = dict(query)
+        if bounds:
+            bucket_query['ts'] = {('$gt' if op in ('$gte', '$gt') else op): (v - BUCKET_SPAN if op in ('$gte', '$gt') else v) for op, v in bounds.items()}
+
+        if self.explain:
+            self.check_plan(self.coll, bucket_query, BUCKET_PROJECTION)
+
+        cursor = self.coll.find(bucket_query, BUCKET_PROJECTION, batch_size=max(1, batch_size // 24))
+        cancel = CANCEL.get()
+
+        parts = []
+        rows = 0
+        total = 0
+        start = time.perf_counter()
+        for bucket in chain(cursor, [None]):
+            if cancel is not None and cancel.is_set():
+                cursor.close()
+                raise QueryCancelled(f'Query {query} was cancelled')
+
+            if bucket is not None:
+                ts = np.datetime64(bucket['ts'], 'ms') + np.asarray(bucket['t'], dtype='timedelta64[s]')
+
+                keep = np.ones(ts.shape[0], dtype=bool)
+                for op, v in bounds.items():
+                    keep &= TS_OPS[op](ts, np.datetime64(v, 'ms'))
+
+                n = int(keep.sum())
+                if n:
+                    part = {'id': np.full(n, float(bucket['id'])), 'ts': ts[keep]}
+                    for m in METRICS:
+                        part[m] = np.asarray(bucket[m], dtype=float)[keep]
+
+                    parts.append(part)
+                    rows += n
+
+            if parts and (bucket is None or rows >= batch_size or (limit and total + rows >= limit)):
+                decoded = time.perf_counter()
+                CURSOR_SECONDS.observe(decoded - start, layout=self.layout)
+
+                df = pd.DataFrame({c: np.concatenate([p[c] for p in parts]) for c in COLUMNS})
+                if limit:
+                    df = df.iloc[:limit - total]
+
+                FRAME_SECONDS.observe(time.perf_counter() - decoded, layout=self.layout)
+                ROWS.inc(len(df), layout=self.layout)
+
+                yield df
+                start = time.perf_counter()
+                total += len(df)
+                parts = []
+                rows = 0
+
+                if limit and total >= limit:
+                    cursor.close()
+                    return
+
+    def read_frame(self, query, batch_size=None, limit=0, chunks=False):
+        '''
+        Runs a query and returns one DataFrame, or with chunks=True the iterator from iter_chunks.
+        '''
+        chunk_iter = self.iter_chunks(query, batch_size, limit)
+
+        if chunks:
+            return chunk_iter
+
+        frames = list(chunk_iter)
+        if not frames:
+            return empty_frame()
+
+        return pd.concat(frames, ignore_index=True)
 
     def get_all_rows(self):
-        start = dt.now()
-        responses = self.coll.find({})
-
-        rows = []
-        try:
-            for row in responses:
-                    rows.append(responses.next())
-        except StopIteration:
-            pass
+        with QUERY_SECONDS.time(op='get_all_rows', layout=self.source):
+            df = self.replica.read_all() if self.replica is not None else self.read_frame({})
+
+        log.debug('get_all_rows: %d rows', len(df))
+
+        self.full_df = df
         
-        df = pd.DataFrame(rows)
 
-        print(df.head())
+    def get_rows(self, dates, ids, resolution='hourly'):
+        self.df = self.fetch_rows(dates, ids, resolution)
 
-        # Convert data types from string
-        for c in [c for c in df.columns if c not in ('_id', 'ts')]:
-            df[c] = pd.to_numeric(df[c])
-        df['ts'] = pd.to_datetime(df['ts'])
+    def route(self, resolution):
+        '''
+        The coarsest resolution whose rows cover no more than the requested one.
+        resolution is a name from RESOLUTIONS or a number of hours.
+        '''
+        hours = dict((name, h) for name, h, _ in RESOLUTIONS).get(resolution, resolution)
 
-        df = df[[c for c in df.columns if c]]
-        
-        self.full_df = df
+        return [r for r in RESOLUTIONS if r[1] <= hours][-1]
 
-        print(f'Querying data took {dt.now() - start}')
-        
+    def fetch_rows(self, dates, ids, resolution='hourly'):
+        '''
+        Rows for ids with dates[0] <= ts < dates[1], ts indexed and sorted.
+
+        For a coarser resolution, reads from the matching rollup collection instead:
+        metric columns are then the mean over each day/week, with count and <metric>_min/_max alongside.
+        '''
+        name, hours, collection = self.route(resolution)
+        if name != 'hourly':
+            return self.fetch_rollup(self.db[collection], dates, ids, hours)
+
+        if self.replica is not None:
+            with QUERY_SECONDS.time(op='fetch_rows', layout=self.source):
+                return self.replica.fetch_rows(dates, ids)
 
-    def get_rows(self, dates, ids):
-        start = dt.now()
         query = {
             'ts': {'$gte': dates[0], '$lt': dates[1]},
             'id': {'$in': ids}
         }
 
-        responses = self.coll.find(query)
+        with QUERY_SECONDS.time(op='fetch_rows', layout=self.layout):
+            if self.fan_out:
+                df = self.read_shards(self.shard_queries(dates, ids, self.fan_out))
+            else:
+                df = self.read_frame(query)
 
-        rows = []
-        try:
-            for row in responses:
-                    rows.append(responses.next())
-        except StopIteration:
-            pass
-        
-        df = pd.DataFrame(rows)
+        log.debug('fetch_rows %s: %d rows', query, len(df))
 
-        print(query)
-        print(df.head())
+        df = df.set_index('ts')
+        # Stable, so rows with the same ts stay in id order however they were fetched
+        df = df.sort_index(kind='stable')
 
-        # Convert data types from string
-        for c in [c for c in df.columns if c not in ('_id', 'ts')]:
-            df[c] = pd.to_numeric(df[c])
-        df['ts'] = pd.to_datetime(df['ts'])
+        return df
 
-        df = df[[c for c in df.columns if c]]
+    def latest_ts(self, ids):
+        '''
+        {id: ts of its latest reading} for each of ids that has any. One (id, ts) index lookup per device.
+        '''
+        latest = {}
+        with QUERY_SECONDS.time(op='latest_ts', layout=self.layout):
+            for i in ids:
+                doc = self.coll.find_one({'id': i}, {'_id': 0, 'ts': 1, 't': 1}, sort=[('ts', -1)])
+                if doc is None:
+                    continue
 
-        df = df.set_index('ts')
-        df = df.sort_index()
-        
-        self.df = df
-        print(f'Querying data took {dt.now() - start}')
+                # A day bucket's ts is the start of the day, its readings are t seconds after that
+                offset = timedelta(seconds=max(doc['t'])) if self.layout == 'buckets' and doc.get('t') else timedelta(0)
+                latest[i] = pd.Timestamp(doc['ts']) + offset
 
-    def get_rows_tst(self):
-        rows = []
-        for id_lkp in ['10.0', '11.0', '12.0', '13.0']:
-            responses = self.coll.find({'id': id_lkp})
+        return latest
 
-            for i in range(0, 100):
+    def fetch_since(self, since):
+        '''
+        Hourly readings newer than each device's watermark in since ({id: ts}), oldest first, with ts as a column.
+        What the live charts poll with when there's no change stream (see live.py).
 
-                rows.append(responses.next())
-        df = pd.DataFrame(rows)
+        Devices that are up to the same reading share a query ({'id': {'$in': [...]}, 'ts': {'$gt': ts}}),
+        so a fleet reporting on the same hourly schedule takes one or two index range scans,
+        and a device that's behind never drags the others back to its watermark.
+        '''
+        groups = {}
+        for i, ts in since.items():
+            groups.setdefault(pd.Timestamp(ts), []).append(i)
 
-        # Convert data types from string
-        for c in [c for c in df.columns if c not in ('_id', 'ts')]:
-            df[c] = pd.to_numeric(df[c])
-        df['ts'] = pd.to_datetime(df['ts'])
+        queries = [{'id': {'$in': ids}, 'ts': {'$gt': ts.to_pydatetime()}} for ts, ids in sorted(groups.items())]
+
+        with QUERY_SECONDS.time(op='fetch_since', layout=self.layout):
+            df = self.read_shards(queries)
+
+        return df.sort_values('ts', kind='stable', ignore_index=True)
+
+    def shard_queries(self, dates, ids, fan_out='device'):
+        '''
+        Splits the fetch_rows query for [dates[0], dates[1]) and ids into one query per device,
+        or with fan_out='month' one per device per calendar month.
+        '''
+        if fan_out == 'device':
+            bounds = [dates]
+        elif fan_out == 'month':
+            months = pd.date_range(pd.Timestamp(dates[0]).to_period('M').to_timestamp(), dates[1], freq='MS')
+            edges = [dates[0]] + [m.to_pydatetime() for m in months if dates[0] < m < dates[1]] + [dates[1]]
+            bounds = list(zip(edges[:-1], edges[1:]))
+        else:
+            raise ValueError(f'Unknown fan_out {fan_out}, expected device or month')
+
+        return [{'ts': {'$gte': lo, '$lt': hi}, 'id': i} for i in ids for lo, hi in bounds]
+
+    def read_shards(self, queries):
+        '''
+        Runs queries max_concurrency at a time over the client's pool and returns their rows as one DataFrame.
+        Rows come back in query order, fetch_rows sorts them by ts.
+        '''
+        if len(queries) <= 1:
+            return self.read_frame(queries[0]) if queries else empty_frame()
+
+        # Each query runs in a copy of this context, so a CANCEL set by the caller stops every shard
+        context = copy_context()
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            frames = list(pool.map(lambda q: context.copy().run(self.read_frame, q), queries))
+
+        frames = [f for f in frames if not f.empty]
+        if not frames:
+            return empty_frame()
 
-        df = df[[c for c in df.columns if c]]
+        return pd.concat(frames, ignore_index=True)
 
+    def fetch_rollup(self, coll, dates, ids, hours):
+        '''
+        Rollup rows for every day/week overlapping [dates[0], dates[1]), in the same shape as fetch_rows.
+        '''
+        query = {
+            'ts': {'$gt': dates[0] - timedelta(hours=hours), '$lt': dates[1]},
+            'id': {'$in': ids}
+        }
+
+        # t (which readings a rollup has taken in) is only for the consumer
+        projection = {'_id': 0, 't': 0}
+
+        if self.explain:
+            self.check_plan(coll, query, projection)
+
+        with QUERY_SECONDS.time(op='fetch_rollup', layout=coll.name):
+            rows = list(coll.find(query, projection))
+        log.debug('%s query %s: %d rows', coll.name, query, len(rows))
+
+        start = time.perf_counter()
+
+        stats = [m + s for m in METRICS for s in ('_min', '_max', '_sum')]
+        df = pd.DataFrame(rows, columns=['id', 'ts', 'count'] + stats)
+        df['id'] = df['id'].astype(float)
         df['ts'] = pd.to_datetime(df['ts'])
+
+        for m in METRICS:
+            df[m] = df[m + '_sum'] / df['count']
+
+        df = df[['id', 'ts'] + METRICS + ['count'] + [m + s for m in METRICS for s in ('_min', '_max')]]
+        df = df.set_index('ts').sort_index()
+
+        FRAME_SECONDS.observe(time.perf_counter() - start, layout=coll.name)
+
+        return df
+
+    def get_device_summaries(self, cpu_temp_limit=122):
+        '''
+        Per device health stats, aggregated by MongoDB so only one row per device comes back.
+
+        Returns two DataFrames indexed by id, with the same columns a groupby over every row would give:
+            summary: ts_min, ts_max, ts_count, signal_min, signal_max, signal_mean
+            cpu_temp: cpu_temp_max, cpu_temp_count - only for devices with readings over cpu_temp_limit
+        '''
+        summary_pipeline = [
+            {'$group': {
+                '_id': '$id',
+                'ts_min': {'$min': '$ts'},
+                'ts_max': {'$max': '$ts'},
+                'ts_count': {'$sum': 1},
+                'signal_min': {'$min': '$signal'},
+                'signal_max': {'$max': '$signal'},
+                'signal_mean': {'$avg': '$signal'}
+            }}
+        ]
+
+        cpu_temp_pipeline = [
+            {'$match': {'cpu_temp': {'$gt': cpu_temp_limit}}},
+            {'$group': {
+                '_id': '$id',
+                'cpu_temp_max': {'$max': '$cpu_temp'},
+                'cpu_temp_count': {'$sum': 1}
+            }}
+        ]
+
+        with QUERY_SECONDS.time(op='get_device_summaries', layout=self.layout):
+            summary = self.aggregate_frame(summary_pipeline, ['ts_min', 'ts_max', 'ts_count', 'signal_min', 'signal_max', 'signal_mean'])
+            cpu_temp = self.aggregate_frame(cpu_temp_pipeline, ['cpu_temp_max', 'cpu_temp_count'])
+
+        return summary, cpu_temp
+
+    def get_health_summaries(self):
+        '''
+        Reads the per device health summaries kept up to date by the ingest consumer (ingest_data/health.py).
+
+        Returns the same (summary, cpu_temp) frames as get_device_summaries, or None if there are no summaries yet.
+        Cost is one small document per device, no matter how much history there is.
+        '''
+        with QUERY_SECONDS.time(op='get_health_summaries', layout=self.layout):
+            rows = list(self.health.find({}))
+        if not rows:
+            return None
+
+        df = pd.DataFrame(rows).rename({'_id': 'id'}, axis=1).set_index('id').sort_index()
+        # Summaries written before any reading went over the CPU temp limit may not have cpu_temp_max at all
+        df = df.reindex(columns=df.columns.union(['cpu_temp_max', 'cpu_temp_count'], sort=False))
+        df['cpu_temp_count'] = df['cpu_temp_count'].fillna(0)
+        df['signal_mean'] = df['signal_sum'] / df['ts_count']
+
+        summary = df[['ts_min', 'ts_max', 'ts_count', 'signal_min', 'signal_max', 'signal_mean']]
+
+        cpu_temp = df[df['cpu_temp_count'] > 0][['cpu_temp_max', 'cpu_temp_count']]
+
+        return summary, cpu_temp
+
+    def get_watermark(self):
+        '''
+        A cheap summary of how much data there is, that changes whenever readings are added:
+        the collection's document count (from its metadata, no scan) and the total reading count and latest
+        reading from the health summaries (one small document per device). Anything computed from the data
+        can be reused for as long as this stays the same.
+
+        Returns a dict of plain values, so it can be saved as JSON and compared with ==.
+        '''
+        with QUERY_SECONDS.time(op='get_watermark', layout=self.layout):
+            documents = self.coll.estimated_document_count()
+            latest = next(iter(self.health.aggregate([
+                {'$group': {'_id': None, 'ts_max': {'$max': '$ts_max'}, 'readings': {'$sum': '$ts_count'}}}
+            ])), None)
+
+        return {
+            'layout': self.layout,
+            'documents': documents,
+            'readings': latest['readings'] if latest else None,
+            'ts_max': latest['ts_max'].isoformat() if latest and latest['ts_max'] else None
+        }
+
+    def aggregate_frame(self, pipeline, columns):
+        '''
+        Runs an aggregation grouped on id and returns the result as a DataFrame indexed by id.
+        '''
+        if self.layout == 'buckets':
+            pipeline = UNWIND_BUCKETS + pipeline
+
+        rows = list(self.coll.aggregate(pipeline, allowDiskUse=True))
+
+        df = pd.DataFrame(rows, columns=['_id'] + columns)
+        df = df.rename({'_id': 'id'}, axis=1).set_index('id').sort_index()
+
+        return df
+
+    def get_rows_tst(self):
+        frames = []
+        for id_lkp in [10, 11, 12, 13]:
+            if self.replica is not None:
+                frames.append(self.replica.device_frame(id_lkp).iloc[:100].reset_index())
+            else:
+                frames.append(self.read_frame({'id': id_lkp}, limit=100))
+        df = pd.concat(frames, ignore_index=True)
+
         df = df.set_index('ts')
         
         self.df = df
 
 
+_reader = None
+_reader_lock = threading.Lock()
+
+
+def get_reader(**kwargs):
+    '''
+    The reader for this process. Panel re-runs viewer.py for every session, but this module is only imported
+    once, so every session shares one reader, and with it one client and connection pool
+    (created with the first session's kwargs).
+    '''
+    global _reader
+
+    with _reader_lock:
+        if _reader is None:
+            _reader = MongoReader(**kwargs)
+
+    return _reader
+
+
+def empty_frame():
+    df = pd.DataFrame({c: pd.Series(dtype=float) for c in NUMERIC_COLUMNS})
+    df.insert(1, 'ts', pd.Series(dtype='datetime64[ns]'))
+
+    return df
+
+
+def plan_stages(plan):
+    '''
+    Every stage name in an explain plan, outermost first.
+    Handles both the classic (inputStage/inputStages) and the slot based engine (queryPlan) layouts.
+    '''
+    stages = []
+    if 'stage' in plan:
+        stages.append(plan['stage'])
+
+    for key in ('queryPlan', 'inputStage'):
+        if key in plan:
+            stages.extend(plan_stages(plan[key]))
+
+    for child in plan.get('inputStages', []):
+        stages.extend(plan_stages(child))
+
+    return stages
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read the sensor readings')
+    parser.add_argument('--ensure-indexes', action='store_true', help='create the indexes the reader needs (see INDEXES), then exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.ensure_indexes:
+        MongoReader(ensure_indexes=True)
+        log.info('Indexes created: %s', INDEXES)
+        raise SystemExit
+
     rdr = MongoReader()
 
     vw = Viewer(rdr)
@@ -0,0 +1,407 @@
+'''
+Anomaly detection over every device's hourly readings at once.
+
+The fixed checks in Viewer.find_errors only look at per device summaries, so they can't see a metric
+changing behaviour partway through (like the lumens jump the light failure injects). These detectors
+score every reading instead:
+
+    zscore      distance from the mean of the previous `window` hours, in standard deviations
+    cusum       two sided CUSUM of the distance from the device's baseline (its first `baseline` readings),
+                catches sustained shifts too small to stand out hour by hour
+    seasonal    distance from the device's own baseline for that hour of the day
+
+Devices are split into blocks that run on a thread pool (numpy releases the GIL). Each block's readings are
+laid out as a devices x hours array per metric (NaN where a reading is missing), so each detector is a
+handful of cumulative sums over whole arrays rather than a groupby.apply per device. Each detector keeps
+per device state between calls, and each device has its own watermark, so DetectionEngine.update only
+ever has to look at readings newer than what it's seen from that device.
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from ts_store import METRICS
+
+
+def lindley(steps, start):
+    '''
+    s[t] = max(0, s[t - 1] + steps[t]) along each row, with s[-1] = start. No python loop over t:
+    it's the running sum minus its running minimum (floored at 0).
+    '''
+    c = start[:, None] + np.cumsum(steps, axis=1)
+
+    return c - np.minimum(np.minimum.accumulate(c, axis=1), 0)
+
+
+def baseline_stats(x, n0, s0, ss0, size):
+    '''
+    Running mean/std of the first `size` readings in each row of x, given the count/sum/sum of squares
+    (n0, s0, ss0) of readings seen in earlier blocks. Readings after the first size don't change them.
+
+    Returns mean, std and whether the baseline was complete at every position, and the new n, s, ss.
+    '''
+    seen = ~np.isnan(x)
+    use = seen & (n0[:, None] + np.cumsum(seen, axis=1) <= size)
+    values = np.where(use, x, 0.0)
+
+    n = n0[:, None] + np.cumsum(use, axis=1)
+    s = s0[:, None] + np.cumsum(values, axis=1)
+    ss = ss0[:, None] + np.cumsum(values * values, axis=1)
+
+    mean = s / np.maximum(n, 1)
+    std = np.sqrt(np.maximum(ss / np.maximum(n, 1) - mean * mean, 0))
+
+    return mean, std, n >= size, n[:, -1], s[:, -1], ss[:, -1]
+
+
+def floored(std, mean, rel=0.01):
+    '''
+    Some metrics don't vary at all for a given hour (lumens at night), so never divide by less than 1% of the mean.
+    '''
+    return np.maximum(std, rel * np.abs(mean) + 1e-9)
+
+
+class Detector():
+    '''
+    Scores a block of readings (devices x hours, NaN where missing) and flags scores over threshold.
+
+    init_state(n) returns the per device arrays the detector carries between blocks. score() reads and
+    replaces entries of that state dict, and returns scores the same shape as x (NaN where it can't score yet).
+    Each row's readings end at its own length (lengths[r] columns, NaN after that), and its state has to be
+    left as of its own last column, so the next block carries on from there.
+    '''
+    name = None
+    label = None
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def init_state(self, n):
+        return {}
+
+    def score(self, x, hours, state, lengths):
+        raise NotImplementedError
+
+
+class RollingZScore(Detector):
+    name = 'zscore'
+    label = 'Rolling Z-Score'
+
+    def __init__(self, window=48, threshold=4, min_periods=24):
+        super().__init__(threshold)
+        self.window = window
+        self.min_periods = min_periods
+
+    def init_state(self, n):
+        return {'tail': np.full((n, self.window), np.nan)}
+
+    def score(self, x, hours, state, lengths):
+        full = np.concatenate([state['tail'], x], axis=1)
+        seen = ~np.isnan(full)
+        values = np.where(seen, full, 0.0)
+
+        zero = np.zeros((full.shape[0], 1))
+        c_n = np.concatenate([zero, np.cumsum(seen, axis=1)], axis=1)
+        c_s = np.concatenate([zero, np.cumsum(values, axis=1)], axis=1)
+        c_ss = np.concatenate([zero, np.cumsum(values * values, axis=1)], axis=1)
+
+        # The window for x[:, j] is full[:, j:j + window], the `window` hours before it
+        lo = np.arange(x.shape[1])
+        hi = lo + self.window
+        n = c_n[:, hi] - c_n[:, lo]
+        mean = (c_s[:, hi] - c_s[:, lo]) / np.maximum(n, 1)
+        std = np.sqrt(np.maximum((c_ss[:, hi] - c_ss[:, lo]) / np.maximum(n, 1) - mean * mean, 0))
+
+        z = np.abs(x - mean) / floored(std, mean)
+        z[n < self.min_periods] = np.nan
+
+        # The `window` hours up to each row's last reading
+        state['tail'] = np.take_along_axis(full, lengths[:, None] + np.arange(self.window), axis=1)
+
+        return z
+
+
+class Cusum(Detector):
+    name = 'cusum'
+    label = 'Change Point (CUSUM)'
+
+    def __init__(self, k=0.5, threshold=15, baseline=336):
+        super().__init__(threshold)
+        self.k = k
+        self.baseline = baseline
+
+    def init_state(self, n):
+        return {'n': np.zeros(n), 's': np.zeros(n), 'ss': np.zeros(n), 'hi': np.zeros(n), 'lo': np.zeros(n)}
+
+    def score(self, x, hours, state, lengths):
+        mean, std, fitted, state['n'], state['s'], state['ss'] = baseline_stats(x, state['n'], state['s'], state['ss'], self.baseline)
+
+        # Hours without a reading, or before the baseline is known, don't move the sums
+        z = np.where(fitted & ~np.isnan(x), (x - mean) / floored(std, mean), 0.0)
+
+        hi = lindley(z - self.k, state['hi'])
+        lo = lindley(-z - self.k, state['lo'])
+        last = (lengths - 1)[:, None]
+        state['hi'], state['lo'] = np.take_along_axis(hi, last, axis=1)[:, 0], np.take_along_axis(lo, last, axis=1)[:, 0]
+
+        return np.where(fitted, np.maximum(hi, lo), np.nan)
+
+
+class SeasonalBaseline(Detector):
+    name = 'seasonal'
+    label = 'Seasonal Baseline'
+
+    def __init__(self, period=24, baseline_days=28, threshold=4):
+        super().__init__(threshold)
+        self.period = period
+        self.baseline_days = baseline_days
+
+    def init_state(self, n):
+        return {k: np.zeros((n, self.period)) for k in ('n', 's', 'ss')}
+
+    def score(self, x, hours, state, lengths):
+        # Missing readings don't change the baselines, so the padding after each row's length needs no special case
+        phase = hours % self.period
+        z = np.full(x.shape, np.nan)
+
+        for p in np.unique(phase):
+            cols = phase == p
+            mean, std, fitted, n, s, ss = baseline_stats(x[:, cols], state['n'][:, p], state['s'][:, p], state['ss'][:, p], self.baseline_days)
+            state['n'][:, p], state['s'][:, p], state['ss'][:, p] = n, s, ss
+
+            z[:, cols] = np.where(fitted, np.abs(x[:, cols] - mean) / floored(std, mean), np.nan)
+
+        return z
+
+
+def default_detectors():
+    return [RollingZScore(), Cusum(), SeasonalBaseline()]
+
+
+class DetectionEngine():
+    '''
+    Runs detectors over every metric of a growing set of devices, a block of devices per thread.
+
+    update() takes readings in the TimeSeriesStore.get_frame shape and only processes each device's readings
+    after the last one it processed for that device (its watermark), so it can be called with new data as
+    it arrives, and a device whose readings turn up late still has them scored.
+    findings() summarises every alarm so far per detector.
+    '''
+    def __init__(self, detectors=None, metrics=METRICS, workers=4, block_size=64):
+        self.detectors = detectors or default_detectors()
+        self.metrics = list(metrics)
+        self.workers = workers
+        self.block_size = block_size
+
+        self.ids = pd.Index([], dtype=int)
+        # Per device, the hour after its latest processed reading (hours since the epoch), -1 if none yet
+        self.watermarks = np.zeros(0, dtype=np.int64)
+        self.states = {(d.name, m): d.init_state(0) for d in self.detectors for m in self.metrics}
+        self.alarms = {key: np.zeros(0, dtype=int) for key in self.states}
+        self.first = {key: np.zeros(0, dtype=np.int64) for key in self.states}
+        self.max_score = {key: np.zeros(0) for key in self.states}
+        self.lock = threading.Lock()
+
+    def add_devices(self, ids):
+        new = pd.Index(sorted(set(ids) - set(self.ids)), dtype=int)
+        if new.empty:
+            return
+
+        self.ids = self.ids.append(new)
+        self.watermarks = np.concatenate([self.watermarks, np.full(len(new), -1, dtype=np.int64)])
+        for d in self.detectors:
+            for m in self.metrics:
+                key = (d.name, m)
+                fresh = d.init_state(len(new))
+                self.states[key] = {k: np.concatenate([v, fresh[k]]) for k, v in self.states[key].items()}
+                self.alarms[key] = np.concatenate([self.alarms[key], np.zeros(len(new), dtype=int)])
+                self.first[key] = np.concatenate([self.first[key], np.full(len(new), -1, dtype=np.int64)])
+                self.max_score[key] = np.concatenate([self.max_score[key], np.full(len(new), -np.inf)])
+
+    def update(self, df):
+        '''
+        Scores the readings in df (ts indexed, id and metric columns) from each device's watermark on,
+        then moves the devices' watermarks past them. Returns the number of readings processed.
+        '''
+        with self.lock:
+            if df.empty:
+                return 0
+
+            self.add_devices(df['id'].astype(int).unique())
+
+            rows = self.ids.get_indexer(df['id'].astype(int))
+            hours = df.index.to_numpy(dtype='datetime64[h]').astype(np.int64)
+            keep = hours >= self.watermarks[rows]
+            if not keep.any():
+                return 0
+
+            # Device by device, in time order, so each device's readings are one contiguous run
+            order = np.flatnonzero(keep)[np.lexsort((hours[keep], rows[keep]))]
+            rows, hours = rows[order], hours[order]
+            values = {m: df[m].to_numpy(dtype=float)[order] for m in self.metrics}
+
+            devices, lo = np.unique(rows, return_index=True)
+            hi = np.append(lo[1:], len(rows))
+            ends = hours[hi - 1] + 1
+
+            # A device carries on from its own watermark. New ones have no state to carry on from, so
+            # starting early only adds empty hours, and they can all start with the earliest of them
+            starts = self.watermarks[devices].copy()
+            new = starts < 0
+            if new.any():
+                starts[new] = hours[lo[new]].min()
+
+            blocks = []
+            for start in np.unique(starts):
+                group = np.flatnonzero(starts == start)
+                blocks.extend((start, group[i:i + self.block_size]) for i in range(0, len(group), self.block_size))
+
+            def run(block):
+                start, members = block
+                self.run_block(devices[members], start, ends[members], lo[members], hi[members], hours, values)
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(run, blocks))
+
+            self.watermarks[devices] = ends
+
+            return len(rows)
+
+    def run_block(self, rows, start, ends, lo, hi, hours, values):
+        '''
+        Runs every detector over one block of devices (rows of the engine's arrays), whose readings are
+        hours[lo[r]:hi[r]] and values[m][lo[r]:hi[r]], from start up to ends[r].
+        Only this block's grid for one metric is held at a time.
+        '''
+        lengths = ends - start
+        span = int(lengths.max())
+        block_hours = np.arange(start, start + span)
+        padding = np.arange(span)[None, :] >= lengths[:, None]
+
+        readings = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)])
+        grid_rows = np.repeat(np.arange(len(rows)), hi - lo)
+        grid_cols = hours[readings] - start
+
+        for m in self.metrics:
+            grid = np.full((len(rows), span), np.nan)
+            grid[grid_rows, grid_cols] = values[m][readings]
+
+            for d in self.detectors:
+                key = (d.name, m)
+                state = {k: v[rows].copy() for k, v in self.states[key].items()}
+
+                score = d.score(grid, block_hours, state, lengths)
+                score[padding] = np.nan
+
+                for k, v in state.items():
+                    self.states[key][k][rows] = v
+
+                flagged = score > d.threshold
+                first = np.where(flagged.any(axis=1), block_hours[flagged.argmax(axis=1)], -1)
+
+                self.alarms[key][rows] += flagged.sum(axis=1)
+                self.first[key][rows] = np.where(self.first[key][rows] < 0, first, self.first[key][rows])
+                self.max_score[key][rows] = np.maximum(self.max_score[key][rows], np.where(np.isnan(score), -np.inf, score).max(axis=1, initial=-np.inf))
+
+    def findings(self):
+        '''
+        {detector name: DataFrame} with a row per device and metric that raised any alarm, indexed by id:
+        the metric, the first hour it alarmed, how many hours alarmed and the highest score.
+        '''
+        tables = {}
+        with self.lock:
+            for d in self.detectors:
+                frames = []
+                for m in self.metrics:
+                    key = (d.name, m)
+                    hit = self.alarms[key] > 0
+
+                    frames.append(pd.DataFrame({
+                        'metric': m,
+                        'first_alarm': pd.to_datetime(self.first[key][hit].astype('datetime64[h]')),
+                        'alarms': self.alarms[key][hit],
+                        'max_score': self.max_score[key][hit]
+                    }, index=pd.Index(self.ids[hit], name='id')))
+
+                tables[d.name] = pd.concat(frames).sort_values(['alarms', 'max_score'], ascending=False)
+
+        return tables
+
+    def since(self, ids):
+        '''
+        {id: ts after which update() still wants the device's readings}, None for devices it hasn't seen.
+        '''
+        with self.lock:
+            # get_indexer gives -1 for ids it doesn't have, which picks the -1 on the end
+            watermarks = np.append(self.watermarks, -1)[self.ids.get_indexer(pd.Index(ids, dtype=int))]
+
+        return {i: None if w < 0 else pd.Timestamp(np.datetime64(int(w), 'h')) for i, w in zip(ids, watermarks)}
+
+    def save(self, path):
+        '''
+        Writes the per device state, alarms and watermarks to an .npz file, so a restarted dashboard
+        can carry on from here instead of scoring the whole history again.
+        '''
+        with self.lock:
+            arrays = {'ids': self.ids.to_numpy(), 'watermarks': self.watermarks}
+            for name, m in self.states:
+                prefix = f'{name}.{m}.'
+                arrays.update({prefix + 'state.' + k: v for k, v in self.states[(name, m)].items()})
+                arrays[prefix + 'alarms'] = self.alarms[(name, m)]
+                arrays[prefix + 'first'] = self.first[(name, m)]
+                arrays[prefix + 'max_score'] = self.max_score[(name, m)]
+
+            np.savez(path, **arrays)
+
+    def load(self, path):
+        '''
+        Picks up the state save() wrote. Returns False, and leaves this engine as it was, if it has already
+        seen data or the file was written with different detectors or metrics.
+        '''
+        with self.lock:
+            if len(self.ids):
+                return False
+
+            with np.load(path) as saved:
+                fresh = {(d.name, m): d.init_state(0) for d in self.detectors for m in self.metrics}
+                wanted = [f'{name}.{m}.{k}' for name, m in fresh for k in ['alarms', 'first', 'max_score'] + ['state.' + s for s in fresh[(name, m)]]]
+                if any(k not in saved.files for k in wanted):
+                    return False
+
+                # A detector's parameters set the shape of its state (like the z-score window)
+                for (name, m), state in fresh.items():
+                    if any(saved[f'{name}.{m}.state.{k}'].shape[1:] != v.shape[1:] for k, v in state.items()):
+                        return False
+
+                self.ids = pd.Index(saved['ids'], dtype=int)
+                if 'watermarks' in saved.files:
+                    self.watermarks = saved['watermarks'].astype(np.int64)
+                else:
+                    # Saved when the engine had one watermark for every device
+                    self.watermarks = np.full(len(self.ids), int(saved['watermark']), dtype=np.int64)
+
+                for name, m in fresh:
+                    prefix = f'{name}.{m}.'
+                    self.states[(name, m)] = {k: saved[prefix + 'state.' + k] for k in fresh[(name, m)]}
+                    self.alarms[(name, m)] = saved[prefix + 'alarms']
+                    self.first[(name, m)] = saved[prefix + 'first']
+                    self.max_score[(name, m)] = saved[prefix + 'max_score']
+
+            return True
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(**kwargs):
+    '''
+    The engine for this process, shared by every session like the TimeSeriesStore.
+    '''
+    global _engine
+
+    with _engine_lock:
+        if _engine is None:
+            _engine = DetectionEngine(**kwargs)
+
+    return _engine
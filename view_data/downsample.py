@@ -0,0 +1,129 @@
+'''
+Level of detail for long range line charts.
+
+A browser can't show more points than the chart has pixels, so sending ~26k hourly points per device
+just makes the websocket payload and rendering slow. These pick a resolution from the visible range
+and the chart width:
+
+    raw         every point, when there are no more than ~2 per pixel
+    minmax      the min and max of each pixel wide bucket, keeps spikes and dropouts visible
+    lttb        largest triangle three buckets, best looking for smooth series
+    daily/weekly    mean per day/week, for ranges where a pixel covers a day or more
+'''
+import numpy as np
+import pandas as pd
+
+LOD_METHODS = ['auto', 'raw', 'minmax', 'lttb', 'daily', 'weekly']
+
+HOURS_PER_DAY = 24
+HOURS_PER_WEEK = 168
+
+
+def minmax_indices(y, n_buckets):
+    '''
+    Indices of the min and max of y in each of n_buckets equal sized buckets, in order.
+    '''
+    n = y.shape[0]
+    if n <= 2 * n_buckets:
+        return np.arange(n)
+
+    bucket = np.arange(n) * n_buckets // n
+
+    # Sorted by bucket then value, the first of each bucket is its min and the last its max
+    order = np.lexsort((y, bucket))
+    starts = np.searchsorted(bucket[order], np.arange(n_buckets), side='left')
+    ends = np.searchsorted(bucket[order], np.arange(n_buckets), side='right') - 1
+
+    return np.unique(np.concatenate([order[starts], order[ends]]))
+
+
+def lttb_indices(x, y, n_out):
+    '''
+    Largest triangle three buckets: keeps the first and last points, and from each bucket in between
+    the point forming the largest triangle with the previously kept point and the next bucket's average.
+    '''
+    n = y.shape[0]
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    kept = np.empty(n_out, dtype=int)
+    kept[0] = 0
+    kept[-1] = n - 1
+
+    prev = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+
+        area = np.abs((x[prev] - avg_x) * (y[lo:hi] - y[prev]) - (x[prev] - x[lo:hi]) * (avg_y - y[prev]))
+
+        prev = lo + int(area.argmax())
+        kept[i + 1] = prev
+
+    return kept
+
+
+def to_timestamp(value):
+    '''
+    Range stream values can come back from bokeh as epoch milliseconds rather than datetimes.
+    '''
+    if isinstance(value, (int, float, np.number)):
+        return pd.Timestamp(value, unit='ms')
+
+    return pd.Timestamp(value)
+
+
+def choose_lod(start, end, width):
+    '''
+    Resolution to draw [start, end) at, for a chart width pixels wide.
+    '''
+    hours_per_pixel = (pd.Timestamp(end) - pd.Timestamp(start)) / pd.Timedelta(hours=1) / width
+
+    if hours_per_pixel >= HOURS_PER_WEEK:
+        return 'weekly'
+    elif hours_per_pixel >= HOURS_PER_DAY:
+        return 'daily'
+    elif hours_per_pixel > 0.5:
+        return 'minmax'
+
+    return 'raw'
+
+
+def downsample_frame(df, column, start, end, width=900, method='auto'):
+    '''
+    Cuts a ts indexed frame with id and column down to what's visible in [start, end) at the given width.
+
+    Returns a frame in the same shape, so it can be plotted the same way.
+    '''
+    start, end = to_timestamp(start), to_timestamp(end)
+    df = df[(df.index >= start) & (df.index < end)]
+
+    if method == 'auto':
+        method = choose_lod(start, end, width)
+
+    if method == 'raw' or df.empty:
+        return df
+
+    if method in ('daily', 'weekly'):
+        freq = '1D' if method == 'daily' else '7D'
+        rolled = df.groupby('id')[column].resample(freq).mean().dropna()
+
+        return rolled.reset_index(level='id')[['id', column]]
+
+    frames = []
+    for device_id, device_df in df.groupby('id', sort=True):
+        y = device_df[column].to_numpy(dtype=float)
+
+        if method == 'lttb':
+            x = device_df.index.to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(float)
+            idx = lttb_indices(x, y, 2 * width)
+        else:
+            idx = minmax_indices(y, width)
+
+        frames.append(device_df.iloc[idx])
+
+    return pd.concat(frames).sort_index(kind='stable')
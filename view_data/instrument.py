@@ -0,0 +1,168 @@
+'''
+Dashboard side of the metrics in metrics.py: an HTTP endpoint to scrape them from, and timing/profiling for widget callbacks.
+
+Under `panel serve` stdout is easy to lose, so serve_metrics() starts a small server next to the app:
+
+    http://localhost:9464/metrics         Prometheus text
+    http://localhost:9464/metrics.json    the same as JSON
+
+The port comes from VIEWER_METRICS_PORT (0 turns the endpoint off).
+
+Callbacks wrapped with @callback are timed into viewer_callback_seconds. Setting VIEWER_PROFILE to
+cprofile or pyinstrument also profiles every call, and writes one file per call into VIEWER_PROFILE_DIR
+(default profiles/): <callback>-<time>.prof for cProfile (open with snakeviz or pstats), .html for pyinstrument.
+
+Only one call is profiled at a time per process: cProfile can't run two profilers at once (from 3.12 enabling
+a second one raises), and async callbacks overlap on the event loop. Calls made while another is being
+profiled are still timed, just not profiled.
+'''
+import os
+import json
+import logging
+import time
+import inspect
+import cProfile
+import threading
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from metrics import REGISTRY, histogram
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+log = logging.getLogger(__name__)
+
+CALLBACK_SECONDS = histogram('viewer_callback_seconds', 'Wall time of dashboard widget callbacks')
+
+_server = None
+_server_lock = threading.Lock()
+_profiling = threading.Lock()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = REGISTRY.to_prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(REGISTRY.to_dict(), default=str), 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port=None):
+    '''
+    Starts the metrics endpoint on a background thread, once per process however many sessions call it.
+    Returns the server, or None if it's turned off.
+    '''
+    global _server
+
+    port = int(os.environ.get('VIEWER_METRICS_PORT', 9464)) if port is None else port
+    if not port:
+        return None
+
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(('', port), MetricsHandler)
+            except OSError as e:
+                # Another panel serve process on this machine already has it
+                log.warning('Metrics endpoint not started on port %d: %s', port, e)
+                return None
+
+            threading.Thread(target=_server.serve_forever, daemon=True, name='metrics').start()
+            log.info('Serving metrics on http://localhost:%d/metrics', port)
+
+    return _server
+
+
+class Profile():
+    '''
+    Profiles one call with whichever profiler VIEWER_PROFILE names, if any, and saves the result.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.mode = os.environ.get('VIEWER_PROFILE', '').lower()
+        self.profiler = None
+
+    def __enter__(self):
+        if self.mode not in ('cprofile', 'pyinstrument'):
+            return self
+        if self.mode == 'pyinstrument' and pyinstrument is None:
+            log.warning('VIEWER_PROFILE=pyinstrument but pyinstrument is not installed (pip install pyinstrument)')
+            return self
+
+        # Another call is being profiled already, this one just runs
+        if not _profiling.acquire(blocking=False):
+            return self
+
+        try:
+            if self.mode == 'cprofile':
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+            else:
+                self.profiler = pyinstrument.Profiler(async_mode='enabled')
+                self.profiler.start()
+        except Exception:
+            self.profiler = None
+            _profiling.release()
+            raise
+
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is None:
+            return
+
+        try:
+            self.save()
+        finally:
+            self.profiler = None
+            _profiling.release()
+
+    def save(self):
+        out_dir = os.environ.get('VIEWER_PROFILE_DIR', 'profiles')
+        os.makedirs(out_dir, exist_ok=True)
+        stem = os.path.join(out_dir, f'{self.name}-{time.strftime("%Y%m%d-%H%M%S")}-{time.perf_counter_ns() % 10 ** 6}')
+
+        if self.mode == 'cprofile':
+            self.profiler.disable()
+            self.profiler.dump_stats(stem + '.prof')
+        else:
+            self.profiler.stop()
+            with open(stem + '.html', 'w') as f:
+                f.write(self.profiler.output_html())
+
+
+def callback(name):
+    '''
+    Decorator for widget callbacks (sync or async): times every call into viewer_callback_seconds{callback=name},
+    and profiles it when VIEWER_PROFILE is set.
+    '''
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with Profile(name), CALLBACK_SECONDS.time(callback=name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with Profile(name), CALLBACK_SECONDS.time(callback=name):
+                    return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
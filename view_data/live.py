@@ -0,0 +1,272 @@
+'''
+Live mode: tails new readings as they're inserted and hands each session just the new points for the
+devices it's showing, so the live charts append instead of re-querying their whole window.
+
+One LiveFeed per process (get_feed) reads new readings for every session, from either:
+
+    changestream    a MongoDB change stream of inserts into the readings collection. Needs a replica set
+                    (or sharded cluster) and the documents layout, since buckets are updated rather than
+                    inserted, and time-series collections don't support change streams.
+    poll            every `interval` seconds, (id, ts) index queries for each subscribed device's readings
+                    newer than the latest it has had. Works anywhere, with any layout.
+
+VIEWER_LIVE_SOURCE picks one (default auto: the change stream if the server supports it, polling otherwise),
+and VIEWER_LIVE_INTERVAL sets the poll interval.
+
+Each subscriber gets a bounded queue of new readings, which the session drains into a HoloViews Buffer
+from a periodic callback (Bokeh documents can only be changed from their own session, not the feed's thread).
+
+A new subscriber's initial window was read before it subscribed, so subscribe() catches it up with one
+fetch_since from the end of that window once the feed is following the data. Whatever the feed hands it
+meanwhile is held back and merged in, so nothing inserted between the window and the stream is missed.
+'''
+import os
+import time
+import logging
+import threading
+from collections import deque
+import pandas as pd
+from pymongo.errors import OperationFailure, PyMongoError
+from metrics import counter, gauge
+
+log = logging.getLogger(__name__)
+
+COLUMNS = ['id', 'ts', 'lumens', 'temp', 'cpu_temp', 'signal', 'charge']
+
+# Where a device with no readings yet is waiting from
+EPOCH = pd.Timestamp(0)
+
+# Seconds subscribe() waits for the feed to start following the data before catching up anyway
+FOLLOW_TIMEOUT = 10
+
+LIVE_READINGS = counter('viewer_live_readings_total', 'New readings picked up by the live feed, by source')
+SUBSCRIPTIONS = gauge('viewer_live_subscriptions', 'Live charts being fed')
+
+
+class Subscription():
+    '''
+    One live chart's view of the feed: the devices it shows, the latest reading it has for each,
+    and the new readings waiting to be drawn (at most max_rows, oldest dropped first).
+    '''
+    def __init__(self, ids, since, max_rows=10000):
+        self.ids = set(ids)
+        self.since = dict(since)
+        self.pending = deque(maxlen=max_rows)
+        self.lock = threading.Lock()
+        # Frames offered while catching up (see catch_up), None once caught up
+        self.held = []
+
+    def offer(self, df):
+        '''
+        Queues the rows of df for this subscriber's devices that are newer than what it already has.
+        '''
+        df = df[df['id'].isin(self.ids)]
+        if df.empty:
+            return
+
+        with self.lock:
+            if self.held is not None:
+                self.held.append(df)
+                return
+
+            self.queue(df)
+
+    def catch_up(self, df):
+        '''
+        Queues df (the readings since the initial window) together with everything held back meanwhile,
+        in ts order, and from then on takes what it's offered directly.
+        '''
+        with self.lock:
+            frames = [f for f in [df[df['id'].isin(self.ids)]] + (self.held or []) if not f.empty]
+            self.held = None
+
+            if frames:
+                self.queue(pd.concat(frames).drop_duplicates(['id', 'ts']).sort_values('ts', kind='stable'))
+
+    def queue(self, df):
+        # Called holding the lock
+        floor = df['id'].map(self.since).fillna(EPOCH)
+        df = df[df['ts'] > floor]
+        if df.empty:
+            return
+
+        self.pending.extend(df.to_dict('records'))
+        self.since.update(df.groupby('id')['ts'].max().to_dict())
+
+    def drain(self):
+        '''
+        Everything queued since the last drain, as a DataFrame (None if nothing is).
+        '''
+        with self.lock:
+            if not self.pending:
+                return None
+
+            rows = list(self.pending)
+            self.pending.clear()
+
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+
+class LiveFeed():
+    '''
+    Reads new readings on a background thread and offers them to every subscription.
+    The thread only runs while there are subscribers.
+    '''
+    def __init__(self, reader, source=None, interval=None):
+        self.reader = reader
+        self.source = source or os.environ.get('VIEWER_LIVE_SOURCE', 'auto')
+        self.interval = float(os.environ.get('VIEWER_LIVE_INTERVAL', 2)) if interval is None else interval
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stream = None
+        self.resume_token = None
+        # Set while the feed thread is following the data (the stream is open, or it's polling)
+        self.following = threading.Event()
+
+    def subscribe(self, ids, since, max_rows=10000):
+        '''
+        Starts feeding ids' readings newer than since ({id: ts}) to a new Subscription, catching it up
+        with the readings that arrived since then (see the module docstring). Blocks on a query, so call it
+        off the event loop.
+        Devices missing from since are followed from their latest reading, not from the start of their history.
+        '''
+        since = dict(since)
+        missing = [i for i in ids if i not in since]
+        if missing:
+            since.update(self.reader.latest_ts(missing))
+
+        sub = Subscription(ids, since, max_rows)
+
+        with self.lock:
+            self.subscriptions.add(sub)
+            SUBSCRIPTIONS.set(len(self.subscriptions))
+
+            if self.thread is None or not self.thread.is_alive():
+                self.following.clear()
+                self.thread = threading.Thread(target=self.run, daemon=True, name='live-feed')
+                self.thread.start()
+
+        # Only once the feed follows the data, so anything newer than this query reaches sub through the feed
+        self.following.wait(FOLLOW_TIMEOUT)
+        sub.catch_up(self.reader.fetch_since({i: since.get(i, EPOCH) for i in ids}))
+
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscriptions.discard(sub)
+            SUBSCRIPTIONS.set(len(self.subscriptions))
+
+    def publish(self, df, source):
+        if df.empty:
+            return
+
+        LIVE_READINGS.inc(len(df), source=source)
+
+        with self.lock:
+            subs = list(self.subscriptions)
+        for sub in subs:
+            sub.offer(df)
+
+    def open_stream(self):
+        '''
+        A change stream of inserts into the readings collection, or None if this server/layout can't do one.
+        '''
+        if self.reader.layout != 'documents':
+            log.info('No change stream for the %s layout, polling for new readings instead', self.reader.layout)
+            self.source = 'poll'
+            return None
+
+        try:
+            stream = self.reader.coll.watch([{'$match': {'operationType': 'insert'}}], resume_after=self.resume_token, max_await_time_ms=int(self.interval * 1000))
+        except OperationFailure as e:
+            if self.source == 'changestream':
+                raise
+
+            log.info('Change streams not available (%s), polling for new readings instead', e)
+            self.source = 'poll'
+            return None
+
+        log.info('Live feed following the change stream')
+        return stream
+
+    def read_stream(self):
+        '''
+        The inserts the change stream has for us right now (waits up to the interval for the first one).
+        '''
+        docs = []
+        while True:
+            change = self.stream.try_next()
+            if change is None:
+                break
+
+            docs.append(change['fullDocument'])
+            self.resume_token = self.stream.resume_token
+
+        return pd.DataFrame(docs, columns=COLUMNS)
+
+    def poll(self, subs):
+        '''
+        New readings for every subscribed device, each from the earliest point any subscriber is waiting from
+        for that device. Subscription.offer drops the ones a given subscriber already has.
+        A device that had no readings at all when it was subscribed is waited on from EPOCH, which only matches its new ones.
+        '''
+        since = {}
+        for sub in subs:
+            with sub.lock:
+                for i in sub.ids:
+                    ts = sub.since.get(i, EPOCH)
+                    since[i] = min(since.get(i, ts), ts)
+
+        if not since:
+            return pd.DataFrame(columns=COLUMNS)
+
+        return self.reader.fetch_since(since)
+
+    def run(self):
+        while True:
+            with self.lock:
+                subs = list(self.subscriptions)
+                if not subs:
+                    self.thread = None
+                    self.following.clear()
+                    if self.stream is not None:
+                        self.stream.close()
+                        self.stream = None
+                    return
+
+            try:
+                if self.stream is None and self.source != 'poll':
+                    self.stream = self.open_stream()
+                self.following.set()
+
+                if self.stream is not None:
+                    self.publish(self.read_stream(), 'changestream')
+                else:
+                    self.publish(self.poll(subs), 'poll')
+                    time.sleep(self.interval)
+            except PyMongoError as e:
+                # Dropped connection, stepdown etc. Start over from the last resume token on the next pass
+                log.warning('Live feed error, retrying: %s', e)
+                if self.stream is not None:
+                    self.stream.close()
+                    self.stream = None
+                time.sleep(self.interval)
+
+
+_feed = None
+_feed_lock = threading.Lock()
+
+
+def get_feed(reader, **kwargs):
+    '''
+    The feed for this process, shared by every session like the TimeSeriesStore (created with the first session's reader).
+    '''
+    global _feed
+
+    with _feed_lock:
+        if _feed is None:
+            _feed = LiveFeed(reader, **kwargs)
+
+    return _feed
@@ -0,0 +1,12 @@
+'''
+The metrics registry is common/metrics.py, shared with generate_data/. This puts the repo root on the path,
+so the scripts here (run from this directory) import it as metrics like any sibling module.
+'''
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from common.metrics import *
@@ -0,0 +1,300 @@
+'''
+A local, memory mapped copy of the hourly readings, for analyses that read the same history over and over.
+
+Pulling the full history out of MongoDB means sending every document over the wire and decoding it
+into DataFrames again, every run. The replica keeps each device's readings on disk as plain arrays,
+so reading them is a memory map, and only readings newer than what it already has are ever fetched:
+
+    <dir>/manifest.json         {'columns': [...], 'devices': {id: {'rows': n, 'watermark': ts of its latest reading}}}
+    <dir>/<id>/ts.bin           datetime64[ms], sorted
+    <dir>/<id>/<metric>.bin     float64, one per metric, in the same order as ts
+
+The .bin files are raw little endian arrays with no header, so a sync just appends to them. Only the first
+`rows` of each are valid: the manifest is replaced (atomically) after the data is written, so readers never
+see half a sync, and anything past `rows` left by a sync that died gets cut off by the next one.
+
+Syncing fetches each device's readings with ts after its watermark, so readings that arrive later than
+newer ones from the same device are missed. Re-sync with --full to pick those up.
+
+    python replica.py sync [--dir replica] [--workers 8] [--ids 1 2 3] [--full]
+    python replica.py info
+
+MongoReader(backend='replica') (or MONGOREADER_BACKEND=replica) serves its hourly reads from here.
+The directory is MONGOREADER_REPLICA_DIR, default replica/.
+'''
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+METRICS = ['lumens', 'temp', 'cpu_temp', 'signal', 'charge']
+TS_DTYPE = np.dtype('<M8[ms]')
+VALUE_DTYPE = np.dtype('<f8')
+MANIFEST = 'manifest.json'
+
+log = logging.getLogger(__name__)
+
+
+def default_dir():
+    return os.environ.get('MONGOREADER_REPLICA_DIR', 'replica')
+
+
+def empty_rows(columns=METRICS):
+    df = pd.DataFrame({'id': np.array([], dtype=float), **{c: np.array([], dtype=float) for c in columns}})
+    df.index = pd.DatetimeIndex(np.array([], dtype=TS_DTYPE), name='ts')
+
+    return df
+
+
+class Replica():
+    '''
+    Reads (and, with sync, writes) a replica directory.
+
+    Arrays are mapped on first use and re-mapped when a sync has added rows, so one Replica can stay
+    open in a long running process (or notebook) while syncs run alongside it.
+    '''
+    def __init__(self, path=None, columns=METRICS):
+        self.path = path or default_dir()
+        self.columns = list(columns)
+        self.lock = threading.Lock()
+        self.maps = {}
+        self.manifest = None
+        self.manifest_mtime = None
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Re-reads the manifest if a sync has replaced it since it was last read.
+        '''
+        path = os.path.join(self.path, MANIFEST)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        with self.lock:
+            if self.manifest is not None and mtime == self.manifest_mtime:
+                return
+
+            if mtime is None:
+                self.manifest = {'columns': self.columns, 'devices': {}}
+            else:
+                with open(path) as f:
+                    self.manifest = json.load(f)
+
+                if self.manifest['columns'] != self.columns:
+                    raise ValueError(f'Replica in {self.path} has columns {self.manifest["columns"]}, not {self.columns}')
+
+            self.manifest_mtime = mtime
+
+    def device_ids(self):
+        return sorted(int(i) for i in self.manifest['devices'])
+
+    def rows(self, device_id):
+        return self.manifest['devices'].get(str(device_id), {}).get('rows', 0)
+
+    def watermark(self, device_id):
+        '''
+        The ts of the latest reading the replica has for device_id, or None.
+        '''
+        watermark = self.manifest['devices'].get(str(device_id), {}).get('watermark')
+
+        return None if watermark is None else pd.Timestamp(watermark)
+
+    def device_dir(self, device_id):
+        return os.path.join(self.path, str(device_id))
+
+    def arrays(self, device_id):
+        '''
+        ts and {column: values} for every reading of device_id the replica has, as read only memory maps.
+        '''
+        rows = self.rows(device_id)
+
+        with self.lock:
+            cached = self.maps.get(device_id)
+            if cached is not None and cached[0] == rows:
+                return cached[1], cached[2]
+
+        if rows == 0:
+            ts, columns = np.array([], dtype=TS_DTYPE), {c: np.array([], dtype=VALUE_DTYPE) for c in self.columns}
+        else:
+            folder = self.device_dir(device_id)
+            ts = np.memmap(os.path.join(folder, 'ts.bin'), dtype=TS_DTYPE, mode='r', shape=(rows,))
+            columns = {c: np.memmap(os.path.join(folder, f'{c}.bin'), dtype=VALUE_DTYPE, mode='r', shape=(rows,)) for c in self.columns}
+
+        with self.lock:
+            self.maps[device_id] = (rows, ts, columns)
+
+        return ts, columns
+
+    def slice(self, device_id, start=None, end=None, columns=None):
+        '''
+        Views (no copies, nothing read from disk until used) of device_id's readings with start <= ts < end.
+        '''
+        ts, values = self.arrays(device_id)
+
+        lo = 0 if start is None else ts.searchsorted(np.datetime64(pd.Timestamp(start), 'ms'), side='left')
+        hi = len(ts) if end is None else ts.searchsorted(np.datetime64(pd.Timestamp(end), 'ms'), side='left')
+
+        return ts[lo:hi], {c: values[c][lo:hi] for c in columns or self.columns}
+
+    def device_frame(self, device_id, start=None, end=None, columns=None):
+        '''
+        One device's readings as a ts indexed DataFrame whose index and metric columns are views of the memory maps.
+        '''
+        ts, values = self.slice(device_id, start, end, columns)
+
+        df = pd.DataFrame(values, index=pd.DatetimeIndex(ts, copy=False, name='ts'), copy=False)
+        df.insert(0, 'id', np.full(len(ts), float(device_id)))
+
+        return df
+
+    def fetch_rows(self, dates, ids, columns=None):
+        '''
+        Same as MongoReader.fetch_rows (hourly): rows for ids with dates[0] <= ts < dates[1], ts indexed and sorted.
+        For a single device nothing is copied. Several devices are interleaved by ts, which takes one copy.
+        '''
+        self.refresh()
+
+        frames = [self.device_frame(i, dates[0], dates[1], columns) for i in ids if self.rows(i)]
+        frames = [f for f in frames if not f.empty]
+        if not frames:
+            return empty_rows(columns or self.columns)
+        if len(frames) == 1:
+            return frames[0]
+
+        # Stable, so rows with the same ts stay in id order like MongoReader.fetch_rows
+        return pd.concat(frames).sort_index(kind='stable')
+
+    def read_all(self, columns=None):
+        '''
+        Every reading of every device, in the read_frame shape (ts a column, device by device).
+        '''
+        self.refresh()
+
+        frames = [self.device_frame(i, columns=columns).reset_index() for i in self.device_ids()]
+        if not frames:
+            return empty_rows(columns or self.columns).reset_index()[['id', 'ts'] + list(columns or self.columns)]
+
+        return pd.concat(frames, ignore_index=True)[['id', 'ts'] + list(columns or self.columns)]
+
+    def append(self, device_id, df, rows):
+        '''
+        Appends df's readings (sorted, all newer than the device's watermark) after the first `rows` valid rows
+        of device_id's files, cutting off anything a failed sync left past them. Returns the new row count.
+        '''
+        folder = self.device_dir(device_id)
+        os.makedirs(folder, exist_ok=True)
+
+        arrays = {'ts': df['ts'].to_numpy(dtype=TS_DTYPE)}
+        arrays.update({c: df[c].to_numpy(dtype=VALUE_DTYPE) for c in self.columns})
+
+        for name, values in arrays.items():
+            path = os.path.join(folder, f'{name}.bin')
+            with open(path, 'ab') as f:
+                f.truncate(rows * values.dtype.itemsize)
+                values.tofile(f)
+
+        return rows + len(df)
+
+    def write_manifest(self):
+        tmp = os.path.join(self.path, f'{MANIFEST}.{os.getpid()}')
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def sync_device(self, reader, device_id, full=False):
+        '''
+        Fetches device_id's readings newer than its watermark (all of them with full=True) and appends them.
+        Returns how many were added.
+        '''
+        watermark = None if full else self.watermark(device_id)
+        rows = 0 if full else self.rows(device_id)
+
+        query = {'id': device_id}
+        if watermark is not None:
+            query['ts'] = {'$gt': watermark.to_pydatetime()}
+
+        df = reader.read_frame(query)
+        if df.empty:
+            return 0
+
+        df = df.sort_values('ts', kind='stable')
+        rows = self.append(device_id, df, rows)
+
+        with self.lock:
+            self.manifest['devices'][str(device_id)] = {'rows': rows, 'watermark': pd.Timestamp(df['ts'].iloc[-1]).isoformat()}
+
+        return len(df)
+
+    def sync(self, reader, ids=None, workers=8, full=False):
+        '''
+        Brings the replica up to date with reader's hourly readings for ids (default every device in the collection),
+        several devices at a time. The manifest is written once everything has been fetched, or whatever was
+        fetched if it fails partway, so every device's rows and watermark always match what's on disk.
+        '''
+        self.refresh()
+        os.makedirs(self.path, exist_ok=True)
+
+        if ids is None:
+            ids = sorted(int(i) for i in reader.coll.distinct('id'))
+
+        if full:
+            # New files from scratch for the devices being re-synced, rather than truncating under open memory maps
+            with self.lock:
+                for i in ids:
+                    self.manifest['devices'].pop(str(i), None)
+                    shutil.rmtree(self.device_dir(i), ignore_errors=True)
+
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                added = sum(pool.map(lambda i: self.sync_device(reader, i), ids))
+        finally:
+            self.write_manifest()
+
+        log.info('Synced %d devices in %.1fs: %d new readings, %d in the replica', len(ids), time.perf_counter() - start, added, self.total_rows())
+
+        return added
+
+    def total_rows(self):
+        return sum(d['rows'] for d in self.manifest['devices'].values())
+
+    def print_info(self):
+        self.refresh()
+
+        size = 0
+        for root, _, files in os.walk(self.path):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+
+        watermarks = [d['watermark'] for d in self.manifest['devices'].values()]
+        print(f'{self.path}: {len(watermarks)} devices, {self.total_rows()} readings, {size / 1e6:.1f}MB')
+        if watermarks:
+            print(f'Watermarks from {min(watermarks)} to {max(watermarks)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep a local memory mapped replica of the sensor readings')
+    parser.add_argument('command', choices=['sync', 'info'])
+    parser.add_argument('--dir', default=None, help='replica directory (default MONGOREADER_REPLICA_DIR or replica/)')
+    parser.add_argument('--ids', type=int, nargs='*', default=None, help='devices to sync (default all of them)')
+    parser.add_argument('--workers', type=int, default=8, help='devices fetched concurrently')
+    parser.add_argument('--full', action='store_true', help='fetch every reading again instead of only ones past the watermarks')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    replica = Replica(args.dir)
+
+    if args.command == 'sync':
+        from MongoReader import MongoReader
+
+        replica.sync(MongoReader(backend='mongo'), ids=args.ids, workers=args.workers, full=args.full)
+
+    replica.print_info()
@@ -0,0 +1,113 @@
+'''
+The error tables saved to disk, so a restarted (or newly started) dashboard process doesn't have to
+compute them from the whole history again before anyone can see them.
+
+    <dir>/snapshot.json             the data watermark the tables were computed at, when, and which version holds them
+    <dir>/<version>/<table>.parquet one per error table
+    <dir>/<version>/detectors.npz   the DetectionEngine's state, so it carries on scoring from where it was
+
+A snapshot is only used while the data's watermark (MongoReader.get_watermark) is the same as when it was written.
+Every save goes into a new version directory and snapshot.json is swapped in last, so several
+`panel serve` processes can share a directory without ever reading half of someone else's snapshot.
+
+The directory is VIEWER_SNAPSHOT_DIR (default snapshots/). Parquet needs pyarrow, without it nothing is saved.
+'''
+import os
+import json
+import logging
+import time
+import shutil
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.environ.get('VIEWER_SNAPSHOT_DIR', 'snapshots')
+INDEX_FILE = 'snapshot.json'
+ENGINE_FILE = 'detectors.npz'
+
+
+def read_index(path):
+    try:
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_snapshot(tables, watermark, engine=None, path=SNAPSHOT_DIR):
+    '''
+    Saves {name: DataFrame} as computed at watermark, along with the engine's state if given.
+    Returns the version directory, or None if it couldn't be saved.
+    '''
+    if pyarrow is None:
+        log.warning('Not saving an error table snapshot: pyarrow is not installed (pip install pyarrow)')
+        return None
+
+    version = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{time.perf_counter_ns() % 10 ** 6}'
+    version_dir = os.path.join(path, version)
+
+    try:
+        os.makedirs(version_dir)
+
+        for name, df in tables.items():
+            df.to_parquet(os.path.join(version_dir, f'{name}.parquet'))
+
+        if engine is not None:
+            engine.save(os.path.join(version_dir, ENGINE_FILE))
+
+        previous = read_index(path)
+
+        tmp = os.path.join(path, f'{INDEX_FILE}.{version}')
+        with open(tmp, 'w') as f:
+            json.dump({'version': version, 'watermark': watermark, 'saved': time.time(), 'tables': list(tables)}, f)
+        os.replace(tmp, os.path.join(path, INDEX_FILE))
+    except OSError as e:
+        log.warning('Could not save the error table snapshot to %s: %s', version_dir, e)
+        shutil.rmtree(version_dir, ignore_errors=True)
+        return None
+
+    # Whoever still has the previous version open on this machine keeps their file handles, so it's safe to delete
+    if previous is not None and previous['version'] != version:
+        shutil.rmtree(os.path.join(path, previous['version']), ignore_errors=True)
+
+    log.info('Saved error table snapshot %s', version)
+
+    return version_dir
+
+
+def load_snapshot(watermark, engine=None, path=SNAPSHOT_DIR):
+    '''
+    {name: DataFrame} from the last snapshot, if it was computed at this watermark, otherwise None.
+
+    Also restores the engine's state from it if the engine hasn't seen any data yet, even when the tables
+    are out of date: the engine only scores readings past its own watermark, so recomputing then
+    only has to look at the new data, like it would in a process that had been running all along.
+    '''
+    index = read_index(path)
+    if index is None or pyarrow is None:
+        return None
+
+    version_dir = os.path.join(path, index['version'])
+    try:
+        engine_path = os.path.join(version_dir, ENGINE_FILE)
+        if engine is not None and os.path.exists(engine_path):
+            engine.load(engine_path)
+
+        if index['watermark'] != watermark:
+            log.info('Error table snapshot %s is out of date (data has changed since)', index['version'])
+            return None
+
+        tables = {name: pd.read_parquet(os.path.join(version_dir, f'{name}.parquet')) for name in index['tables']}
+    except OSError as e:
+        # Replaced and deleted by another process between reading the index and the tables
+        log.warning('Could not load error table snapshot %s: %s', index['version'], e)
+        return None
+
+    log.info('Loaded error table snapshot %s, saved %.0fs ago', index['version'], time.time() - index['saved'])
+
+    return tables
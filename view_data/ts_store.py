@@ -0,0 +1,297 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from metrics import gauge
+
+log = logging.getLogger(__name__)
+
+METRICS = ['lumens', 'temp', 'cpu_temp', 'signal', 'charge']
+
+
+class Chunk():
+    '''
+    One device's readings for one month: a sorted datetime64 index and a contiguous float32 array per metric.
+    '''
+    def __init__(self, ts, columns):
+        self.ts = ts
+        self.columns = columns
+        self.nbytes = ts.nbytes + sum(a.nbytes for a in columns.values())
+
+    def slice(self, start, end, columns):
+        '''
+        Views (no copies) of the rows in [start, end) for the given columns.
+        '''
+        lo = self.ts.searchsorted(start, side='left')
+        hi = self.ts.searchsorted(end, side='left')
+
+        return self.ts[lo:hi], {c: self.columns[c][lo:hi] for c in columns}
+
+
+class TimeSeriesStore():
+    '''
+    Process wide, read optimized store of readings, shared by every chart and Panel session on the server.
+
+    Data is held as per device, per month Chunks. A request only fetches the (device, month) chunks
+    that aren't loaded yet, and everything else is served by slicing the loaded chunks.
+    Chunks are evicted least recently used first once max_bytes is exceeded, and hits/misses are counted per chunk.
+
+    fetch(dates, ids) must return a ts indexed, sorted DataFrame with an id column, like MongoReader.fetch_rows.
+
+    watermark() (like MongoReader.get_watermark) is checked at most every max_age seconds. When it has changed,
+    the chunks for months that were still open (not over as of the previous latest reading) are dropped, so the
+    next request fetches those months again with the new readings. Readings that arrive for months that were
+    already over aren't picked up. Without a watermark chunks are never refreshed.
+    '''
+    def __init__(self, fetch, max_bytes=512 * 1024 * 1024, watermark=None, max_age=30):
+        self.fetch = fetch
+        self.max_bytes = max_bytes
+        self.watermark = watermark
+        self.max_age = max_age
+        self.chunks = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.checked = None
+        self.last_watermark = None
+        self.generation = 0
+        self.derived = {}
+        self.derived_locks = {}
+
+    def get_chunks(self, ids, months):
+        '''
+        Returns {(id, month): Chunk} for every requested pair, fetching the ones not loaded yet.
+        '''
+        self.refresh()
+
+        wanted = [(i, m) for i in ids for m in months]
+
+        found = self.lookup(wanted, count=True)
+        missing = [k for k in wanted if k not in found]
+
+        # Each (id, month) is fetched by one request at a time: a request loads the chunks nobody else is
+        # loading and waits for the rest, so sessions asking for the same data don't all query it,
+        # and ones asking for different data don't wait for each other
+        while missing:
+            claimed, waiting = [], set()
+            with self.lock:
+                for key in missing:
+                    event = self.loading.get(key)
+                    if event is None:
+                        self.loading[key] = threading.Event()
+                        claimed.append(key)
+                    else:
+                        waiting.add(event)
+
+            if claimed:
+                try:
+                    found.update(self.load(claimed))
+                finally:
+                    with self.lock:
+                        for key in claimed:
+                            self.loading.pop(key).set()
+
+            for event in waiting:
+                event.wait()
+
+            # Whatever the others loaded (if their fetch failed, or it's been evicted already, go round again)
+            found.update(self.lookup([k for k in missing if k not in found]))
+            missing = [k for k in wanted if k not in found]
+
+        return found
+
+    def refresh(self):
+        '''
+        Drops the chunks of months that were still open if the data's watermark has changed (see the class docstring).
+        '''
+        if self.watermark is None:
+            return
+
+        with self.lock:
+            if self.checked is not None and time.monotonic() - self.checked < self.max_age:
+                return
+            self.checked = time.monotonic()
+
+        watermark = self.watermark()
+
+        with self.lock:
+            previous, self.last_watermark = self.last_watermark, watermark
+            if previous is None or previous == watermark:
+                return
+
+            # Months ending after the latest reading there was could have had readings added since
+            last = previous.get('ts_max')
+            stale = [k for k in self.chunks if last is None or k[1] >= to_ns(last).astype('datetime64[M]')]
+            for key in stale:
+                self.bytes -= self.chunks.pop(key).nbytes
+
+            # Anything being fetched right now may have missed the new readings too, so it isn't kept
+            self.generation += 1
+
+        if stale:
+            log.info('Data changed, dropped %d chunks of open months', len(stale))
+
+    def lookup(self, keys, count=False):
+        found = {}
+        with self.lock:
+            for key in keys:
+                chunk = self.chunks.get(key)
+                if chunk is not None:
+                    self.chunks.move_to_end(key)
+                    found[key] = chunk
+
+            if count:
+                self.hits += len(found)
+                self.misses += len(keys) - len(found)
+
+        return found
+
+    def load(self, keys):
+        '''
+        Fetches whole months for the missing (id, month) pairs and splits them into chunks. Each query covers
+        a run of consecutive months missing the same ids and asks only for those ids, so a device that's
+        only missing one month doesn't pull in the others.
+        '''
+        generation = self.generation
+
+        missing = {}
+        for device_id, month in keys:
+            missing.setdefault(month, set()).add(device_id)
+
+        runs = []
+        for month in sorted(missing):
+            ids = missing[month]
+            if runs and runs[-1][1] + 1 == month and runs[-1][2] == ids:
+                runs[-1][1] = month
+            else:
+                runs.append([month, month, ids])
+
+        loaded = {}
+        for first, last, ids in runs:
+            df = self.fetch((pd.Timestamp(first).to_pydatetime(), pd.Timestamp(last + 1).to_pydatetime()), sorted(ids))
+
+            ts = df.index.to_numpy(dtype='datetime64[ns]')
+            device_ids = df['id'].to_numpy()
+            month_of_row = ts.astype('datetime64[M]')
+
+            for month in np.arange(first, last + 1):
+                for device_id in ids:
+                    mask = (device_ids == device_id) & (month_of_row == month)
+
+                    columns = {c: np.ascontiguousarray(df[c].to_numpy()[mask], dtype=np.float32) for c in METRICS}
+                    loaded[(device_id, month)] = Chunk(np.ascontiguousarray(ts[mask]), columns)
+
+        with self.lock:
+            if generation != self.generation:
+                return loaded
+
+            for key, chunk in loaded.items():
+                old = self.chunks.pop(key, None)
+                if old is not None:
+                    self.bytes -= old.nbytes
+
+                self.chunks[key] = chunk
+                self.bytes += chunk.nbytes
+
+            while self.bytes > self.max_bytes and len(self.chunks) > len(loaded):
+                _, evicted = self.chunks.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+        return loaded
+
+    def slices(self, dates, ids, columns=METRICS):
+        '''
+        Zero copy access: yields (id, ts view, {column: view}) for every chunk overlapping [dates[0], dates[1]).
+        '''
+        start, end = to_ns(dates[0]), to_ns(dates[1])
+        ids = sorted(set(int(i) for i in ids))
+        months = month_range(start, end)
+
+        chunks = self.get_chunks(ids, months)
+
+        for device_id in ids:
+            for month in months:
+                ts, cols = chunks[(device_id, month)].slice(start, end, columns)
+                if ts.shape[0]:
+                    yield device_id, ts, cols
+
+    def get_frame(self, dates, ids, columns=METRICS):
+        '''
+        Rows for ids in [dates[0], dates[1]) as a ts indexed, sorted DataFrame with an id column
+        and only the requested columns. This is the one place the chunk views get copied.
+        '''
+        parts = list(self.slices(dates, ids, columns))
+
+        if not parts:
+            df = pd.DataFrame({'id': pd.Series(dtype=float), **{c: pd.Series(dtype=np.float32) for c in columns}})
+            return df.set_index(pd.DatetimeIndex([], name='ts'))
+
+        df = pd.DataFrame({
+            'id': np.concatenate([np.full(ts.shape[0], float(device_id)) for device_id, ts, _ in parts]),
+            **{c: np.concatenate([cols[c] for _, _, cols in parts]) for c in columns}
+        }, index=pd.DatetimeIndex(np.concatenate([ts for _, ts, _ in parts]), name='ts'))
+
+        return df.sort_index(kind='stable')
+
+    def shared(self, key, compute, max_age=300):
+        '''
+        Results derived from the data (like the error tables) computed once and shared by every
+        session, recomputed when older than max_age seconds.
+        Sessions asking while it's being computed wait for that result rather than computing it again.
+        '''
+        with self.lock:
+            cached = self.derived.get(key)
+            key_lock = self.derived_locks.setdefault(key, threading.Lock())
+        if cached is not None and time.monotonic() - cached[0] < max_age:
+            return cached[1]
+
+        with key_lock:
+            with self.lock:
+                cached = self.derived.get(key)
+            if cached is not None and time.monotonic() - cached[0] < max_age:
+                return cached[1]
+
+            value = compute()
+            with self.lock:
+                self.derived[key] = (time.monotonic(), value)
+
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'chunks': len(self.chunks), 'bytes': self.bytes}
+
+
+def to_ns(value):
+    return np.datetime64(pd.Timestamp(value).to_datetime64(), 'ns')
+
+
+def month_range(start, end):
+    '''
+    Every month with any time in [start, end).
+    '''
+    return list(np.arange(start.astype('datetime64[M]'), (end - np.timedelta64(1, 'ns')).astype('datetime64[M]') + 1))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store(reader, **kwargs):
+    '''
+    The store for this process. Panel re-runs viewer.py for every session, but this module is only imported
+    once, so every session gets the same store (created with the first session's reader).
+    '''
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            _store = TimeSeriesStore(reader.fetch_rows, watermark=reader.get_watermark, **kwargs)
+
+            for stat in ('hits', 'misses', 'chunks', 'bytes'):
+                gauge(f'ts_store_{stat}', f'TimeSeriesStore {stat}', fn=lambda stat=stat: _store.stats()[stat])
+
+    return _store
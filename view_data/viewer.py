@@ -1,10 +1,39 @@
+import os
+import asyncio
+import logging
+from functools import partial
 import panel as pn
 import hvplot.pandas
+import holoviews as hv
 import pandas as pd
 import numpy as np
-from MongoReader import MongoReader
+from MongoReader import get_reader
+from AsyncMongoReader import AsyncMongoReader
+from ts_store import get_store, METRICS
+from downsample import downsample_frame, choose_lod, to_timestamp, LOD_METHODS
+from detectors import get_engine
+from snapshot import load_snapshot, save_snapshot
+from live import get_feed
+from metrics import histogram
+from instrument import callback, serve_metrics
 import datetime as dt
 
+log = logging.getLogger(__name__)
+
+# panel serve gives the root logger a handler but leaves it at WARNING, so the dashboard's modules get their
+# own level: VIEWER_LOG_LEVEL, default INFO (DEBUG for the per-query and per-plot messages).
+# basicConfig only does anything when run without panel serve.
+logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+for name in ('MongoReader', 'ts_store', 'live', 'snapshot', 'instrument', 'replica', __name__):
+    logging.getLogger(name).setLevel(os.environ.get('VIEWER_LOG_LEVEL', 'INFO').upper())
+
+
+PLOT_SECONDS = histogram('viewer_plot_seconds', 'Time getting the data for a chart (stage=data) and building the plot from it (stage=render)')
+ERROR_TABLE_SECONDS = histogram('viewer_error_tables_seconds', 'Time computing the error tables, by stage')
+
+# Hours of each device's latest readings a live chart shows (and keeps, as new ones are appended)
+LIVE_HOURS = int(os.environ.get('VIEWER_LIVE_HOURS', 72))
+
 
 class Viewer():
     '''
@@ -12,15 +41,50 @@ class Viewer():
     '''
     def __init__(self, mongo):
         self.mongodb = mongo
-        self.prev_date = (dt.datetime(2022, 1, 1), dt.datetime(2022, 1, 31))
-        self.mongodb.get_rows(self.prev_date, [0, 1, 2, 3, 4])
+        # Shared by every session in this process, so only the first one pays for loading data
+        self.store = get_store(self.mongodb)
+        self.async_reader = AsyncMongoReader(self.mongodb)
+        self.plots = {}
+        self.live = {}
+        # The latest live plot call per chart, so an older one that finishes later backs off
+        self.live_calls = {}
         self.query_cnt = 0
-        
-        self.potential_errors()
+
+        # Nothing is queried until the page asks for it: the charts and the error table load asynchronously
+        self.error_tables = None
 
     def potential_errors(self):
         '''
-        Queries all data from MongoDB to look for potential hardware problems.
+        Gets the error tables, computed at most once every few minutes for all sessions (see load_error_tables).
+        '''
+        self.error_tables = self.store.shared('error_tables', self.load_error_tables)
+
+        return self.error_tables
+
+    def load_error_tables(self):
+        '''
+        The error tables from the snapshot on disk if no data has arrived since it was saved (see snapshot.py),
+        otherwise computed with find_errors and saved as the new snapshot.
+
+        The watermark is read before computing, so data that arrives meanwhile makes the next call recompute.
+        '''
+        watermark = self.mongodb.get_watermark()
+
+        with ERROR_TABLE_SECONDS.time(stage='snapshot_load'):
+            tables = load_snapshot(watermark, get_engine())
+        if tables is not None:
+            return tables
+
+        tables = self.find_errors()
+
+        with ERROR_TABLE_SECONDS.time(stage='snapshot_save'):
+            save_snapshot(tables, watermark, get_engine())
+
+        return tables
+
+    def find_errors(self):
+        '''
+        Uses per device stats from MongoDB to look for potential hardware problems.
 
         Creates a DF for each problem defined, to be displayed in the dashboard later.
 
@@ -29,19 +93,17 @@ class Viewer():
             2. Devices that stopped reporting data
             3. Devices with potential signal problems
             4. Devices with potential CPU Temp problems
+            5. Readings the anomaly detectors flag (see detectors.py), one table per detector
         '''
-        start = dt.datetime.now()
-        self.mongodb.get_all_rows()
-        print(f'Getting all rows took {dt.datetime.now() - start}')
+        # Use the summaries the ingest consumer keeps up to date, and only aggregate the raw readings if there aren't any.
+        # Either way, one row per device comes back rather than every reading
+        with ERROR_TABLE_SECONDS.time(stage='summaries'):
+            summaries = self.mongodb.get_health_summaries()
+            if summaries is None:
+                summaries = self.mongodb.get_device_summaries()
 
-        # Let's see if I can't just do all the aggregation at once
-        agg_dict = {
-            'ts': ['min', 'max', 'count'],
-            'signal': ['min', 'max', 'mean']
-        }
+        missing_df, cpu_temp_df = summaries
 
-        missing_df = self.mongodb.full_df.groupby('id').agg(agg_dict)
-        missing_df.columns = ['_'.join(col).strip() for col in missing_df.columns.values]
         missing_max_df = missing_df.copy()
         signal_df = missing_df.copy()
 
@@ -90,12 +152,7 @@ class Viewer():
         }, axis=1)
 
         # CPU TEMP
-        # Safe range is assumed to be 104-122F. Find count of records where temp is too high
-        cpu_temp_df = self.mongodb.full_df[self.mongodb.full_df['cpu_temp'] > 122]
-        cpu_temp_df = cpu_temp_df.groupby('id').agg({'cpu_temp': ['max', 'count']})
-
-        cpu_temp_df.columns = ['_'.join(col).strip() for col in cpu_temp_df.columns.values]
-
+        # Safe range is assumed to be 104-122F. Count of records where temp is too high comes from get_device_summaries
         cpu_temp_df = cpu_temp_df.sort_values(by=['cpu_temp_count', 'cpu_temp_max'], ascending=False)
 
         cpu_temp_df = cpu_temp_df.rename({
@@ -103,71 +160,243 @@ class Viewer():
             'cpu_temp_count': 'Record Count'
         }, axis=1)
 
-        self.error_tables = {
+        return {
             'missing_records': missing_df,
             'max_date': missing_max_df,
             'signal': signal_df,
-            'cpu_temp': cpu_temp_df
+            'cpu_temp': cpu_temp_df,
+            **self.detect_anomalies(summaries[0])
         }
 
-        a=1
+    def detect_anomalies(self, summary):
+        '''
+        Runs the shared detection engine over readings newer than what it's already seen, for every device in summary.
+        '''
+        engine = get_engine()
+
+        with ERROR_TABLE_SECONDS.time(stage='detection'):
+            if not summary.empty:
+                ids = summary.index.astype(int)
+                since = pd.Series(engine.since(list(ids)), index=ids, dtype='datetime64[ns]').fillna(summary['ts_min'].set_axis(ids))
+                until = summary['ts_max'].set_axis(ids) + pd.Timedelta(hours=1)
 
+                # Only devices with readings past their watermark, one read per group of devices up to the same hour
+                since = since[since < until]
+                frames = [self.store.get_frame((start, until[group].max()), list(group)) for start, group in since.groupby(since).groups.items()]
+                if frames:
+                    engine.update(pd.concat(frames))
 
-    def select_column(self, column='signal'):
+            return engine.findings()
+
+
+    def select_column(self, df, column='signal'):
         '''
-        Returns the df currently stored in the MongoDB object filtered to a given column.
+        Returns the given df filtered to a given column.
         '''
-        return self.mongodb.df[['id', column]]
+        return df[['id', column]]
 
 
-    def update_df(self, dates, ids):
+    def update_df(self, dates, ids, columns=METRICS):
         '''
         Given a tuple of datetimes and a list of ids (other iterables would prolly work)
 
-        Requery the mongodb database and store in the mongodb connector object.
+        Get the rows from the shared store, so only device months not already loaded are queried.
+        Returns the df rather than storing it, since both charts call this at the same time.
         '''
-        self.mongodb.get_rows(dates, ids)
+        return self.store.get_frame(dates, ids, columns)
 
-    def create_plot(self, variable='signal', dates_given=(dt.datetime(2022, 1, 1), dt.datetime(2022, 2, 1)), ids=[0, 1, 2, 3, 4], window=10):
+    def plot_frame(self, variable, start, end, ids, lod='auto', width=900):
         '''
-        Create a plot using the df currently in the mongodb object.
-        Refresh it using given params first.
-
-        Then line chart.
+        The id/variable rows to draw for [start, end), at the level of detail for the chart width.
         '''
-        print(f'Creating a plot for {variable}, with dates {dates_given} and ids {ids}')
+        start, end = to_timestamp(start), to_timestamp(end)
+        method = choose_lod(start, end, width) if lod == 'auto' else lod
 
-        self.update_df(dates_given, ids)
-        print('df updated')
+        if method in ('daily', 'weekly'):
+            # Read the rollup collection for that resolution rather than loading every hourly reading
+            df = self.mongodb.fetch_rows((start.to_pydatetime(), end.to_pydatetime()), ids, resolution=method)
 
-        print(f'variable/colname: {variable}')
-        plottable = self.select_column(variable)
-        
-        print('printing plottable.info()')
-        print(plottable.info())
+            if not df.empty:
+                return self.select_column(df, variable)
+
+        df = self.update_df((start, end), ids, [variable])
+        log.debug('df updated, store: %s', self.store.stats())
 
+        return downsample_frame(self.select_column(df, variable), variable, start, end, width=width, method=method)
+
+    def create_plot(self, variable='signal', dates_given=(dt.datetime(2022, 1, 1), dt.datetime(2022, 2, 1)), ids=[0, 1, 2, 3, 4], window=10, lod='auto', width=900, initial=None, chart=None):
+        '''
+        Create a plot for the given params, using cached data where possible.
+
+        Then line chart, downsampled to what fits in the chart width (see downsample.py for the lod options).
+        Daily/weekly detail comes from the rollup collections when they've been populated.
+        The chart is a DynamicMap fed by a Pipe, and zooming fetches the zoomed range at a finer level of detail
+        on the reader's thread pool (like create_plot_async, superseding anything else running for chart),
+        then sends it down the Pipe. The event loop only ever draws.
+
+        initial is the plot_frame for dates_given, if it's already been fetched (see create_plot_async).
+        '''
         self.query_cnt += 1
-        print(f'query counter: {self.query_cnt}')
-        return plottable.hvplot.line(y=variable, by='id', height=500, width=900, legend=True)
+        log.debug('Creating plot %d for %s, with dates %s and ids %s', self.query_cnt, variable, dates_given, ids)
+
+        if initial is None:
+            with PLOT_SECONDS.time(stage='data', lod=lod):
+                initial = self.plot_frame(variable, dates_given[0], dates_given[1], ids, lod, width)
+
+        def view(data):
+            with PLOT_SECONDS.time(stage='render', lod=lod):
+                return data.hvplot.line(y=variable, by='id', height=500, width=width, legend=True)
+
+        if lod == 'raw':
+            return view(initial)
+
+        pipe = hv.streams.Pipe(data=initial)
+        plot = hv.DynamicMap(view, streams=[pipe])
+
+        async def refine(x_range):
+            try:
+                with PLOT_SECONDS.time(stage='data', lod=lod):
+                    df = await self.async_reader.run(self.plot_frame, variable, x_range[0], x_range[1], ids, lod, width, key=chart)
+            except asyncio.CancelledError:
+                # Zoomed again, or the chart was replaced, before this range came back
+                return
+
+            # On the next tick, with the document lock held
+            pn.state.execute(partial(pipe.send, df), schedule=True)
+
+        def on_zoom(x_range):
+            if x_range is not None:
+                pn.state.execute(partial(refine, x_range))
+
+        hv.streams.RangeX(source=plot).add_subscriber(on_zoom)
+
+        return plot
 
         '''
         mongodb query to search between two dates:
             db['raw-sensor-data'].find({ts:{$gte:ISODate('2020-01-01'),$lt:ISODate('2020-01-02')}})
         '''
 
-    def create_table(self, table_name=''):
+    @callback('create_plot')
+    async def create_plot_async(self, chart, variable='signal', dates_given=(dt.datetime(2022, 1, 1), dt.datetime(2022, 2, 1)), ids=[0, 1, 2, 3, 4], window=10, lod='auto', width=900, live=False):
+        '''
+        What the dashboard binds the charts to.
+
+        Fetches the data for dates_given on the reader's thread pool, so widgets and the other chart stay
+        responsive (and both charts load at the same time), then builds the plot from it.
+        A newer widget change for the same chart cancels this call's query, and this one leaves the current plot up.
+
+        With live=True the chart follows the latest readings instead (see create_live_plot), ignoring dates_given and lod.
+        '''
+        if live:
+            return await self.create_live_plot(chart, variable, ids, width)
+
+        try:
+            with PLOT_SECONDS.time(stage='data', lod=lod):
+                initial = await self.async_reader.run(self.plot_frame, variable, dates_given[0], dates_given[1], ids, lod, width, key=chart)
+        except asyncio.CancelledError:
+            log.debug('Plot for %s superseded by a newer one', chart)
+            return self.plots.get(chart)
+
+        self.stop_live(chart)
+        self.plots[chart] = self.create_plot(variable, dates_given, ids, window, lod, width, initial=initial, chart=chart)
+
+        return self.plots[chart]
+
+    def live_frame(self, variable, ids, hours=LIVE_HOURS):
+        '''
+        The last `hours` of each device's readings (up to its latest one) as ts/id/variable columns,
+        and {id: ts of its latest reading} to follow the live feed from.
+        '''
+        latest = self.mongodb.latest_ts(ids)
+        if not latest:
+            return pd.DataFrame({'ts': pd.Series(dtype='datetime64[ns]'), 'id': pd.Series(dtype=float), variable: pd.Series(dtype=float)}), latest
+
+        window = pd.Timedelta(hours=hours)
+        df = self.mongodb.fetch_rows(((min(latest.values()) - window).to_pydatetime(), (max(latest.values()) + pd.Timedelta(hours=1)).to_pydatetime()), list(latest))
+        df = df.reset_index()[['ts', 'id', variable]]
+
+        # The devices don't all stop at the same time, so trim each one to its own window
+        df = df[df['ts'] > df['id'].map(latest) - window]
+
+        return df.reset_index(drop=True), latest
+
+    async def create_live_plot(self, chart, variable, ids, width=900):
+        '''
+        A chart of the last LIVE_HOURS of readings for ids, that new readings are appended to as they arrive.
+
+        Only the initial window is queried. After that the process wide live feed (live.py) hands this chart
+        just the new readings for its ids, and a periodic callback sends them into a Buffer. The Buffer keeps
+        the latest LIVE_HOURS * (number of devices shown) rows in total, oldest dropped first, so neither the
+        query nor the browser's data grows with time. It's a cap on the total, not per device, so a device
+        that reports more often than hourly keeps a shorter window than the others.
+        '''
+        call = self.live_calls[chart] = object()
+
+        try:
+            initial, latest = await self.async_reader.run(self.live_frame, variable, ids, key=chart)
+        except asyncio.CancelledError:
+            log.debug('Live plot for %s superseded by a newer one', chart)
+            return self.plots.get(chart)
+
+        buffer = hv.streams.Buffer(initial, length=LIVE_HOURS * max(len(ids), 1), index=False)
+        feed = get_feed(self.mongodb)
+        # Catching up with what arrived since the window was read is a query too
+        sub = await self.async_reader.run(feed.subscribe, ids, latest)
+
+        if self.live_calls.get(chart) is not call:
+            # The chart has been asked for again (live or not) meanwhile
+            feed.unsubscribe(sub)
+            return self.plots.get(chart)
+
+        self.stop_live(chart)
+
+        def append():
+            df = sub.drain()
+            if df is not None:
+                buffer.send(df[['ts', 'id', variable]])
+
+        periodic = pn.state.add_periodic_callback(append, period=int(feed.interval * 1000))
+        self.live[chart] = (sub, periodic)
+
+        def view(data):
+            return data.hvplot.line(x='ts', y=variable, by='id', height=500, width=width, legend=True)
+
+        self.plots[chart] = hv.DynamicMap(view, streams=[buffer])
+
+        return self.plots[chart]
+
+    def stop_live(self, chart=None):
+        '''
+        Stops feeding the live plot on chart (or every chart), if there is one.
+        '''
+        for name in [chart] if chart else list(self.live) + list(self.live_calls):
+            self.live_calls.pop(name, None)
+            live = self.live.pop(name, None)
+            if live is not None:
+                sub, periodic = live
+                periodic.stop()
+                get_feed(self.mongodb).unsubscribe(sub)
+
+    @callback('create_table')
+    async def create_table(self, table_name=''):
         '''
         Creates a table object from the selected radio button options.
 
-        Decodes the radio options that are human readable to keys in the dictionary
+        Decodes the radio options that are human readable to keys in the dictionary.
+        The first call loads the error tables on the reader's thread pool, so the rest of the page is usable meanwhile.
         '''
-        print(f'Creating table for {table_name}')
+        if self.error_tables is None:
+            await self.async_reader.run(self.potential_errors)
+
+        log.debug('Creating table for %s', table_name)
 
         table_name = {
             'Missing Many Records': 'missing_records',
             'No New Data': 'max_date',
             'Too little signal': 'signal',
-            'CPU Temp': 'cpu_temp'
+            'CPU Temp': 'cpu_temp',
+            **{d.label: d.name for d in get_engine().detectors}
         }[table_name]
 
         df = self.error_tables[table_name]
@@ -182,10 +411,11 @@ class Viewer():
         '''
         creates plots/charts/widgets/everything, main driver function
         '''
-        available_columns = [c for c in self.mongodb.df.columns if c not in ['_id', 'id', 'Unnamed: 0', 'ts']]
+        available_columns = list(METRICS)
         available_ids = list(range(0, 150))
 
         pn.extension(design='material')
+        serve_metrics()
 
         ############ Set up widgets
 
@@ -198,32 +428,40 @@ class Viewer():
         # TODO: Sort this based on any results from the table_issue_selector
         id_selector = pn.widgets.MultiChoice(name='ID Selector', options=available_ids, value=[0,1,2,3,4], max_items=10)
 
+        lod_selector = pn.widgets.Select(name='Level of Detail', value='auto', options=LOD_METHODS)
+
+        # Follow the latest readings instead of the date range
+        live_toggle = pn.widgets.Toggle(name='Live', value=False, button_type='success')
+
         # Create charts dependent on widgets
-        col_chart1 = pn.bind(self.create_plot, variable=colname_widget1, dates_given=date_picker, ids=id_selector, window=10)
-        col_chart2 = pn.bind(self.create_plot, variable=colname_widget2, dates_given=date_picker, ids=id_selector, window=10)
+        col_chart1 = pn.bind(self.create_plot_async, 'chart1', variable=colname_widget1, dates_given=date_picker, ids=id_selector, window=10, lod=lod_selector, live=live_toggle)
+        col_chart2 = pn.bind(self.create_plot_async, 'chart2', variable=colname_widget2, dates_given=date_picker, ids=id_selector, window=10, lod=lod_selector, live=live_toggle)
+
+        # Live charts are fed until the session goes away
+        pn.state.on_session_destroyed(lambda session_context: self.stop_live())
 
         ### Stuff for error table
         # Table issue selector
         table_issue_selector = pn.widgets.RadioBoxGroup(name='Error Type Box Group', 
-                options=['Missing Many Records', 'No New Data', 'Too little signal', 'CPU Temp'],
+                options=['Missing Many Records', 'No New Data', 'Too little signal', 'CPU Temp'] + [d.label for d in get_engine().detectors],
                 value = 'No New Data', inline=True
         )
 
         # Create table of potential issues
-        missing_records_table = pn.bind(self.create_table, table_name=table_issue_selector)
+        missing_records_table = pn.panel(pn.bind(self.create_table, table_name=table_issue_selector), defer_load=True, loading_indicator=True)
 
 
         gb = pn.GridBox(
                 pn.Row(pn.layout.HSpacer(margin=10), pn.pane.Markdown('# IoT Data Monitoring'), pn.layout.HSpacer(margin=10)),
                 pn.Row(pn.layout.HSpacer(margin=10), col_chart1, pn.layout.HSpacer(), col_chart2, pn.layout.HSpacer(margin=10)),
                 pn.Row(pn.layout.HSpacer(margin=10), colname_widget1, pn.layout.HSpacer(), colname_widget2, pn.layout.HSpacer(margin=10)),
-                pn.Row(pn.layout.HSpacer(margin=10), date_picker, pn.layout.HSpacer(margin=10), id_selector, pn.layout.HSpacer(margin=10)),
+                pn.Row(pn.layout.HSpacer(margin=10), date_picker, pn.layout.HSpacer(margin=10), id_selector, pn.layout.HSpacer(margin=10), lod_selector, pn.layout.HSpacer(margin=10), live_toggle, pn.layout.HSpacer(margin=10)),
                 pn.Row(pn.layout.HSpacer(margin=10), missing_records_table, pn.layout.HSpacer(margin=10)),
                 pn.Row(pn.layout.HSpacer(margin=10), table_issue_selector, pn.layout.HSpacer(margin=10))
             )
         gb.servable()
 
-rdr = MongoReader()
+rdr = get_reader()
 vw = Viewer(rdr)
 
 vw.plot_it()